@@ -1,36 +1,50 @@
 from logger_config import (
     app_logger, log_request, log_response, log_error,
-    log_user_action, log_session_event, log_database_operation
+    log_user_action, log_session_event
 )
 from functools import wraps
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_wtf.csrf import CSRFProtect, generate_csrf, validate_csrf
 from flask_wtf import FlaskForm
-from config import Config
-from flask import Flask, abort, render_template, request, jsonify, session, redirect, url_for,g
+from config import Config, DATABASE_CONFIG
+from db_pool import REPLICA, get_pool, pool_stats
+from user_cache import user_cache
+from query_tracker import RequestQueries
+import rate_limit_storage  # registra el esquema pgpool:// de Flask-Limiter
+from email_service import email_queue, email_service
+import session_events
+import auth_service
+import session_tokens
+from session_tokens import generation_cache
+from interaction_tracker import interaction_tracker
+from health import health_checker
+from maintenance import MAINTENANCE_IN_PROCESS, maintenance_scheduler
+import recognition_jobs
+from recognition_jobs import RECOGNITION_IN_PROCESS, caras_como_facepp, deteccion_vigente, recognition_worker
+import repository
+import migrations
+from flask import Flask, Response, abort, render_template, request, jsonify, session, redirect, stream_with_context, url_for,g
 import psycopg2
 import secrets
 import hashlib
 import json
 from datetime import datetime, timedelta
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
-import requests
 import base64
 from io import BytesIO
 import time
 import socket
 import threading
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
-from services import detect_faces_facepp, get_face_crop, upload_face_crop_to_cloudinary, upload_temp_face_crop, get_face_crop_from_facepp
+from face_detectors import detector
+from face_index import embedder, indexar_confirmadas
+from services import get_face_crops, upload_face_crop_to_cloudinary
 # Cargar variables de entorno
 from dotenv import load_dotenv
 load_dotenv()
@@ -38,6 +52,7 @@ from whitenoise import WhiteNoise
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 import multiprocessing
+import atexit
 
 # Número de workers
 workers = multiprocessing.cpu_count() * 2 + 1
@@ -85,41 +100,21 @@ app.config['PREFERRED_URL_SCHEME'] = 'https'
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["3000 per day", "500 per hour"],
-    storage_uri="memory://"
+    default_limits=["3000 per day", "500 per hour"]
 )
 
 # Configurar protección CSRF
 csrf = CSRFProtect(app)
 
-# Configuración de la base de datos PostgreSQL
-DATABASE_CONFIG = {
-    'host': os.getenv('DATABASE_HOST', 'ep-divine-sea-a2tsh7q5.eu-central-1.pg.koyeb.app'),
-    'database': os.getenv('DATABASE_NAME', 'koyebdb'),
-    'user': os.getenv('DATABASE_USER', 'koyeb-adm'),
-    'password': os.getenv('DATABASE_PASSWORD', 'npg_dGpMKX9j8qnm'),
-    'port': os.getenv('DATABASE_PORT', '5432'),
-    'connect_timeout': 10,
-    'sslmode': 'require'
-}
+# Configuración de la base de datos PostgreSQL (ver config.py)
 app_logger.info(f"Using PostgreSQL database: {DATABASE_CONFIG['host']}")
 
 def get_db():
-    """Obtener conexión a la base de datos PostgreSQL"""
+    """Obtener conexión a la base de datos PostgreSQL desde el pool del worker"""
     if 'db' not in g:
         try:
-            app_logger.info(f"Conectando a PostgreSQL con host: {DATABASE_CONFIG['host']}")
-            g.db = psycopg2.connect(
-                host=DATABASE_CONFIG['host'],
-                database=DATABASE_CONFIG['database'],
-                user=DATABASE_CONFIG['user'],
-                password=DATABASE_CONFIG['password'],
-                port=DATABASE_CONFIG['port'],
-                connect_timeout=DATABASE_CONFIG.get('connect_timeout', 10),
-                sslmode=DATABASE_CONFIG.get('sslmode', 'require')
-            )
-            g.db.autocommit = True
-            app_logger.info("Conexión a PostgreSQL establecida exitosamente")
+            g.db = get_pool().getconn()
+            g.db.query_tracker = request_queries()
         except psycopg2.OperationalError as e:
             app_logger.error(f"Error de conexión operacional a PostgreSQL: {str(e)}")
             raise
@@ -131,131 +126,61 @@ def get_db():
             raise
     return g.db
 
+def get_read_db():
+    """Conexión para vistas de solo lectura: la réplica, salvo que la sesión acabe de escribir"""
+    if 'db_read' in g:
+        return g.db_read
+
+    pool = get_pool(REPLICA)
+    if pool is not None and session.get('db_primary_until', 0) <= time.time():
+        try:
+            g.db_read = pool.getconn()
+            g.db_read.query_tracker = request_queries()
+            return g.db_read
+        except psycopg2.OperationalError as e:
+            app_logger.warning(f"Réplica no disponible, leyendo del primario: {str(e)}")
+    return get_db()
+
+def request_queries():
+    """RequestQueries de la petición actual (compartido por primario y réplica)"""
+    if 'query_tracker' not in g:
+        g.query_tracker = RequestQueries()
+    return g.query_tracker
+
+@app.after_request
+def log_request_queries(response):
+    """Resumen SQL de la petición: línea de log, cabecera Server-Timing y aviso de N+1"""
+    queries = g.get('query_tracker')
+    if queries is None or not queries.count:
+        return response
+
+    response.headers.add('Server-Timing', queries.server_timing())
+    slowest_time, slowest_sql = queries.slowest
+    app_logger.info(
+        f"SQL {request.method} {request.path} - {queries.count} consultas, "
+        f"{queries.total * 1000:.1f} ms (más lenta {slowest_time * 1000:.1f} ms: {slowest_sql[:120]})")
+    for sql, veces, total_ms in queries.repeated(app.config['SQL_REPEAT_WARN']):
+        app_logger.warning(
+            f"N+1 {request.method} {request.path} - {veces} ejecuciones, {total_ms:.1f} ms: {sql[:200]}")
+    return response
+
+@app.after_request
+def pin_session_to_primary(response):
+    """Tras una escritura, las lecturas de la sesión van al primario unos segundos (retraso de la réplica)"""
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and 'db' in g and get_pool(REPLICA) is not None:
+        session['db_primary_until'] = time.time() + app.config['DB_REPLICA_STICKY_SECONDS']
+    return response
+
 @app.teardown_appcontext
 def close_db(e=None):
-    """Cerrar la conexión a la base de datos al final de la petición"""
+    """Devolver las conexiones a sus pools al final de la petición"""
+    broken = isinstance(e, psycopg2.OperationalError)
     db = g.pop('db', None)
     if db is not None:
-        db.close()
-
-def init_db():
-    """Inicializar la base de datos PostgreSQL"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Crear tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                alias TEXT,
-                phone TEXT,
-                email TEXT,
-                access_token TEXT,
-                token_expires TIMESTAMP,
-                verification_code TEXT,
-                code_expires TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_interaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_interaction_days INTEGER DEFAULT 1
-            )
-        ''')
-
-        # Crear tabla de sesiones
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER,
-                token TEXT UNIQUE,
-                expires TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-
-        # Crear tabla de códigos de verificación
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS verification_codes (
-                id SERIAL PRIMARY KEY,
-                email TEXT NOT NULL,
-                name TEXT,
-                code TEXT NOT NULL,
-                expires TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Crear tabla de fotos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS photos (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                nombre TEXT,
-                nombre_archivo TEXT NOT NULL,
-                categoria TEXT,
-                mes INTEGER,
-                año INTEGER,
-                personas_ids TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-
-        # Crear tabla de personas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS personas (
-                id SERIAL PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                imagen TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Crear tabla para solicitudes de cambio de email
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_change_requests (
-                user_id INTEGER PRIMARY KEY,
-                new_email TEXT NOT NULL,
-                verification_code TEXT NOT NULL,
-                expires TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-
-        # Crear tabla para verificaciones de email
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_verification (
-                email TEXT PRIMARY KEY,
-                name TEXT,
-                code TEXT,
-                expires TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Crear índices para optimizar consultas
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_token ON sessions(token)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_email ON verification_codes(email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_code ON verification_codes(code)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_user_id ON photos(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_año ON photos(año)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_mes ON photos(mes)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_personas_nombre ON personas(nombre)')
-
-        conn.commit()
-        app_logger.info("PostgreSQL database initialized successfully")
-        
-    except Exception as e:
-        app_logger.error(f"Error initializing PostgreSQL database: {str(e)}")
-        raise
+        get_pool().putconn(db, broken=broken)
+    db_read = g.pop('db_read', None)
+    if db_read is not None:
+        get_pool(REPLICA).putconn(db_read, broken=broken)
 
 # Manejo de errores de rate limiting
 @app.errorhandler(429)
@@ -272,155 +197,32 @@ def ratelimit_handler(e):
                            description=e.description,
                            retry_after=e.retry_after), 429
 
-def create_user_email(name, email):
-    """Crear nuevo usuario con email en la base de datos"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO users (name, email, created_at, updated_at)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        ''', (name, email, datetime.now(), datetime.now()))
-
-        user_id = cursor.fetchone()[0]
-        conn.commit()
-        log_database_operation('INSERT', 'users', f'Email: {email}, ID: {user_id}')
-        return user_id
-
-    except psycopg2.IntegrityError as e:
-        log_error('create_user_email', e, f'Email: {email}')
-        return None
-    except Exception as e:
-        log_error('create_user_email', e, f'Email: {email}')
-        return None
-
-def create_user_session_email(user_id):
-    """Crear sesión segura para usuario autenticado con email"""
-    try:
-        access_token = secrets.token_urlsafe(32)
-        token_expires = datetime.now() + timedelta(hours=8)
-
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET access_token = %s, token_expires = %s, updated_at = %s
-            WHERE id = %s
-        ''', (access_token, token_expires, datetime.now(), user_id))
-        conn.commit()
-
-        # Configurar sesión
-        session.permanent = True
-        session['user_id'] = user_id
-        session['access_token'] = access_token
-
-        log_database_operation('UPDATE', 'users', f'Session created for user {user_id}')
-        return access_token
-
-    except Exception as e:
-        log_error('create_user_session_email', e, f'User ID: {user_id}')
-        return None
-
-def store_verification_code(email, name, code):
-    """Almacenar código de verificación en la base de datos"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        expires = datetime.now() + timedelta(minutes=10)  # Código válido por 10 minutos
-
-        # Limpiar códigos anteriores para este email
-        cursor.execute('DELETE FROM verification_codes WHERE email = %s', (email,))
-
-        # Insertar nuevo código
-        cursor.execute('''
-            INSERT INTO verification_codes (email, name, code, expires)
-            VALUES (%s, %s, %s, %s)
-        ''', (email, name, code, expires))
-
-        conn.commit()
-        log_database_operation('INSERT', 'verification_codes', f'Email: {email}')
-        return True
-
-    except Exception as e:
-        log_error('store_verification_code', e, f'Email: {email}')
-        return False
-
-def verify_code(email, code):
-    """Verificar código de verificación desde la base de datos"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Buscar código válido
-        cursor.execute('''
-            SELECT name FROM verification_codes 
-            WHERE email = %s AND code = %s AND expires > %s
-        ''', (email, code, datetime.now()))
-        result = cursor.fetchone()
-
-        if result:
-            # Limpiar código usado
-            cursor.execute('DELETE FROM verification_codes WHERE email = %s AND code = %s', (email, code))
-            conn.commit()
-            log_database_operation('DELETE', 'verification_codes', f'Email: {email}, Code verified')
-            return result[0]  # PostgreSQL devuelve tuplas
-
-        return None
+def open_session_with_code(email, code):
+    """Consumir el código y abrir la sesión (auth_service.py); devuelve el usuario o None"""
+    token_expires = datetime.now() + auth_service.SESSION_TTL
+    signed = app.config['SIGNED_ACCESS_TOKENS']
+    access_token = None if signed else secrets.token_urlsafe(32)
 
-    except Exception as e:
-        log_error('verify_code', e, f'Email: {email}')
+    user = auth_service.verificar_codigo(get_db(), email, code, access_token, token_expires)
+    if user is None:
         return None
 
-def cleanup_expired_codes():
-    """Limpiar códigos de verificación expirados"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM verification_codes WHERE expires <= %s', (datetime.now(),))
-        deleted_count = cursor.rowcount
-        conn.commit()
-
-        if deleted_count > 0:
-            log_database_operation('DELETE', 'verification_codes', f'Cleaned {deleted_count} expired codes')
+    if signed:
+        # La generación llega en la misma sentencia: firmar sin otra consulta
+        generation_cache.set(user['id'], user['generation'])
+        access_token = session_tokens.issue_token(app.config['SECRET_KEY'], user['id'],
+                                                  token_expires, user['generation'])
 
-    except Exception as e:
-        log_error('cleanup_expired_codes', e, 'Cleanup failed')
+    session.permanent = True
+    session['user_id'] = user['id']
+    session['access_token'] = access_token
+    invalidate_current_user(user['id'])
+    user['access_token'] = access_token
+    return user
 
 def update_interaction_days(user_id):
-    """Actualiza los días de interacción del usuario."""
-    conn = None
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Obtener la última fecha de interacción y los días totales
-        cursor.execute(
-            "SELECT last_interaction_date, total_interaction_days FROM users WHERE id = %s", (user_id,))
-        result = cursor.fetchone()
-
-        if result:
-            last_interaction_date_str = result[0]
-            total_interaction_days = result[1]
-
-            last_interaction_date = last_interaction_date_str
-            today = datetime.now().date()
-
-            if last_interaction_date.date() < today:
-                # Si la última interacción fue en un día diferente, incrementar el contador
-                total_interaction_days += 1
-                cursor.execute("UPDATE users SET last_interaction_date = %s, total_interaction_days = %s WHERE id = %s",
-                               (datetime.now(), total_interaction_days, user_id))
-                conn.commit()
-                app_logger.info(
-                    f"User {user_id}: Interaction days updated to {total_interaction_days}")
-            else:
-                app_logger.info(
-                    f"User {user_id}: Interaction already logged for today.")
-
-    except Exception as e:
-        app_logger.error(
-            f"Error updating interaction days for user {user_id}: {e}")
+    """Anotar la interacción de hoy; se escribe en bloque (interaction_tracker.py)"""
+    interaction_tracker.mark(user_id)
 
 def upload_to_cloudinary(file, user_id, original_filename):
     """Subir archivo a Cloudinary y retornar URL"""
@@ -477,120 +279,50 @@ def delete_from_cloudinary(public_id):
         return False
 
 def send_verification_email(email, code, name="Usuario"):
-    """Enviar código de verificación por email"""
+    """Encolar el código de verificación por email (plantillas de email_service)"""
     try:
-        # Configuración SMTP desde variables de entorno
-        smtp_server = os.getenv('SMTP_SERVER')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        smtp_email = os.getenv('SMTP_EMAIL')
-        smtp_password = os.getenv('SMTP_PASSWORD')
-        smtp_from_name = os.getenv('SMTP_FROM_NAME', 'Auth App')
-
-        if not all([smtp_server, smtp_email, smtp_password]):
+        if not email_service.is_configured():
             print("Configuracion SMTP incompleta")
             return False
 
-        # Crear mensaje HTML
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{smtp_from_name} <{smtp_email}>"
-        msg['To'] = email
-        msg['Subject'] = f"Tu código de verificación: {code}"
-
-        # Cuerpo del email en HTML elegante
-        html_body = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        </head>
-        <body style="margin: 0; padding: 20px; font-family: Arial, sans-serif; background-color: #f5f5f5;">
-            <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.1);">
-                
-                <!-- Header -->
-                <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; text-align: center;">
-                    <h1 style="color: white; margin: 0 0 20px 0; font-size: 24px; font-weight: 300;">
-                        🔐 Código de Verificación
-                    </h1>
-                    <p style="color: rgba(255,255,255,0.9); margin: 10px 0 0 0; font-size: 16px;">
-                        Hola {name}, aquí tienes tu código
-                    </p>
-                </div>
-                
-                <!-- Content -->
-                <div style="padding: 40px 30px;">
-                    <p style="color: #666; font-size: 16px; line-height: 1.6; margin-bottom: 30px;">
-                        Has solicitado acceso a tu cuenta. Usa el siguiente código para completar la verificación:
-                    </p>
-                    
-                    <!-- Code Box -->
-                    <div style="border: 2px dashed #3498db; border-radius: 10px; padding: 30px; text-align: center; background: #f8f9ff; margin: 30px 0;">
-                        <div style="font-size: 36px; font-weight: bold; color: #3498db; letter-spacing: 8px; margin-bottom: 10px;">
-                            {code}
-                        </div>
-                        <p style="color: #999; margin: 0; font-size: 14px;">
-                            Código de 6 dígitos
-                        </p>
-                    </div>
-                    
-                    <!-- Warning -->
-                    <div style="background: #fff3cd; border: 1px solid #ffeaa7; border-radius: 8px; padding: 15px; margin: 20px 0;">
-                        <p style="color: #856404; margin: 0; font-size: 14px;">
-                            ⏰ Este código expira en 10 minutos
-                        </p>
-                    </div>
-                    
-                    <p style="color: #666; font-size: 14px; line-height: 1.6; margin-top: 30px;">
-                        Si no solicitaste este código, puedes ignorar este email.
-                    </p>
-                </div>
-                
-                <!-- Footer -->
-                <div style="background: #f8f9fa; padding: 20px 30px; text-align: center; border-top: 1px solid #eee;">
-                    <p style="color: #999; margin: 0; font-size: 12px;">
-                        © 2024 {smtp_from_name} - Sistema de Autenticación Segura
-                    </p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-
-        # Texto plano como fallback
-        text_body = f"""
-Hola {name},
-
-Tu código de verificación es: {code}
-
-Este código expira en 10 minutos.
-
-Si no solicitaste este código, puedes ignorar este email.
-
-Saludos,
-{smtp_from_name}
-        """
-
-        msg.attach(MIMEText(text_body, 'plain'))
-        msg.attach(MIMEText(html_body, 'html'))
-
-        # Enviar email
-        if smtp_port == 465:
-            server = smtplib.SMTP_SSL(smtp_server, smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            server.starttls()
-
-        server.login(smtp_email, smtp_password)
-        server.send_message(msg)
-        server.quit()
+        # Encolar: el hilo de email_service lo envía por su sesión SMTP persistente
+        if not email_service.send_verification_code(email, name, code):
+            return False
 
-        print(f"Email enviado a {email}")
+        print(f"Email encolado para {email}")
         return True
 
     except Exception as e:
         print(f"Error enviando email: {e}")
         return False
 
+def render_galeria(template, template_pagina, user, condiciones=None, params=(), busqueda=None, **extra):
+    """Renderizar una galería paginada: la página completa o, con ?cursor=, solo la siguiente página"""
+    conn = get_read_db()
+    consulta = repository.consulta_galeria(conn, condiciones, params, busqueda)
+
+    valor_cursor = request.args.get('cursor')
+    despues_de = repository.decode_galeria_cursor(valor_cursor, consulta['por_ranking']) if valor_cursor else None
+    if valor_cursor and despues_de is None:
+        return render_template('error.html', message='Página de fotos no válida'), 400
+
+    # Pedir una foto de más para saber si hay página siguiente
+    page_size = app.config['GALLERY_PAGE_SIZE']
+    fotos = repository.pagina_galeria(conn, consulta, page_size + 1, despues_de)
+    siguiente_url = None
+    if len(fotos) > page_size:
+        fotos = fotos[:page_size]
+        args = request.args.to_dict()
+        args['cursor'] = repository.encode_galeria_cursor(repository.clave_galeria(consulta, fotos[-1]))
+        siguiente_url = url_for(request.endpoint, **args)
+
+    contexto = dict(fotos=fotos, user=user, siguiente_url=siguiente_url, **extra)
+    if despues_de:
+        return render_template(template_pagina, **contexto)
+
+    total_fotos = len(fotos) if not siguiente_url else repository.contar_fotos_galeria(conn, consulta)
+    return render_template(template, total_fotos=total_fotos, **contexto)
+
 def get_user_display_name(user):
     """Obtener el mejor nombre disponible para mostrar"""
     if not user:
@@ -626,35 +358,110 @@ def require_debug(f):
     return decorated_function
 
 def get_current_user():
-    """Obtener usuario actual de la sesión"""
+    """Obtener usuario actual de la sesión (memorizado en g durante la petición)"""
+    if 'current_user' in g:
+        return g.current_user
+
     if 'user_id' not in session or 'access_token' not in session:
         return None
 
     user_id = session['user_id']
     access_token = session['access_token']
 
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM users 
-        WHERE id = %s AND access_token = %s AND token_expires > %s
-    ''', (user_id, access_token, datetime.now()))
-    user_row = cursor.fetchone()
-    
-    if user_row:
-        # Convert row to dict
-        columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(columns, user_row))
-        return user
+    if session_tokens.is_signed_token(access_token):
+        # Token firmado: se valida en el proceso; solo falta la fila (cacheada) del usuario
+        claims = verify_access_token(user_id, access_token)
+        user = user_cache.get(user_id, access_token) if claims else None
+        if claims and user is None:
+            user = repository.get_user_by_id(get_db(), user_id)
+            if user:
+                user['token_expires'] = claims.expires_at
+                user_cache.set(user_id, access_token, user)
     else:
+        user = user_cache.get(user_id, access_token)
+        if user is None:
+            user = repository.get_user_by_token(get_db(), user_id, access_token)
+            if user:
+                user_cache.set(user_id, access_token, user)
+
+    if user is None:
         # Limpiar sesión inválida
         session.clear()
+
+    g.current_user = user
+    return user
+
+def verify_access_token(user_id, access_token):
+    """TokenClaims de un token firmado válido y no revocado, o None"""
+    claims = session_tokens.verify_token(app.config['SECRET_KEY'], access_token)
+    if claims is None or claims.user_id != user_id:
         return None
+    generation = generation_cache.get(user_id)
+    if generation is None:
+        generation = repository.get_token_generation(get_db(), user_id)
+        if generation is None:
+            return None
+        generation_cache.set(user_id, generation)
+    return claims if claims.generation >= generation else None
+
+def new_access_token(user_id, token_expires):
+    """Token de acceso para una sesión nueva: firmado si SIGNED_ACCESS_TOKENS, si no aleatorio"""
+    if not app.config['SIGNED_ACCESS_TOKENS']:
+        return secrets.token_urlsafe(32)
+    generation = repository.get_token_generation(get_db(), user_id) or 0
+    generation_cache.set(user_id, generation)
+    return session_tokens.issue_token(app.config['SECRET_KEY'], user_id, token_expires, generation)
+
+def revoke_access_tokens(user_id):
+    """Revocar los tokens firmados del usuario (todos sus dispositivos)"""
+    generation_cache.set(user_id, repository.bump_token_generation(get_db(), user_id))
+
+def get_session_expiry():
+    """(autenticado, caducidad) de la sesión; con token firmado no consulta users"""
+    access_token = session.get('access_token')
+    if session_tokens.is_signed_token(access_token):
+        claims = verify_access_token(session.get('user_id'), access_token)
+        return claims is not None, claims.expires_at if claims else None
+
+    user = get_current_user()
+    if not user:
+        return False, None
+    token_expires = user['token_expires']
+    if isinstance(token_expires, str):
+        token_expires = datetime.fromisoformat(token_expires)
+    return True, token_expires
+
+def invalidate_current_user(user_id=None):
+    """Olvidar el usuario memorizado en g y en la caché del worker"""
+    g.pop('current_user', None)
+    user_cache.invalidate(user_id if user_id is not None else session.get('user_id'))
 
 @app.route('/health')
+@limiter.exempt
 def health_check():
+    """Sonda de vida: no consulta nada"""
     return {'status': 'healthy'}, 200
 
+@app.route('/ready')
+@limiter.exempt
+def readiness_check():
+    """Sonda de disponibilidad: último resultado de health_checker (no espera a ningún servicio)"""
+    ready, informe = health_checker.snapshot()
+    return jsonify(informe), 200 if ready else 503
+
+@app.route('/api/db-pool-stats')
+@require_auth
+def db_pool_stats():
+    """Estadísticas del pool de conexiones y de las consultas del repositorio en este worker"""
+    return jsonify({'pid': os.getpid(), 'pool': pool_stats(), 'replica_pool': pool_stats(REPLICA),
+                    'queries': repository.query_stats()})
+
+@app.route('/api/email-queue-stats')
+@require_auth
+def email_queue_stats():
+    """Profundidad de la cola de emails y latencia de envío en este worker"""
+    return jsonify(email_queue.stats())
+
 @app.route('/')
 def index():
     user = get_current_user()  # Get user to check if logged in
@@ -788,33 +595,13 @@ def htmx_register():
         if not name or not email:
             return render_template('auth_register_form.html')
 
-        # Verificar que el email no exista
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id FROM users WHERE email = %s', (email,))
-        existing_user = cursor.fetchone()
-
-        if existing_user:
-            return render_template('auth_user_exists.html', email=email)
-
-        # Generar código de verificación
-        verification_code = str(secrets.randbelow(900000) + 100000)
-        code_expires = datetime.now() + timedelta(minutes=10)
-
+        # Generar código; se guarda solo si el email no tiene cuenta (una sentencia)
+        verification_code = auth_service.generar_codigo()
         print(
             f"DEBUG REGISTER: Generando código '{verification_code}' para {email}")
-        print(f"DEBUG REGISTER: Expira en: {code_expires}")
-
-        # Crear usuario temporal con código
-        cursor.execute('''
-            INSERT INTO users (name, email, verification_code, code_expires, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        ''', (name, email, verification_code, code_expires, datetime.now(), datetime.now()))
 
-        user_id = cursor.fetchone()[0]
-        conn.commit()
+        if not auth_service.emitir_codigo_registro(get_db(), email, name, verification_code):
+            return render_template('auth_user_exists.html', email=email)
 
         # Enviar código por email
         email_sent = send_verification_email(email, verification_code, name)
@@ -841,36 +628,17 @@ def htmx_login():
         if not email:
             return render_template('auth_login_form.html')
 
-        # Verificar que el email existe
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, name FROM users WHERE email = %s', (email,))
-        existing_user = cursor.fetchone()
-
-        if not existing_user:
-            return render_template('auth_user_not_found.html', email=email)
-
-        # Generar código de verificación
-        verification_code = str(secrets.randbelow(900000) + 100000)
-        code_expires = datetime.now() + timedelta(minutes=10)
-
+        # Generar código; se guarda solo si el email tiene cuenta (una sentencia)
+        verification_code = auth_service.generar_codigo()
         print(
             f"DEBUG LOGIN: Generando código '{verification_code}' para {email}")
-        print(f"DEBUG LOGIN: Expira en: {code_expires}")
-
-        # Actualizar usuario con código
-        cursor.execute('''
-            UPDATE users 
-            SET verification_code = %s, code_expires = %s, updated_at = %s
-            WHERE email = %s
-        ''', (verification_code, code_expires, datetime.now(), email))
 
-        conn.commit()
+        user_name = auth_service.emitir_codigo_login(get_db(), email, verification_code)
+        if user_name is None:
+            return render_template('auth_user_not_found.html', email=email)
 
         # Enviar código por email
-        email_sent = send_verification_email(
-            email, verification_code, existing_user[1])
+        email_sent = send_verification_email(email, verification_code, user_name)
         if not email_sent:
             print(
                 f"⚠️ No se pudo enviar email a {email}, pero continuando con el proceso")
@@ -904,40 +672,8 @@ def htmx_verify():
                                    error="Email y código son requeridos",
                                    flow_type='login')
 
-        # Verificar código directamente en la base de datos
-        app_logger.info("Obteniendo conexión a la base de datos")
-        conn = get_db()
-        cursor = conn.cursor()
-        app_logger.info("Conexión a la base de datos obtenida exitosamente")
-
-        # Primero buscar el usuario por email para debug
-        app_logger.info(f"Buscando usuario con email: {email}")
-        cursor.execute('''
-            SELECT id, name, email, verification_code, code_expires 
-            FROM users 
-            WHERE email = %s
-        ''', (email,))
-        debug_user = cursor.fetchone()
-        app_logger.info(
-            f"DEBUG VERIFY: Usuario encontrado: {debug_user if debug_user else 'None'}")
-
-        if debug_user:
-            app_logger.info(f"DEBUG VERIFY: Código recibido: '{code}'")
-            app_logger.info(
-                f"DEBUG VERIFY: Código en DB: '{debug_user[3] if debug_user else 'None'}'")
-            app_logger.info(
-                f"DEBUG VERIFY: Expira en: {debug_user[4] if debug_user else 'None'}")
-        app_logger.info(f"DEBUG VERIFY: Hora actual: {datetime.now()}")
-
-        app_logger.info("Verificando código de verificación")
-        cursor.execute('''
-            SELECT id, name, verification_code, code_expires 
-            FROM users 
-            WHERE email = %s AND verification_code = %s AND code_expires > %s
-        ''', (email, code, datetime.now()))
-        user = cursor.fetchone()
-        app_logger.info(f"Resultado de verificación: {user is not None}")
-
+        # Consumir el código y abrir la sesión en una sola sentencia
+        user = open_session_with_code(email, code)
         if not user:
             app_logger.warning(f"Código incorrecto o expirado para email {email}")
             return render_template('auth_verify_simple.html',
@@ -945,30 +681,8 @@ def htmx_verify():
                                    error="Código incorrecto o expirado",
                                    flow_type='login')
 
-        # Limpiar código de verificación
-        app_logger.info("Limpiando código de verificación")
-        cursor.execute('''
-            UPDATE users 
-            SET verification_code = NULL, code_expires = NULL, updated_at = %s
-            WHERE id = %s
-        ''', (datetime.now(), user[0]))
-        conn.commit()
-        app_logger.info("Código de verificación limpiado exitosamente")
-
-        user_id = user[0]
-
-        # Crear sesión
-        app_logger.info(f"Creando sesión para usuario {user_id}")
-        access_token = create_user_session_email(user_id)
-        if not access_token:
-            app_logger.error(f"Error creando sesión para usuario {user_id}")
-            return render_template('auth_verify_simple.html',
-                                   email=email,
-                                   error="Error creando sesión",
-                                   flow_type='login')
-        app_logger.info("Sesión creada exitosamente")
-
-        log_user_action(user_id, 'LOGIN_SUCCESS', f'Email: {email}')
+        log_user_action(user['id'], 'REGISTER_SUCCESS' if user['created'] else 'LOGIN_SUCCESS',
+                        f'Email: {email}')
 
         # Retornar template de éxito
         app_logger.info("Retornando auth_success.html")
@@ -1263,7 +977,6 @@ def upload_photos():
         uploaded_photos = []
         failed_uploads = []
         conn = get_db()
-        cursor = conn.cursor()
 
         for i, file in enumerate(files):
             if file and file.filename:
@@ -1295,13 +1008,8 @@ def upload_photos():
                     continue
 
                 # Guardar en base de datos con URL de Cloudinary
-                cursor.execute('''
-                    INSERT INTO photos (user_id, nombre, nombre_archivo, mes, año, created_at, updated_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                ''', (user['id'], nombre, cloudinary_result['url'], mes, año, datetime.now(), datetime.now()))
-
-                photo_id = cursor.fetchone()[0]
+                photo_id = repository.insertar_foto(
+                    conn, user['id'], nombre, cloudinary_result['url'], mes, año)
                 uploaded_photos.append({
                     'id': photo_id,
                     'nombre': nombre,
@@ -1362,48 +1070,8 @@ def fotos_recien_subidas():
         if not foto_ids:
             return render_template('galeria_todas_fotos.html', fotos=[], user=user)
 
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Crear placeholders para la consulta SQL
-        placeholders = ','.join(['%s' for _ in foto_ids])
-
         # Obtener solo las fotos recién subidas
-        cursor.execute(f'''
-            SELECT p.*, u.name as usuario_nombre
-            FROM photos p
-            JOIN users u ON p.user_id = u.id
-            WHERE p.id IN ({placeholders})
-            ORDER BY p.created_at DESC
-        ''', foto_ids)
-        fotos = cursor.fetchall()
-
-        # Convertir a lista de diccionarios
-        fotos_list = []
-        columns = [desc[0] for desc in cursor.description]
-        for foto in fotos:
-            foto_dict = dict(zip(columns, foto))
-            # Determinar si necesita etiquetado
-            personas_ids = foto_dict['personas_ids']
-            necesita_etiquetado = (
-                not personas_ids or
-                personas_ids == 'null' or
-                personas_ids == '' or
-                personas_ids == '[]' or
-                personas_ids == 'None'
-            )
-
-            fotos_list.append({
-                'id': foto_dict['id'],
-                'nombre': foto_dict['nombre'],
-                'nombre_archivo': foto_dict['nombre_archivo'],
-                'mes': foto_dict['mes'],
-                'año': foto_dict['año'],
-                'usuario_nombre': foto_dict['usuario_nombre'],
-                'created_at': foto_dict['created_at'],
-                'personas_ids': foto_dict['personas_ids'],
-                'necesita_etiquetado': necesita_etiquetado
-            })
+        fotos_list = repository.fotos_por_ids(get_db(), foto_ids)
 
         log_user_action(user['id'], 'VIEW_RECENT_UPLOADS',
                         f'Viewed {len(fotos_list)} recently uploaded photos')
@@ -1427,23 +1095,13 @@ def editar_nombre():
     if not photo_id:
         return '<div class="alert alert-danger m-3">ID de foto no proporcionado.</div>', 400
 
-    conn = get_db()
-    cursor = conn.cursor()
     # Asegurarse de que el usuario solo pueda editar sus propias fotos
-    cursor.execute(
-        'SELECT id, nombre, nombre_archivo, mes, año FROM photos WHERE id = %s AND user_id = %s',
-        (photo_id, user['id'])
-    )
-    foto = cursor.fetchone()
+    foto = repository.foto_editable(get_db(), photo_id, user['id'])
 
     if not foto:
         return '<div class="alert alert-danger m-3">Foto no encontrada o no tienes permiso para editarla.</div>', 404
 
-    # Convertir a dict
-    columns = [desc[0] for desc in cursor.description]
-    foto_dict = dict(zip(columns, foto))
-
-    return render_template('editar_nombre.html', foto=foto_dict)
+    return render_template('editar_nombre.html', foto=foto)
 
 @app.route('/api/actualizar_nombre/<int:photo_id>', methods=['POST'])
 @require_auth
@@ -1451,28 +1109,14 @@ def actualizar_nombre(photo_id):
     """Actualiza el nombre de una foto."""
     user = get_current_user()
 
-    conn = get_db()
-    cursor = conn.cursor()
-    # Verificar que la foto pertenece al usuario
-    cursor.execute(
-        'SELECT id FROM photos WHERE id = %s AND user_id = %s',
-        (photo_id, user['id'])
-    )
-    foto = cursor.fetchone()
-
-    if not foto:
-        return '<div class="alert alert-danger">Foto no encontrada o sin permiso.</div>', 404
-
     try:
         nuevo_nombre = request.form.get('nombre', '').strip()
         if not nuevo_nombre:
             return '<div class="alert alert-danger">El nombre no puede estar vacío.</div>', 400
 
-        cursor.execute(
-            'UPDATE photos SET nombre = %s, updated_at = %s WHERE id = %s',
-            (nuevo_nombre, datetime.now(), photo_id)
-        )
-        conn.commit()
+        # Solo se actualiza si la foto pertenece al usuario
+        if not repository.actualizar_nombre_foto(get_db(), photo_id, user['id'], nuevo_nombre):
+            return '<div class="alert alert-danger">Foto no encontrada o sin permiso.</div>', 404
 
         log_user_action(user['id'], 'UPDATE_PHOTO_NAME',
                         f'Updated photo ID: {photo_id} to name: {nuevo_nombre}')
@@ -1651,19 +1295,11 @@ def update_profile():
             '''
 
         # Actualizar información (solo nombre y teléfono)
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET name = %s, phone = %s, updated_at = %s
-            WHERE id = %s
-        ''', (name, phone if phone else None, datetime.now(), user['id']))
-        conn.commit()
+        repository.update_profile(get_db(), user['id'], name, phone if phone else None)
+        invalidate_current_user(user['id'])
 
         log_user_action(user['id'], 'UPDATE_PROFILE_SUCCESS',
                         f'Updated: {name}, {phone}')
-        log_database_operation(
-            'UPDATE', 'users', f'Profile updated for user {user["id"]}')
 
         return '''
         <div class="alert alert-success">
@@ -1765,16 +1401,8 @@ def delete_account_modal():
 
         # Intentar contar registros relacionados
         try:
-            conn = get_db()
-            cursor = conn.cursor()
-
-            cursor.execute(
-                'SELECT COUNT(*) as count FROM email_change_requests WHERE user_id = %s',
-                (user['id'],))
-            email_requests_row = cursor.fetchone()
-            if email_requests_row:
-                user_stats['email_requests'] = email_requests_row[0]
-
+            user_stats['email_requests'] = repository.contar_solicitudes_cambio_email(
+                get_db(), user['id'])
         except:
             pass  # Usar valores por defecto
 
@@ -1881,36 +1509,16 @@ def request_email_change():
             </div>
             '''
 
-        # Verificar que el nuevo email no esté en uso
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id FROM users WHERE email = %s', (new_email,))
-        existing_user = cursor.fetchone()
-
-        if existing_user:
+        # Guardar la solicitud solo si el nuevo email no está en uso (una sentencia)
+        verification_code = auth_service.generar_codigo()
+        if not auth_service.solicitar_cambio_email(get_db(), user['id'], new_email, verification_code):
             return '''
             <div class="alert alert-danger">
                 <strong>Error:</strong> Este email ya está en uso por otra cuenta.
             </div>
             '''
 
-        # Generar código de verificación
-        verification_code = str(
-            secrets.randbelow(900000) + 100000)  # 6 dígitos
-        code_expires = datetime.now() + timedelta(minutes=10)
-
-        # Guardar solicitud de cambio de email
-        cursor.execute('''
-            INSERT INTO email_change_requests (user_id, new_email, verification_code, expires)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET new_email = %s, verification_code = %s, expires = %s, created_at = CURRENT_TIMESTAMP
-        ''', (user['id'], new_email, verification_code, code_expires, new_email, verification_code, code_expires))
-        conn.commit()
-
         # Enviar email de verificación al NUEVO email
-        from email_service import email_service
         if email_service.send_verification_code(new_email, user['name'], verification_code):
             log_user_action(
                 user['id'], 'EMAIL_CHANGE_CODE_SENT', f'Code sent to: {new_email}')
@@ -1950,13 +1558,7 @@ def verify_email_change_form():
         return jsonify({'error': 'No autenticado'}), 401
 
     # Verificar que hay una solicitud pendiente
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT new_email, expires FROM email_change_requests 
-        WHERE user_id = %s AND expires > %s
-    ''', (user['id'], datetime.now()))
-    request_data = cursor.fetchone()
+    request_data = auth_service.solicitud_cambio_email_pendiente(get_db(), user['id'])
 
     if not request_data:
         return '''
@@ -2016,59 +1618,41 @@ def confirm_email_change():
             </div>
             '''
 
-        # Verificar código
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT new_email, verification_code, expires FROM email_change_requests 
-            WHERE user_id = %s
-        ''', (user['id'],))
-        request_data = cursor.fetchone()
-
-        if not request_data:
-            return '''
+        # Consumir la solicitud y cambiar el email en una sola sentencia
+        old_email = user['email']
+        new_email = auth_service.confirmar_cambio_email(get_db(), user['id'], verification_code)
+
+        if new_email is None:
+            # Solo en el camino de error: averiguar el motivo para el mensaje
+            motivo = auth_service.motivo_rechazo_cambio_email(get_db(), user['id'], verification_code)
+            if motivo == auth_service.CODIGO_INCORRECTO:
+                return '''
             <div class="alert alert-danger">
-                <strong>Error:</strong> No se encontró solicitud de cambio de email.
+                <strong>Error:</strong> Código de verificación incorrecto.
             </div>
             '''
-
-        # Verificar que el código coincida
-        if request_data[1] != verification_code:
-            return '''
+            if motivo == auth_service.CODIGO_CADUCADO:
+                return '''
             <div class="alert alert-danger">
-                <strong>Error:</strong> Código de verificación incorrecto.
+                <strong>Error:</strong> El código ha expirado. Solicita uno nuevo.
+            </div>
+            '''
+            if motivo == auth_service.EMAIL_EN_USO:
+                return '''
+            <div class="alert alert-danger">
+                <strong>Error:</strong> Este email ya está en uso por otra cuenta.
             </div>
             '''
-
-        # Verificar que no haya expirado
-        expires = request_data[2]
-        if datetime.now() > expires:
             return '''
             <div class="alert alert-danger">
-                <strong>Error:</strong> El código ha expirado. Solicita uno nuevo.
+                <strong>Error:</strong> No se encontró solicitud de cambio de email.
             </div>
             '''
 
-        # Código válido - actualizar email
-        old_email = user['email']
-        new_email = request_data[0]
-
-        cursor.execute('''
-            UPDATE users 
-            SET email = %s, updated_at = %s
-            WHERE id = %s
-        ''', (new_email, datetime.now(), user['id']))
-
-        # Limpiar solicitud de cambio
-        cursor.execute(
-            'DELETE FROM email_change_requests WHERE user_id = %s', (user['id'],))
-
-        conn.commit()
+        invalidate_current_user(user['id'])
 
         log_user_action(user['id'], 'EMAIL_CHANGED_SUCCESS',
                         f'From: {old_email} To: {new_email}')
-        log_database_operation(
-            'UPDATE', 'users', f'Email changed for user {user["id"]}')
 
         return f'''
         <div class="alert alert-success">
@@ -2137,48 +1721,19 @@ def process_delete_account():
         user_name = user['name']
 
         # 1. PRIMERO: Limpiar sesión actual inmediatamente
+        invalidate_current_user(user_id)
         session.clear()
 
         # 2. Log de cierre de sesión
         log_session_event(user_id, 'TERMINATED', 'Account deletion')
 
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # 3. Eliminar datos relacionados
-        try:
-            # Eliminar verificaciones de email pendientes
-            cursor.execute(
-                'DELETE FROM email_verification WHERE email = %s', (user_email,))
-        except:
-            pass  # Tabla no existe, continuar
-
-        try:
-            # Limpiar token de acceso del usuario
-            cursor.execute('''
-                UPDATE users 
-                SET access_token = NULL, token_expires = NULL 
-                WHERE id = %s
-            ''', (user_id,))
-        except:
-            pass  # Error en update, continuar
-
-        try:
-            # Eliminar sesiones si la tabla existe
-            cursor.execute('DELETE FROM sessions WHERE user_id = %s', (user_id,))
-        except:
-            pass  # Tabla no existe, continuar
-
-        # 4. FINALMENTE: Eliminar el usuario
-        cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
-
-        conn.commit()
+        # 3 y 4. Eliminar datos relacionados y, finalmente, el usuario
+        repository.delete_user(get_db(), user_id, user_email)
+        generation_cache.invalidate(user_id)
 
         # Logging de eliminación exitosa
         log_user_action(user_id, 'ACCOUNT_DELETED_SUCCESS',
                         f'User: {user_name} ({user_email})')
-        log_database_operation(
-            'DELETE', 'users', f'Account deleted: ID {user_id}')
 
         return '''
         <div class="alert alert-success border-0 shadow-sm">
@@ -2232,21 +1787,16 @@ def logout():
         user_id = session.get('user_id')
         log_user_action(user_id, 'LOGOUT_ATTEMPT', f'Method: {request.method}')
 
-        # Limpiar token en base de datos
+        # Cerrar la sesión de este dispositivo (los tokens firmados se revocan todos)
         if user_id:
-            conn = get_db()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET access_token = NULL, token_expires = NULL 
-                WHERE id = %s
-            ''', (user_id,))
-            conn.commit()
-
-            log_database_operation(
-                'UPDATE', 'users', f'Cleared session for user {user_id}')
+            access_token = session.get('access_token')
+            if session_tokens.is_signed_token(access_token):
+                revoke_access_tokens(user_id)
+            elif access_token:
+                repository.clear_session_token(get_db(), user_id, access_token)
 
         # Limpiar sesión
+        invalidate_current_user(user_id)
         session.clear()
         log_user_action(user_id, 'LOGOUT_SUCCESS', 'Session cleared')
 
@@ -2275,21 +1825,16 @@ def api_logout():
         user_id = session.get('user_id')
         log_user_action(user_id, 'LOGOUT_ATTEMPT', 'HTMX logout')
 
-        # Limpiar token en base de datos
+        # Cerrar la sesión de este dispositivo (los tokens firmados se revocan todos)
         if user_id:
-            conn = get_db()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE users 
-                SET access_token = NULL, token_expires = NULL 
-                WHERE id = %s
-            ''', (user_id,))
-            conn.commit()
-
-            log_database_operation(
-                'UPDATE', 'users', f'Cleared session for user {user_id}')
+            access_token = session.get('access_token')
+            if session_tokens.is_signed_token(access_token):
+                revoke_access_tokens(user_id)
+            elif access_token:
+                repository.clear_session_token(get_db(), user_id, access_token)
 
         # Limpiar sesión
+        invalidate_current_user(user_id)
         session.clear()
         log_user_action(user_id, 'LOGOUT_SUCCESS', 'HTMX session cleared')
 
@@ -2318,36 +1863,16 @@ def api_logout():
 @app.route('/api/session-status')
 def session_status():
     """Endpoint para verificar estado de sesión"""
-    user = get_current_user()
-    if not user:
+    authenticated, expires = get_session_expiry()
+    if not authenticated:
         return '<span id="session-time-remaining" class="text-danger">No autenticado</span>'
 
     # Calcular tiempo restante de sesión
-    if user['token_expires']:
-        expires = datetime.fromisoformat(user['token_expires'])
-        time_left = expires - datetime.now()
-        total_minutes = int(time_left.total_seconds() / 60)
-
-        if total_minutes <= 0:
-            session_time_info = {
-                'minutes_remaining': 0,
-                'hours_remaining': 0,
-                'mins_remaining': 0,
-                'is_expiring_soon': True
-            }
-        else:
-            hours = total_minutes // 60
-            minutes = total_minutes % 60
-
-            session_time_info = {
-                'minutes_remaining': total_minutes,
-                'hours_remaining': hours,
-                'mins_remaining': minutes,
-                'is_expiring_soon': total_minutes < 30
-            }
+    if expires:
+        session_time_info = session_events.session_time_info(expires)
 
         session_info = {
-            'expires_at': user['token_expires'][:19] if user['token_expires'] else 'No definido',
+            'expires_at': expires.strftime('%Y-%m-%d %H:%M:%S'),
             **session_time_info
         }
 
@@ -2358,18 +1883,12 @@ def session_status():
 @app.route('/api/session-warning')
 def session_warning():
     """Endpoint para avisos de sesión próxima a expirar"""
-    user = get_current_user()
-    if not user:
+    authenticated, expires = get_session_expiry()
+    if not authenticated:
         return '', 204
 
     # Verificar si la sesión está próxima a expirar (10 minutos antes de expirar)
-    if user['token_expires']:
-        # PostgreSQL returns datetime objects directly, unlike SQLite which returns strings
-        if isinstance(user['token_expires'], str):
-            expires = datetime.fromisoformat(user['token_expires'])
-        else:
-            expires = user['token_expires']
-            
+    if expires:
         time_left = expires - datetime.now()
         total_minutes = int(time_left.total_seconds() / 60)
 
@@ -2379,6 +1898,38 @@ def session_warning():
 
     return '', 204
 
+@app.route('/api/events')
+def session_events_stream():
+    """Canal SSE con el estado de la sesión (sustituye al sondeo de session-status/session-warning)"""
+    authenticated, expires = get_session_expiry()
+    if not authenticated or not expires:
+        return '', 204
+
+    # Cada canal ocupa un hilo del worker: sin canales libres, 204 y el navegador sigue sondeando
+    if not session_events.reservar_stream():
+        return '', 204
+
+    try:
+        # La caducidad ya está calculada: la conexión a la base de datos vuelve al pool
+        # antes de empezar a emitir (el generador solo renderiza plantillas)
+        close_db()
+        expires_at = expires.strftime('%Y-%m-%d %H:%M:%S')
+
+        eventos = session_events.stream(
+            expires,
+            lambda info: render_template('session_status.html', session_info={'expires_at': expires_at, **info}),
+            lambda time_remaining: render_template('session_warning_modal.html', time_remaining=time_remaining))
+        response = Response(stream_with_context(eventos), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # sin buffer en nginx/proxies
+        })
+    except Exception:
+        session_events.liberar_stream()
+        raise
+    # El servidor cierra la respuesta siempre (también si el cliente se desconecta)
+    response.call_on_close(session_events.liberar_stream)
+    return response
+
 @app.route('/api/extend-session', methods=['POST'])
 @limiter.limit("5 per minute")
 @require_auth
@@ -2390,19 +1941,16 @@ def extend_session():
         # Extender la sesión por 8 horas más
         new_expires = datetime.now() + timedelta(hours=8)
 
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users 
-            SET token_expires = %s, updated_at = %s
-            WHERE id = %s
-        ''', (new_expires, datetime.now(), user['id']))
-        conn.commit()
+        if session_tokens.is_signed_token(session.get('access_token')):
+            # La caducidad va firmada dentro del token: se emite uno nuevo
+            session['access_token'] = new_access_token(user['id'], new_expires)
+        else:
+            # Solo la sesión de este dispositivo
+            repository.extend_session_token(get_db(), user['id'], session['access_token'], new_expires)
+        invalidate_current_user(user['id'])
 
         log_user_action(user['id'], 'EXTEND_SESSION',
                         f'Session extended until {new_expires}')
-        log_database_operation(
-            'UPDATE', 'users', f'Session extended for user {user["id"]}')
 
         return jsonify({
             'success': True,
@@ -2489,14 +2037,9 @@ def auth_register():
                 'message': 'El formato del email no es válido'
             }), 400
 
-        # Verificar que el email no exista
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id FROM users WHERE email = %s', (email,))
-        existing_user = cursor.fetchone()
-
-        if existing_user:
+        # Guardar el código solo si el email no tiene cuenta (una sentencia)
+        verification_code = auth_service.generar_codigo()
+        if not auth_service.emitir_codigo_registro(get_db(), email, name, verification_code):
             return jsonify({
                 'error': True,
                 'code': 'EMAIL_ALREADY_EXISTS',
@@ -2504,22 +2047,7 @@ def auth_register():
                 'suggestion': 'login'
             }), 409
 
-        # Generar código de verificación
-        verification_code = str(
-            secrets.randbelow(900000) + 100000)  # 6 dígitos
-        code_expires = datetime.now() + timedelta(minutes=10)
-
-        # Guardar código temporal
-        cursor.execute('''
-            INSERT INTO email_verification (email, name, code, expires)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (email) 
-            DO UPDATE SET name = %s, code = %s, expires = %s, created_at = CURRENT_TIMESTAMP
-        ''', (email, name, verification_code, code_expires, name, verification_code, code_expires))
-        conn.commit()
-
         # Enviar email con código
-        from email_service import email_service
         if email_service.send_verification_code(email, name, verification_code):
             log_response('/api/auth/register', 200,
                          'Código enviado exitosamente')
@@ -2565,14 +2093,10 @@ def auth_login():
                 'message': 'Email es requerido'
             }), 400
 
-        # Verificar que el email existe
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, name FROM users WHERE email = %s', (email,))
-        existing_user = cursor.fetchone()
-
-        if not existing_user:
+        # Guardar el código solo si el email tiene cuenta (una sentencia)
+        verification_code = auth_service.generar_codigo()
+        user_name = auth_service.emitir_codigo_login(get_db(), email, verification_code)
+        if user_name is None:
             return jsonify({
                 'error': True,
                 'code': 'EMAIL_NOT_FOUND',
@@ -2580,23 +2104,8 @@ def auth_login():
                 'suggestion': 'register'
             }), 404
 
-        # Generar código de verificación
-        verification_code = str(secrets.randbelow(900000) + 100000)
-        code_expires = datetime.now() + timedelta(minutes=10)
-
-        # Guardar código temporal
-        cursor.execute('''
-            INSERT INTO email_verification (email, name, code, expires)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (email) 
-            DO UPDATE SET name = %s, code = %s, expires = %s, created_at = CURRENT_TIMESTAMP
-        ''', (email, existing_user[1], verification_code, code_expires, existing_user[1], verification_code, code_expires))
-        conn.commit()
-
         # Enviar email con código
-        from email_service import email_service
-        email_sent = email_service.send_verification_code(
-            email, existing_user[1], verification_code)
+        email_sent = email_service.send_verification_code(email, user_name, verification_code)
 
         if email_sent:
             return jsonify({
@@ -2604,7 +2113,7 @@ def auth_login():
                 'message': 'Código de verificación enviado a tu email',
                 'action': 'verify_email',
                 'email': email,
-                'name': existing_user[1]
+                'name': user_name
             })
         else:
             # MODO DESARROLLO - Mostrar código en logs para poder continuar
@@ -2612,7 +2121,7 @@ def auth_login():
                 app_logger.warning(
                     f"🧪 MODO DEBUG - Email falló, código para desarrollo:")
                 app_logger.warning(f"📧 Email: {email}")
-                app_logger.warning(f"👤 Nombre: {existing_user[1]}")
+                app_logger.warning(f"👤 Nombre: {user_name}")
                 app_logger.warning(f"🔢 CÓDIGO: {verification_code}")
 
                 return jsonify({
@@ -2620,7 +2129,7 @@ def auth_login():
                     'message': f'⚠️ MODO DEBUG: Email falló. Código: {verification_code}',
                     'action': 'verify_email',
                     'email': email,
-                    'name': existing_user[1],
+                    'name': user_name,
                     'debug_code': verification_code  # Solo en modo debug
                 })
             else:
@@ -2648,7 +2157,6 @@ def auth_verify_email():
         data = request.get_json() or {}
         email = data.get('email', '').strip()
         code = data.get('code', '').strip()
-        action = data.get('action', '').strip()  # 'login' o 'register'
 
         if not email or not code:
             return jsonify({
@@ -2657,97 +2165,43 @@ def auth_verify_email():
                 'message': 'Email y código son requeridos'
             }), 400
 
-        # Verificar código de email
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, code, expires FROM email_verification 
-            WHERE email = %s
-        ''', (email,))
-        verification = cursor.fetchone()
-
-        if not verification:
+        # Consumir el código y abrir la sesión en una sola sentencia; si es un
+        # registro (según el código emitido) se crea el usuario en la misma
+        user = open_session_with_code(email, code)
+        if not user:
+            # Solo en el camino de error: averiguar el motivo para el mensaje
+            motivo = auth_service.motivo_rechazo(get_db(), email, code)
+            if motivo == auth_service.CODIGO_INCORRECTO:
+                return jsonify({
+                    'error': True,
+                    'code': 'INVALID_CODE',
+                    'message': 'Código de verificación incorrecto'
+                }), 400
+            if motivo == auth_service.CODIGO_CADUCADO:
+                return jsonify({
+                    'error': True,
+                    'code': 'CODE_EXPIRED',
+                    'message': 'El código ha expirado'
+                }), 400
             return jsonify({
                 'error': True,
                 'code': 'VERIFICATION_NOT_FOUND',
                 'message': 'No se encontró verificación para este email'
             }), 404
 
-        # Verificar que el código coincida
-        if verification[1] != code:
-            return jsonify({
-                'error': True,
-                'code': 'INVALID_CODE',
-                'message': 'Código de verificación incorrecto'
-            }), 400
-
-        # Verificar que no haya expirado
-        expires = verification[2]
-        if datetime.now() > expires:
-            return jsonify({
-                'error': True,
-                'code': 'CODE_EXPIRED',
-                'message': 'El código ha expirado'
-            }), 400
+        log_user_action(user['id'], 'REGISTER_SUCCESS' if user['created'] else 'LOGIN_SUCCESS',
+                        f'Email: {email}')
 
-        # Limpiar verificación usada
-        cursor.execute(
-            'DELETE FROM email_verification WHERE email = %s', (email,))
-        conn.commit()
-
-        # Si es registro, crear usuario
-        if action == 'register':
-            name = verification[0]
-            user_id = create_user_email(name, email)
-            if not user_id:
-                return jsonify({
-                    'error': True,
-                    'code': 'USER_CREATION_ERROR',
-                    'message': 'Error creando usuario'
-                }), 500
-        else:
-            # Si es login, obtener usuario existente
-            cursor.execute(
-                'SELECT id FROM users WHERE email = %s', (email,))
-            user = cursor.fetchone()
-
-            if not user:
-                return jsonify({
-                    'error': True,
-                    'code': 'USER_NOT_FOUND',
-                    'message': 'Usuario no encontrado'
-                }), 404
-
-            user_id = user[0]
-
-        # Crear sesión
-        access_token = create_user_session_email(user_id)
-        if not access_token:
-            return jsonify({
-                'error': True,
-                'code': 'SESSION_ERROR',
-                'message': 'Error creando sesión'
-            }), 500
-
-        # Configurar sesión Flask
-        session.permanent = True
-        session['user_id'] = user_id
-        session['access_token'] = access_token
-
-        # Obtener datos del usuario para respuesta
-        user = get_current_user()
-        log_user_action(user_id, 'LOGIN_SUCCESS', f'Email: {email}')
-
-        return jsonify({
-            'success': True,
-            'message': 'Autenticación exitosa',
-            'user': {
-                'id': user['id'],
-                'name': get_user_display_name(user),
-                'email': user['email'] if user['email'] else email
-            },
-            'token': access_token
-        })
+        return jsonify({
+            'success': True,
+            'message': 'Autenticación exitosa',
+            'user': {
+                'id': user['id'],
+                'name': get_user_display_name(user),
+                'email': email
+            },
+            'token': user['access_token']
+        })
 
     except Exception as e:
         import traceback
@@ -2762,15 +2216,20 @@ def auth_verify_email():
 @require_debug
 def test_smtp():
     """Probar configuración SMTP"""
-    from email_service import email_service
 
     # Probar envío de email de prueba
     test_email = "ecabrerablazquez@gmail.com"  # Tu email
-    test_result = email_service.send_verification_code(
-        test_email,
-        "Usuario de Prueba",
-        "123456"
-    )
+    # Envío directo (sin cola) para ver el resultado en la respuesta
+    try:
+        email_service.deliver(email_service.build_verification_message(
+            test_email,
+            "Usuario de Prueba",
+            "123456"
+        ))
+        test_result = True
+    except Exception as e:
+        log_error('test_smtp', e)
+        test_result = False
 
     if test_result:
         return f"""
@@ -2800,45 +2259,33 @@ def borrar_fotos():
             return jsonify({'success': False, 'message': 'No se proporcionaron IDs de fotos'}), 400
 
         conn = get_db()
-        cursor = conn.cursor()
-        deleted_count = 0
-
-        # Verificar que las fotos pertenecen al usuario actual y borrarlas
-        for foto_id in foto_ids:
-            # Verificar propiedad y obtener info de la foto
-            cursor.execute('''
-                SELECT nombre_archivo FROM photos 
-                WHERE id = %s AND user_id = %s
-            ''', (foto_id, user['id']))
-            foto = cursor.fetchone()
-
-            if foto:
-                # Extraer public_id de la URL de Cloudinary y borrar
-                cloudinary_url = foto[0]
-                try:
-                    # URL típica: https://res.cloudinary.com/dquxfl0fe/image/upload/v1234567890/familia/photo_20250813_abc123.jpg
-                    # Extraer: familia/photo_20250813_abc123
-                    parts = cloudinary_url.split('/')
-                    if 'familia' in parts:
-                        familia_index = parts.index('familia')
-                        public_id_with_extension = '/'.join(
-                            parts[familia_index:])
-                        # Quitar extensión (.jpg, .png, etc.)
-                        public_id = public_id_with_extension.rsplit('.', 1)[0]
-
-                        # Borrar de Cloudinary
-                        result = cloudinary.uploader.destroy(public_id)
-                        print(
-                            f"✅ Cloudinary delete result for {public_id}: {result}")
 
-                except Exception as e:
-                    print(f"❌ Error borrando de Cloudinary: {e}")
-                    # Continuar aunque falle Cloudinary
+        # Solo las fotos que pertenecen al usuario actual
+        fotos = repository.archivos_fotos_usuario(conn, foto_ids, user['id'])
+        for foto_id, cloudinary_url in fotos:
+            # Extraer public_id de la URL de Cloudinary y borrar
+            try:
+                # URL típica: https://res.cloudinary.com/dquxfl0fe/image/upload/v1234567890/familia/photo_20250813_abc123.jpg
+                # Extraer: familia/photo_20250813_abc123
+                parts = cloudinary_url.split('/')
+                if 'familia' in parts:
+                    familia_index = parts.index('familia')
+                    public_id_with_extension = '/'.join(
+                        parts[familia_index:])
+                    # Quitar extensión (.jpg, .png, etc.)
+                    public_id = public_id_with_extension.rsplit('.', 1)[0]
+
+                    # Borrar de Cloudinary
+                    result = cloudinary.uploader.destroy(public_id)
+                    print(
+                        f"✅ Cloudinary delete result for {public_id}: {result}")
+
+            except Exception as e:
+                print(f"❌ Error borrando de Cloudinary: {e}")
+                # Continuar aunque falle Cloudinary
 
-                # Borrar de base de datos
-                cursor.execute(
-                    'DELETE FROM photos WHERE id = %s AND user_id = %s', (foto_id, user['id']))
-                deleted_count += 1
+        # Borrar de base de datos en una sola sentencia
+        deleted_count = repository.borrar_fotos(conn, [foto_id for foto_id, _ in fotos], user['id'])
 
         conn.commit()
 
@@ -2862,50 +2309,15 @@ def ver_mis_fotos():
     """Mostrar solo las fotos del usuario actual ordenadas por año y mes"""
     try:
         user = get_current_user()
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Obtener solo las fotos del usuario actual ordenadas por año DESC, mes DESC
-        cursor.execute('''
-            SELECT p.*, u.name as usuario_nombre
-            FROM photos p
-            JOIN users u ON p.user_id = u.id
-            WHERE p.user_id = %s
-            ORDER BY p.año DESC, p.mes DESC, p.created_at DESC
-        ''', (user['id'],))
-        fotos = cursor.fetchall()
-
-        # Convertir a lista de diccionarios para facilitar el manejo en el template
-        fotos_list = []
-        columns = [desc[0] for desc in cursor.description]
-        for foto in fotos:
-            foto_dict = dict(zip(columns, foto))
-            # Determinar si necesita etiquetado
-            personas_ids = foto_dict['personas_ids']
-            necesita_etiquetado = (
-                not personas_ids or
-                personas_ids == 'null' or
-                personas_ids == '' or
-                personas_ids == '[]' or
-                personas_ids == 'None'
-            )
-
-            fotos_list.append({
-                'id': foto_dict['id'],
-                'nombre': foto_dict['nombre'],
-                'nombre_archivo': foto_dict['nombre_archivo'],  # URL de Cloudinary
-                'mes': foto_dict['mes'],
-                'año': foto_dict['año'],
-                'usuario_nombre': foto_dict['usuario_nombre'],
-                'created_at': foto_dict['created_at'],
-                'personas_ids': foto_dict['personas_ids'],
-                'necesita_etiquetado': necesita_etiquetado
-            })
+
+        # Fotos del usuario actual, por páginas (año DESC, mes DESC)
+        respuesta = render_galeria('galeria_mis_fotos.html', 'galeria_mis_fotos_pagina.html', user,
+                                   ['p.user_id = %s'], (user['id'],))
 
         log_user_action(user['id'], 'VIEW_MY_PHOTOS',
-                        f'Viewed {len(fotos_list)} own photos')
+                        f'Viewed own photos page (cursor: {request.args.get("cursor", "-")})')
 
-        return render_template('galeria_mis_fotos.html', fotos=fotos_list, user=user)
+        return respuesta
 
     except Exception as e:
         log_error('ver_mis_fotos', e,
@@ -2919,34 +2331,9 @@ def gestionar_personas():
     user = None
     try:
         user = get_current_user()
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Obtener todas las personas
-        cursor.execute('''
-            SELECT id, nombre, imagen, created_at
-            FROM personas
-            ORDER BY nombre ASC
-        ''')
-        personas = cursor.fetchall()
-
-        # Convertir a lista de diccionarios
-        personas_list = []
-        columns = [desc[0] for desc in cursor.description]
-        for persona in personas:
-            persona_dict = dict(zip(columns, persona))
-            # Convertir datetime a string para compatibilidad con la plantilla
-            created_at = persona_dict['created_at']
-            if hasattr(created_at, 'strftime'):
-                # Es un objeto datetime (PostgreSQL), convertir a string
-                persona_dict['created_at'] = created_at.strftime('%Y-%m-%d %H:%M:%S')
-            
-            personas_list.append({
-                'id': persona_dict['id'],
-                'nombre': persona_dict['nombre'],
-                'imagen': persona_dict['imagen'],
-                'created_at': persona_dict['created_at']
-            })
+
+        # Obtener todas las personas (created_at ya viene como texto para la plantilla)
+        personas_list = repository.listar_personas(get_read_db())
 
         if user:
             log_user_action(user['id'], 'VIEW_PERSONS',
@@ -2965,51 +2352,14 @@ def ver_todas_fotos():
     """Mostrar todas las fotos ordenadas por año y mes"""
     try:
         user = get_current_user()
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Obtener todas las fotos ordenadas por año DESC, mes DESC (más recientes primero)
-        cursor.execute('''
-            SELECT p.*, u.name as usuario_nombre
-            FROM photos p
-            JOIN users u ON p.user_id = u.id
-            ORDER BY p.año DESC, p.mes DESC, p.created_at DESC
-        ''')
-        fotos = cursor.fetchall()
-
-        # Convertir a lista de diccionarios para facilitar el manejo en el template
-        fotos_list = []
-        columns = [desc[0] for desc in cursor.description]
-        for foto in fotos:
-            foto_dict = dict(zip(columns, foto))
-            # Determinar si necesita etiquetado
-            personas_ids = foto_dict['personas_ids']
-            necesita_etiquetado = (
-                not personas_ids or
-                personas_ids == 'null' or
-                personas_ids == '' or
-                personas_ids == '[]' or
-                personas_ids == 'None'
-            )
-
-            fotos_list.append({
-                'id': foto_dict['id'],
-                'nombre': foto_dict['nombre'],
-                'nombre_archivo': foto_dict['nombre_archivo'],  # URL de Cloudinary
-                'mes': foto_dict['mes'],
-                'año': foto_dict['año'],
-                'usuario_nombre': foto_dict['usuario_nombre'],
-                'created_at': foto_dict['created_at'],
-                'personas_ids': foto_dict['personas_ids'],
-                'necesita_etiquetado': necesita_etiquetado
-            })
+
+        # Todas las fotos, por páginas (año DESC, mes DESC, más recientes primero)
+        respuesta = render_galeria('galeria_todas_fotos.html', 'galeria_todas_fotos_pagina.html', user)
 
         log_user_action(user['id'], 'VIEW_ALL_PHOTOS',
-                        f'Viewed {len(fotos_list)} photos')
+                        f'Viewed photos page (cursor: {request.args.get("cursor", "-")})')
 
-        return render_template('galeria_todas_fotos.html',
-                               fotos=fotos_list,
-                               user=user)
+        return respuesta
 
     except Exception as e:
         log_error('ver_todas_fotos', e,
@@ -3021,21 +2371,7 @@ def ver_todas_fotos():
 def get_personas():
     """Obtener lista de personas para filtros"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, nombre
-            FROM personas
-            ORDER BY nombre ASC
-        ''')
-        personas = cursor.fetchall()
-
-        personas_list = []
-        for persona in personas:
-            personas_list.append({
-                'id': persona[0],
-                'nombre': persona[1]
-            })
+        personas_list = [persona._asdict() for persona in repository.listar_nombres_personas(get_read_db())]
 
         return jsonify({
             'success': True,
@@ -3097,33 +2433,20 @@ def add_person():
             return jsonify({'success': False, 'message': 'El nombre es requerido'}), 400
 
         conn = get_db()
-        cursor = conn.cursor()
         user = get_current_user()
 
         # Si hay ID, es una edición
         if person_id:
             # Verificar que la persona existe
-            cursor.execute(
-                'SELECT id, nombre FROM personas WHERE id = %s', (person_id,))
-            existing = cursor.fetchone()
-            if not existing:
+            if not repository.get_persona(conn, person_id):
                 return jsonify({'success': False, 'message': 'Persona no encontrada'}), 404
 
             # Verificar que no existe otra persona con el mismo nombre
-            cursor.execute(
-                'SELECT id FROM personas WHERE nombre = %s AND id != %s', (nombre, person_id))
-            name_conflict = cursor.fetchone()
-            if name_conflict:
+            if repository.get_persona_por_nombre(conn, nombre, excluir_id=person_id):
                 return jsonify({'success': False, 'message': 'Ya existe otra persona con ese nombre'}), 400
 
             # Actualizar persona existente
-            cursor.execute('''
-                UPDATE personas 
-                SET nombre = %s, imagen = %s, updated_at = %s
-                WHERE id = %s
-            ''', (nombre, imagen_url, datetime.now(), person_id))
-
-            conn.commit()
+            repository.actualizar_persona(conn, person_id, nombre, imagen_url)
 
             log_user_action(user['id'], 'EDIT_PERSON',
                             f'Edited person: {nombre}')
@@ -3137,21 +2460,11 @@ def add_person():
         else:
             # Es una nueva persona
             # Verificar que no existe una persona con el mismo nombre
-            cursor.execute(
-                'SELECT id FROM personas WHERE nombre = %s', (nombre,))
-            existing = cursor.fetchone()
-            if existing:
+            if repository.get_persona_por_nombre(conn, nombre):
                 return jsonify({'success': False, 'message': 'Ya existe una persona con ese nombre'}), 400
 
             # Insertar nueva persona
-            cursor.execute('''
-                INSERT INTO personas (nombre, imagen, created_at, updated_at)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-            ''', (nombre, imagen_url, datetime.now(), datetime.now()))
-
-            person_id = cursor.fetchone()[0]
-            conn.commit()
+            person_id = repository.crear_persona(conn, nombre, imagen_url)
 
             log_user_action(user['id'], 'ADD_PERSON',
                             f'Added person: {nombre}')
@@ -3172,17 +2485,11 @@ def add_person():
 def get_all_persons():
     """Obtener todas las personas para el buscador"""
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, nombre FROM personas 
-            ORDER BY nombre
-        ''')
-        personas = cursor.fetchall()
+        personas = repository.listar_nombres_personas(get_read_db())
 
         return jsonify({
             'success': True,
-            'persons': [{'id': p[0], 'nombre': p[1]} for p in personas]
+            'persons': [persona._asdict() for persona in personas]
         })
 
     except Exception as e:
@@ -3191,199 +2498,41 @@ def get_all_persons():
 @app.route('/api/buscar-fotos-persona')
 @require_auth
 def buscar_fotos_persona():
-    """Buscar fotos por nombre de persona"""
+    """Buscar fotos por nombre de foto o de persona etiquetada"""
     try:
         user = get_current_user()
         buscar_persona = request.args.get('buscar_persona', '').strip()
 
-        conn = get_db()
-        cursor = conn.cursor()
-
         if not buscar_persona:
             # Mostrar todas las fotos
-            cursor.execute('''
-                SELECT p.id, p.nombre, p.nombre_archivo, p.mes, p.año, p.created_at, p.personas_ids,
-                       u.name as usuario_nombre
-                FROM photos p
-                JOIN users u ON p.user_id = u.id
-                ORDER BY p.created_at DESC
-            ''')
-            fotos = cursor.fetchall()
-        else:
-            # Buscar en todas las fotos
-            cursor.execute('''
-                SELECT p.id, p.nombre, p.nombre_archivo, p.mes, p.año, p.created_at, p.personas_ids,
-                       u.name as usuario_nombre
-                FROM photos p
-                JOIN users u ON p.user_id = u.id
-                ORDER BY p.created_at DESC
-            ''')
-            fotos = cursor.fetchall()
-
-            # Filtrar por nombre de foto O por persona
-            fotos_filtradas = []
-            columns = [desc[0] for desc in cursor.description]
-            for foto in fotos:
-                foto_dict = dict(zip(columns, foto))
-                # Buscar en el nombre de la foto
-                if buscar_persona.lower() in foto_dict['nombre'].lower():
-                    fotos_filtradas.append(foto_dict)
-                    continue
-
-                # Buscar en las personas de la foto
-                try:
-                    import json
-                    personas_ids = json.loads(
-                        foto_dict['personas_ids']) if foto_dict['personas_ids'] else []
-                    if personas_ids:
-                        placeholders = ','.join(['%s' for _ in personas_ids])
-                        cursor.execute(f'''
-                            SELECT nombre FROM personas 
-                            WHERE id IN ({placeholders})
-                        ''', personas_ids)
-                        personas = cursor.fetchall()
-
-                        for persona in personas:
-                            if buscar_persona.lower() in persona[0].lower():
-                                fotos_filtradas.append(foto_dict)
-                                break
-                except:
-                    continue
-
-            fotos = fotos_filtradas
+            return render_galeria('galeria_todas_fotos.html', 'galeria_todas_fotos_pagina.html', user)
 
-        # Agregar información de si necesita etiquetado
-        fotos_con_info = []
-        for foto in fotos:
-            if isinstance(foto, dict):
-                foto_dict = foto
-            else:
-                columns = [desc[0] for desc in cursor.description]
-                foto_dict = dict(zip(columns, foto))
-            
-            # Determinar si necesita etiquetado
-            personas_ids = foto_dict['personas_ids']
-            necesita_etiquetado = (
-                not personas_ids or
-                personas_ids == 'null' or
-                personas_ids == '' or
-                personas_ids == '[]' or
-                personas_ids == 'None'
-            )
-            foto_dict['necesita_etiquetado'] = necesita_etiquetado
-            fotos_con_info.append(foto_dict)
-
-        # Renderizar template completo de galería con fotos filtradas
-        return render_template('galeria_todas_fotos.html', fotos=fotos_con_info, user=user)
+        # Filtrar por nombre de foto O por persona, ordenado por relevancia
+        return render_galeria('galeria_todas_fotos.html', 'galeria_todas_fotos_pagina.html', user,
+                              busqueda=buscar_persona)
 
     except Exception as e:
         return f"<div class='alert alert-danger'>Error: {str(e)}</div>"
 
 @app.route('/api/buscar-mis-fotos-persona')
 def buscar_mis_fotos_persona():
-    """Buscar mis fotos por nombre de persona"""
+    """Buscar mis fotos por nombre de foto o de persona etiquetada"""
     try:
         user = get_current_user()
         buscar_persona = request.args.get('buscar_persona', '').strip()
 
-        conn = get_db()
-        cursor = conn.cursor()
-
         if not buscar_persona:
             # Si no hay búsqueda, mostrar todas mis fotos
-            cursor.execute('''
-                SELECT id, nombre, nombre_archivo, mes, año, created_at, personas_ids
-                FROM photos 
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            ''', (user['id'],))
-            fotos = cursor.fetchall()
-        else:
-            # Buscar en todas mis fotos
-            cursor.execute('''
-                SELECT id, nombre, nombre_archivo, mes, año, created_at, personas_ids
-                FROM photos 
-                WHERE user_id = %s
-                ORDER BY created_at DESC
-            ''', (user['id'],))
-            fotos = cursor.fetchall()
-
-            # Filtrar por nombre de foto O por persona
-            fotos_filtradas = []
-            columns = [desc[0] for desc in cursor.description]
-            for foto in fotos:
-                foto_dict = dict(zip(columns, foto))
-                # Buscar en el nombre de la foto
-                if buscar_persona.lower() in foto_dict['nombre'].lower():
-                    fotos_filtradas.append(foto_dict)
-                    continue
-
-                # Buscar en las personas de la foto
-                try:
-                    import json
-                    personas_ids = json.loads(
-                        foto_dict['personas_ids']) if foto_dict['personas_ids'] else []
-                    if personas_ids:
-                        placeholders = ','.join(['%s' for _ in personas_ids])
-                        cursor.execute(f'''
-                            SELECT nombre FROM personas 
-                            WHERE id IN ({placeholders})
-                        ''', personas_ids)
-                        personas = cursor.fetchall()
-
-                        for persona in personas:
-                            if buscar_persona.lower() in persona[0].lower():
-                                fotos_filtradas.append(foto_dict)
-                                break
-                except:
-                    continue
+            return render_galeria('galeria_mis_fotos.html', 'galeria_mis_fotos_pagina.html', user,
+                                  ['p.user_id = %s'], (user['id'],))
 
-            fotos = fotos_filtradas
-
-        # Agregar información de si necesita etiquetado
-        fotos_con_info = []
-        for foto in fotos:
-            if isinstance(foto, dict):
-                foto_dict = foto
-            else:
-                columns = [desc[0] for desc in cursor.description]
-                foto_dict = dict(zip(columns, foto))
-            
-            # Determinar si necesita etiquetado
-            personas_ids = foto_dict['personas_ids']
-            necesita_etiquetado = (
-                not personas_ids or
-                personas_ids == 'null' or
-                personas_ids == '' or
-                personas_ids == '[]' or
-                personas_ids == 'None'
-            )
-            foto_dict['necesita_etiquetado'] = necesita_etiquetado
-            fotos_con_info.append(foto_dict)
-
-        # Renderizar template completo de mis fotos con fotos filtradas
-        return render_template('galeria_mis_fotos.html', fotos=fotos_con_info, user=user)
+        # Filtrar mis fotos por nombre de foto O por persona, ordenado por relevancia
+        return render_galeria('galeria_mis_fotos.html', 'galeria_mis_fotos_pagina.html', user,
+                              ['p.user_id = %s'], (user['id'],), busqueda=buscar_persona)
 
     except Exception as e:
         return f"<div class='alert alert-danger'>Error buscando fotos: {str(e)}</div>"
 
-@app.route('/api/test-buscar-fotos')
-def test_buscar_fotos():
-    """Endpoint de prueba para búsqueda"""
-    buscar_persona = request.args.get('buscar_persona', '')
-
-    if not buscar_persona:
-        return "<div class='alert alert-info'>Escribe algo para buscar</div>"
-
-    return f"""
-    <div class="col-12">
-        <div class="alert alert-success">
-            <h5>Buscando: {buscar_persona}</h5>
-            <p>Endpoint funcionando correctamente</p>
-        </div>
-    </div>
-    """
-
 @app.route('/api/delete-person', methods=['POST'])
 @require_auth
 def delete_person():
@@ -3396,20 +2545,17 @@ def delete_person():
             return jsonify({'success': False, 'message': 'ID de persona requerido'}), 400
 
         conn = get_db()
-        cursor = conn.cursor()
 
         # Obtener info de la persona antes de borrar
-        cursor.execute(
-            'SELECT nombre, imagen FROM personas WHERE id = %s', (person_id,))
-        persona = cursor.fetchone()
+        persona = repository.get_persona(conn, person_id)
         if not persona:
             return jsonify({'success': False, 'message': 'Persona no encontrada'}), 404
 
         # Eliminar de Cloudinary si tiene imagen
-        if persona[1]:
+        if persona.imagen:
             try:
                 # Extraer public_id y eliminar de Cloudinary
-                parts = persona[1].split('/')
+                parts = persona.imagen.split('/')
                 if 'familia' in parts:
                     familia_index = parts.index('familia')
                     public_id_with_extension = '/'.join(parts[familia_index:])
@@ -3420,16 +2566,15 @@ def delete_person():
                     f"❌ Error eliminando imagen de persona de Cloudinary: {e}")
 
         # Eliminar persona
-        cursor.execute('DELETE FROM personas WHERE id = %s', (person_id,))
-        conn.commit()
+        repository.borrar_persona(conn, person_id)
 
         user = get_current_user()
         log_user_action(user['id'], 'DELETE_PERSON',
-                        f'Deleted person: {persona[0]}')
+                        f'Deleted person: {persona.nombre}')
 
         return jsonify({
             'success': True,
-            'message': f'Persona "{persona[0]}" eliminada correctamente'
+            'message': f'Persona "{persona.nombre}" eliminada correctamente'
         })
 
     except Exception as e:
@@ -3452,11 +2597,9 @@ def procesando_reconocimiento():
 @require_auth
 def api_procesar_reconocimiento_facial():
     """API para procesar reconocimiento facial de fotos recientes"""
-    start_time = time.time()  # Medir tiempo de procesamiento
     try:
         user = get_current_user()
         conn = get_db()
-        cursor = conn.cursor()
 
         # Obtener IDs de fotos específicas desde la query string
         ids_param = request.args.get('ids', '')
@@ -3469,14 +2612,7 @@ def api_procesar_reconocimiento_facial():
             return render_template('etiquetar_caras_individuales.html', caras=[], user=user)
 
         # Obtener fotos con información de personas
-        placeholders = ','.join(['%s' for _ in foto_ids])
-        cursor.execute(f'''
-            SELECT id, nombre, nombre_archivo, mes, año, created_at, personas_ids
-            FROM photos 
-            WHERE id IN ({placeholders}) AND user_id = %s
-            ORDER BY created_at DESC
-        ''', foto_ids + [user['id']])
-        fotos_recientes = cursor.fetchall()
+        fotos_recientes = repository.fotos_para_reconocimiento(conn, foto_ids, user['id'])
 
         print(f"Fotos encontradas: {len(fotos_recientes)}")
 
@@ -3487,13 +2623,11 @@ def api_procesar_reconocimiento_facial():
         fotos_ya_procesadas = []
         fotos_sin_procesar = []
 
-        columns = [desc[0] for desc in cursor.description]
         for foto in fotos_recientes:
-            foto_dict = dict(zip(columns, foto))
-            if foto_dict['personas_ids'] and foto_dict['personas_ids'].strip() and foto_dict['personas_ids'] != 'null' and not force_reprocess:
+            foto_dict = foto._asdict()
+            if foto_dict['tiene_personas'] and not force_reprocess:
                 fotos_ya_procesadas.append(foto_dict)
-                print(
-                    f"Foto {foto_dict['id']} ya tiene personas: {foto_dict['personas_ids']}")
+                print(f"Foto {foto_dict['id']} ya tiene personas")
             else:
                 fotos_sin_procesar.append(foto_dict)
                 if force_reprocess:
@@ -3512,95 +2646,22 @@ def api_procesar_reconocimiento_facial():
                 f"Hay {len(fotos_ya_procesadas)} fotos ya procesadas y {len(fotos_sin_procesar)} sin procesar")
 
         # Procesar las fotos correspondientes
-        fotos_a_procesar = fotos_sin_procesar if not force_reprocess else [dict(zip(columns, foto)) for foto in fotos_recientes]
-
-        caras_individuales = []
-
-        # Procesar fotos en paralelo para mejor rendimiento
-        def procesar_foto_individual(foto):
-            """Procesa una foto individual y retorna las caras encontradas"""
-            caras_foto = []
-            print(f"Procesando foto: {foto['nombre']}")
-
-            try:
-                faces = detect_faces_facepp(foto['nombre_archivo'])
-
-                if faces:
-                    print(
-                        f"Face++ detectó {len(faces)} caras en {foto['nombre']}")
+        fotos_a_procesar = fotos_sin_procesar if not force_reprocess else [foto._asdict() for foto in fotos_recientes]
 
-                    # Procesar cada cara de esta foto
-                    for idx, cara in enumerate(faces):
-                        try:
-                            face_rectangle = cara['face_rectangle']
-                            buffer = get_face_crop(
-                                foto['nombre_archivo'], face_rectangle)
-
-                            if not buffer:
-                                print(
-                                    f"Error creando recorte para cara {idx + 1} de {foto['nombre']}")
-                                continue
-
-                            # Subir a Cloudinary
-                            upload_result = upload_temp_face_crop(buffer)
-
-                            if upload_result.get('secure_url'):
-                                caras_foto.append({
-                                    'foto_id': foto['id'],
-                                    'foto_nombre': foto['nombre'],
-                                    'cara_index': idx,
-                                    'face_token': cara['face_token'],
-                                    'recorte_url': upload_result['secure_url'],
-                                    'recorte_public_id': upload_result['public_id'],
-                                    'cara_id': f"{foto['id']}_{idx}"
-                                })
-                                print(
-                                    f"Cara {idx + 1} de {foto['nombre']} procesada exitosamente")
-
-                        except Exception as e:
-                            print(
-                                f"Error procesando cara {idx + 1} de {foto['nombre']}: {e}")
-                            continue
-                else:
-                    print(f"No se detectaron caras en {foto['nombre']}")
-
-            except Exception as e:
-                print(f"Error con Face++ para {foto['nombre']}: {e}")
-
-            return caras_foto
-
-        # Procesar fotos en paralelo (máximo 3 threads para no sobrecargar APIs)
-        max_workers = min(3, len(fotos_a_procesar))
-        print(
-            f"Procesando {len(fotos_a_procesar)} fotos con {max_workers} threads paralelos")
-
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Enviar todas las fotos para procesamiento paralelo
-            future_to_foto = {executor.submit(
-                procesar_foto_individual, foto): foto for foto in fotos_a_procesar}
-
-            # Recopilar resultados conforme van completándose
-            for future in as_completed(future_to_foto):
-                foto = future_to_foto[future]
-                try:
-                    caras_foto = future.result()
-                    caras_individuales.extend(caras_foto)
-                    print(
-                        f"Completado procesamiento de {foto['nombre']}: {len(caras_foto)} caras")
-                except Exception as e:
-                    print(f"Error procesando {foto['nombre']}: {e}")
+        if not fotos_a_procesar:
+            return render_template('etiquetar_caras_individuales.html', caras=[], user=user)
 
-        # Log de rendimiento
-        end_time = time.time()
-        processing_time = end_time - start_time
-        print(
-            f"RESULTADO FINAL: {len(caras_individuales)} caras procesadas en {processing_time:.2f} segundos")
-        log_user_action(user['id'], 'FACIAL_RECOGNITION_COMPLETED',
-                        f'Processed {len(fotos_a_procesar)} photos, {len(caras_individuales)} faces in {processing_time:.2f}s')
+        # Detección, recortes y subidas los hace un worker de la cola (recognition_jobs.py)
+        job_id = recognition_jobs.encolar(conn, user['id'], [foto['id'] for foto in fotos_a_procesar])
+        print(f"Trabajo de reconocimiento {job_id} encolado con {len(fotos_a_procesar)} fotos")
+        log_user_action(user['id'], 'FACIAL_RECOGNITION_QUEUED',
+                        f'Job {job_id} with {len(fotos_a_procesar)} photos')
 
-        return render_template('etiquetar_caras_individuales.html',
-                               caras=caras_individuales,
-                               user=user)
+        if not is_htmx_request():
+            return jsonify({'success': True, 'job_id': job_id,
+                            'status_url': url_for('api_estado_reconocimiento', job_id=job_id)}), 202
+        estado = recognition_jobs.estado_trabajo(conn, job_id, user['id'])
+        return render_template('progreso_reconocimiento.html', trabajo=estado)
 
     except Exception as e:
         print(f"Error general: {e}")
@@ -3608,40 +2669,58 @@ def api_procesar_reconocimiento_facial():
         traceback.print_exc()
         return render_template('error.html', message='Error procesando reconocimiento facial'), 500
 
+@app.route('/api/reconocimiento/<int:job_id>')
+@require_auth
+def api_estado_reconocimiento(job_id):
+    """Progreso de un trabajo de reconocimiento; al terminar, las caras para etiquetar"""
+    user = get_current_user()
+    conn = get_db()
+    estado = recognition_jobs.estado_trabajo(conn, job_id, user['id'])
+    if estado is None:
+        if is_htmx_request():
+            return render_template('error.html', message='Trabajo de reconocimiento no encontrado'), 404
+        return jsonify({'success': False, 'message': 'Trabajo no encontrado'}), 404
+
+    if not is_htmx_request():
+        return jsonify({
+            'success': True,
+            'job_id': estado.id,
+            'status': estado.status,
+            'error': estado.error,
+            'total': estado.total,
+            'terminadas': estado.terminadas,
+            'caras': estado.caras,
+            'fotos': estado.fotos,
+        })
+
+    if estado.status == recognition_jobs.TERMINADO:
+        caras = recognition_jobs.caras_trabajo(conn, job_id, user['id'])
+        # Solo un modelo que distingue personas rellena el nombre; si no, la sugerencia es un botón
+        return render_template('etiquetar_caras_individuales.html', caras=caras, user=user,
+                               rellenar_sugerencia=embedder.identifica)
+    if estado.status == recognition_jobs.FALLIDO:
+        return render_template('error.html', message='Error procesando reconocimiento facial'), 500
+    return render_template('progreso_reconocimiento.html', trabajo=estado)
+
 def mostrar_resumen_fotos_procesadas(fotos_procesadas, user, conn):
     """Mostrar resumen de fotos que ya tienen personas identificadas"""
     try:
-        import json
-        cursor = conn.cursor()
+        # Nombres de las personas de todas las fotos en una sola consulta
+        foto_ids = [foto['id'] for foto in fotos_procesadas]
+        personas_por_foto = repository.nombres_personas_por_foto(conn, foto_ids)
+        caras_por_foto = repository.caras_detectadas(conn, foto_ids)
 
         resumen_fotos = []
-
         for foto in fotos_procesadas:
-            # Parsear personas_ids
-            try:
-                personas_ids = json.loads(
-                    foto['personas_ids']) if foto['personas_ids'] else []
-            except:
-                personas_ids = []
-
-            # Obtener nombres de las personas
-            personas_nombres = []
-            if personas_ids:
-                placeholders = ','.join(['%s' for _ in personas_ids])
-                cursor.execute(f'''
-                    SELECT id, nombre FROM personas 
-                    WHERE id IN ({placeholders})
-                ''', personas_ids)
-                personas = cursor.fetchall()
-
-                personas_nombres = [p[1] for p in personas]
-
+            personas_nombres = personas_por_foto.get(foto['id'], [])
+            caras = caras_por_foto.get(foto['id'])
             resumen_fotos.append({
                 'foto_id': foto['id'],
                 'foto_nombre': foto['nombre'],
                 'foto_url': foto['nombre_archivo'],
                 'personas_count': len(personas_nombres),
-                'personas_nombres': personas_nombres
+                'personas_nombres': personas_nombres,
+                'caras_count': len(caras) if caras is not None else None
             })
 
         return render_template('resumen_fotos_procesadas.html',
@@ -3652,600 +2731,6 @@ def mostrar_resumen_fotos_procesadas(fotos_procesadas, user, conn):
         print(f"Error mostrando resumen: {e}")
         return render_template('error.html', message='Error mostrando resumen de fotos'), 500
 
-@app.route('/api/debug-info')
-def api_debug_info():
-    """Endpoint para debugging de información"""
-    try:
-        # Obtener foto ID 31
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, nombre, nombre_archivo FROM photos WHERE id = 31')
-        foto = cursor.fetchone()
-
-        if not foto:
-            return {"error": "Foto no encontrada"}, 404
-
-        # Información básica
-        info = {
-            "foto_id": foto[0],
-            "foto_nombre": foto[1],
-            "foto_url": foto[2],
-            "face_api_key": os.getenv('FACEPP_API_KEY')[:10] + "..." if os.getenv('FACEPP_API_KEY') else "No encontrada",
-            "cloudinary_configured": bool(os.getenv('CLOUDINARY_CLOUD_NAME'))
-        }
-
-        return info
-
-    except Exception as e:
-        return {"error": str(e)}, 500
-
-@app.route('/api/test-one-face')
-def api_test_one_face():
-    """Procesar solo UNA cara para debugging"""
-    try:
-        # Obtener foto ID 31
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, nombre, nombre_archivo FROM photos WHERE id = 31')
-        foto = cursor.fetchone()
-        cursor.execute('SELECT * FROM users WHERE id = 1')
-        user_row = cursor.fetchone()
-
-        if not foto or not user_row:
-            return {"error": "Foto o usuario no encontrado"}, 404
-
-        # Convertir usuario a dict
-        user_columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(user_columns, user_row))
-
-        # Descargar imagen
-        img_response = requests.get(foto[2])
-        if img_response.status_code != 200:
-            return {"error": "Error descargando imagen"}, 400
-
-        # Face++
-        api_key = os.getenv('FACEPP_API_KEY')
-        api_secret = os.getenv('FACEPP_API_SECRET')
-
-        from io import BytesIO
-        files = {'image_file': BytesIO(img_response.content)}
-        params = {
-            'api_key': api_key,
-            'api_secret': api_secret,
-            'return_attributes': 'age,gender'
-        }
-
-        response = requests.post('https://api-us.faceplusplus.com/facepp/v3/detect',
-                                 files=files, data=params, timeout=30)
-        face_result = response.json()
-
-        if 'faces' not in face_result or len(face_result['faces']) == 0:
-            return {"error": "No se detectaron caras"}, 400
-
-        # Procesar SOLO la primera cara
-        cara = face_result['faces'][0]
-        face_rectangle = cara['face_rectangle']
-
-        print(f"Procesando cara con rectángulo: {face_rectangle}")
-
-        # PIL processing
-        from PIL import Image
-        import uuid
-
-        image = Image.open(BytesIO(img_response.content))
-        print(f"Imagen PIL: {image.width}x{image.height}")
-
-        # Recortar
-        left = face_rectangle['left']
-        top = face_rectangle['top']
-        width = face_rectangle['width']
-        height = face_rectangle['height']
-
-        padding = int(min(width, height) * 0.1)
-        left = max(0, left - padding)
-        top = max(0, top - padding)
-        right = min(image.width, left + width + (padding * 2))
-        bottom = min(image.height, top + height + (padding * 2))
-
-        print(
-            f"Coordenadas de recorte: ({left}, {top}) -> ({right}, {bottom})")
-
-        face_crop = image.crop((left, top, right, bottom))
-        face_crop = face_crop.resize((200, 200), Image.Resampling.LANCZOS)
-
-        print(f"Recorte creado: {face_crop.width}x{face_crop.height}")
-
-        # Buffer
-        buffer = BytesIO()
-        face_crop.save(buffer, format='JPEG', quality=90)
-        buffer.seek(0)
-
-        print(f"Buffer creado: {len(buffer.getvalue())} bytes")
-
-        # Cloudinary
-        temp_filename = f"temp_face_{uuid.uuid4().hex[:8]}.jpg"
-        print(f"Subiendo a Cloudinary: {temp_filename}")
-
-        upload_result = cloudinary.uploader.upload(
-            buffer,
-            folder="temp_faces",
-            public_id=temp_filename,
-            resource_type="image",
-            format="jpg"
-        )
-
-        print(f"Resultado Cloudinary: {upload_result}")
-
-        if not upload_result.get('secure_url'):
-            return {"error": "Error subiendo a Cloudinary"}, 500
-
-        # Crear array con una sola cara
-        caras_individuales = [{
-            'foto_id': foto[0],
-            'foto_nombre': foto[1],
-            'cara_index': 0,
-            'face_token': cara['face_token'],
-            'recorte_url': upload_result['secure_url'],
-            'recorte_public_id': upload_result['public_id'],
-            'cara_id': f"{foto[0]}_0"
-        }]
-
-        print(f"Array de caras creado: {len(caras_individuales)} elementos")
-        print(f"Primera cara URL: {caras_individuales[0]['recorte_url']}")
-
-        # Renderizar template
-        return render_template('etiquetar_caras_individuales.html',
-                               caras=caras_individuales,
-                               user=user)
-
-    except Exception as e:
-        print(f"ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"error": str(e)}, 500
-
-@app.route('/api/test-face-json')
-def api_test_face_json():
-    """Endpoint que devuelve JSON para debugging"""
-    try:
-        # Obtener foto ID 31
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, nombre, nombre_archivo FROM photos WHERE id = 31')
-        foto = cursor.fetchone()
-
-        if not foto:
-            return {"error": "Foto no encontrada"}, 404
-
-        result = {
-            "foto_id": foto[0],
-            "foto_nombre": foto[1],
-            "foto_url": foto[2],
-            "paso": "inicio"
-        }
-
-        # Descargar imagen
-        img_response = requests.get(foto[2])
-        if img_response.status_code != 200:
-            result["error"] = f"Error descargando imagen: {img_response.status_code}"
-            return result, 400
-
-        result["imagen_descargada"] = f"{len(img_response.content)} bytes"
-        result["paso"] = "imagen_descargada"
-
-        # Probar Face++
-        api_key = os.getenv('FACEPP_API_KEY')
-        api_secret = os.getenv('FACEPP_API_SECRET')
-
-        from io import BytesIO
-        files = {'image_file': BytesIO(img_response.content)}
-        params = {
-            'api_key': api_key,
-            'api_secret': api_secret,
-            'return_attributes': 'age,gender'
-        }
-
-        response = requests.post('https://api-us.faceplusplus.com/facepp/v3/detect',
-                                 files=files, data=params, timeout=30)
-        face_result = response.json()
-
-        result["face_api_status"] = response.status_code
-        result["face_api_response"] = face_result
-        result["paso"] = "face_api_completado"
-
-        if 'faces' in face_result:
-            result["caras_detectadas"] = len(face_result['faces'])
-        else:
-            result["caras_detectadas"] = 0
-
-        return result
-
-    except Exception as e:
-        import traceback
-        return {
-            "error": str(e),
-            "traceback": traceback.format_exc()
-        }, 500
-
-@app.route('/api/test-face-simple')
-def api_test_face_simple():
-    """Endpoint simple para probar Face++ con método de archivo"""
-    try:
-        # Obtener foto ID 31
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT id, nombre, nombre_archivo FROM photos WHERE id = 31')
-        foto = cursor.fetchone()
-        cursor.execute('SELECT * FROM users WHERE id = 1')
-        user_row = cursor.fetchone()
-
-        if not foto or not user_row:
-            return {"error": "Foto o usuario no encontrado"}, 404
-
-        # Convertir usuario a dict
-        user_columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(user_columns, user_row))
-
-        print(f"Procesando foto: {foto[1]}")
-        print(f"URL: {foto[2]}")
-
-        # Usar el método de tu ejemplo: descargar imagen y enviar archivo
-        api_key = os.getenv('FACEPP_API_KEY')
-        api_secret = os.getenv('FACEPP_API_SECRET')
-
-        # Descargar imagen
-        img_response = requests.get(foto[2])
-        if img_response.status_code != 200:
-            return {"error": "No se pudo descargar la imagen"}, 400
-
-        print(f"Imagen descargada: {len(img_response.content)} bytes")
-
-        # Enviar archivo a Face++ (método de tu ejemplo)
-        from io import BytesIO
-        files = {'image_file': BytesIO(img_response.content)}
-        params = {
-            'api_key': api_key,
-            'api_secret': api_secret,
-            'return_attributes': 'age,gender'
-        }
-
-        print("Enviando archivo a Face++...")
-        response = requests.post('https://api-us.faceplusplus.com/facepp/v3/detect',
-                                 files=files, data=params, timeout=30)
-        result = response.json()
-
-        print(f"Respuesta Face++: {result}")
-
-        if 'faces' not in result or len(result['faces']) == 0:
-            return render_template('etiquetar_caras_individuales.html', caras=[], user=user)
-
-        faces = result['faces']
-        print(f"Detectadas {len(faces)} caras")
-
-        caras_individuales = []
-
-        # Procesar cada cara
-        for idx, cara in enumerate(faces):
-            try:
-                from PIL import Image
-                import uuid
-
-                face_rectangle = cara['face_rectangle']
-
-                # Abrir imagen con PIL
-                image = Image.open(BytesIO(img_response.content))
-
-                # Recortar cara
-                left = face_rectangle['left']
-                top = face_rectangle['top']
-                width = face_rectangle['width']
-                height = face_rectangle['height']
-
-                padding = int(min(width, height) * 0.1)
-                left = max(0, left - padding)
-                top = max(0, top - padding)
-                right = min(image.width, left + width + (padding * 2))
-                bottom = min(image.height, top + height + (padding * 2))
-
-                face_crop = image.crop((left, top, right, bottom))
-                face_crop = face_crop.resize(
-                    (200, 200), Image.Resampling.LANCZOS)
-
-                # Convertir a buffer
-                buffer = BytesIO()
-                face_crop.save(buffer, format='JPEG', quality=90)
-                buffer.seek(0)
-
-                # Subir a Cloudinary
-                temp_filename = f"temp_face_{uuid.uuid4().hex[:8]}.jpg"
-                upload_result = cloudinary.uploader.upload(
-                    buffer,
-                    folder="temp_faces",
-                    public_id=temp_filename,
-                    resource_type="image",
-                    format="jpg"
-                )
-
-                if upload_result.get('secure_url'):
-                    caras_individuales.append({
-                        'foto_id': foto[0],
-                        'foto_nombre': foto[1],
-                        'cara_index': idx,
-                        'face_token': cara['face_token'],
-                        'recorte_url': upload_result['secure_url'],
-                        'recorte_public_id': upload_result['public_id'],
-                        'cara_id': f"{foto[0]}_{idx}"
-                    })
-                    print(
-                        f"Cara {idx + 1} procesada: {upload_result['secure_url']}")
-
-            except Exception as e:
-                print(f"Error procesando cara {idx + 1}: {e}")
-
-        print(f"RESULTADO: {len(caras_individuales)} caras procesadas")
-
-        return render_template('etiquetar_caras_individuales.html',
-                               caras=caras_individuales,
-                               user=user)
-
-    except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"error": str(e)}, 500
-
-@app.route('/api/test-gestionar-personas')
-def api_test_gestionar_personas():
-    """Probar gestión de personas sin autenticación"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = 1')
-        user_row = cursor.fetchone()
-
-        # Convertir usuario a dict
-        user_columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(user_columns, user_row))
-
-        # Obtener todas las personas
-        cursor.execute('''
-            SELECT id, nombre, imagen, created_at 
-            FROM personas 
-            ORDER BY nombre
-        ''')
-        personas = cursor.fetchall()
-
-        # Convertir a lista de diccionarios
-        personas_list = []
-        columns = [desc[0] for desc in cursor.description]
-        for persona in personas:
-            persona_dict = dict(zip(columns, persona))
-            personas_list.append({
-                'id': persona_dict['id'],
-                'nombre': persona_dict['nombre'],
-                'imagen': persona_dict['imagen'],
-                'created_at': persona_dict['created_at']
-            })
-
-        return render_template('gestionar_personas.html', personas=personas_list, user=user)
-
-    except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"error": str(e)}, 500
-
-@app.route('/api/test-foto-procesada')
-def api_test_foto_procesada():
-    """Probar foto ya procesada sin autenticación"""
-    try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = 1')
-        user_row = cursor.fetchone()
-
-        # Convertir usuario a dict
-        user_columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(user_columns, user_row))
-
-        # Obtener foto ID 1 que ya tiene personas
-        cursor.execute(
-            'SELECT id, nombre, nombre_archivo, personas_ids FROM photos WHERE id = 1')
-        foto = cursor.fetchone()
-
-        if not foto:
-            return {"error": "Foto no encontrada"}, 404
-
-        # Convertir foto a dict
-        foto_columns = [desc[0] for desc in cursor.description]
-        foto_dict = dict(zip(foto_columns, foto))
-
-        print(f"Foto ID 1 - personas_ids: {foto_dict['personas_ids']}")
-
-        # Verificar si tiene personas
-        if foto_dict['personas_ids'] and foto_dict['personas_ids'].strip() and foto_dict['personas_ids'] != 'null':
-            print("Foto ya procesada, mostrando resumen")
-            return mostrar_resumen_fotos_procesadas([foto_dict], user, conn)
-        else:
-            print("Foto sin procesar")
-            return {"message": "Foto sin procesar"}
-
-    except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"error": str(e)}, 500
-
-@app.route('/api/test-procesar-reconocimiento-facial')
-def api_test_procesar_reconocimiento_facial():
-    """API de prueba para procesar reconocimiento facial SIN autenticación"""
-    try:
-        # Obtener usuario ID 1 para pruebas
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = 1')
-        user_row = cursor.fetchone()
-
-        if not user_row:
-            return render_template('error.html', message='Usuario no encontrado'), 404
-
-        # Convertir usuario a dict
-        user_columns = [desc[0] for desc in cursor.description]
-        user = dict(zip(user_columns, user_row))
-
-        # Obtener IDs de fotos específicas desde la query string
-        ids_param = request.args.get('ids', '')
-        print(f"📋 IDs recibidos en parámetro: '{ids_param}'")
-
-        foto_ids = ids_param.split(',')
-        foto_ids = [id.strip() for id in foto_ids if id.strip().isdigit()]
-
-        print(f"📋 IDs procesados: {foto_ids}")
-
-        if not foto_ids:
-            print("❌ No hay IDs válidos para procesar")
-            return render_template('etiquetar_caras_individuales.html', caras=[], user=user)
-
-        # Obtener la foto específica
-        placeholders = ','.join(['%s' for _ in foto_ids])
-        cursor.execute(f'''
-            SELECT id, nombre, nombre_archivo, mes, año, created_at
-            FROM photos 
-            WHERE id IN ({placeholders}) AND user_id = %s
-            ORDER BY created_at DESC
-        ''', foto_ids + [user['id']])
-        fotos_recientes = cursor.fetchall()
-
-        print(f"📸 Fotos encontradas: {len(fotos_recientes)}")
-
-        caras_individuales = []
-
-        # Procesar cada foto usando el código que sabemos que funciona
-        columns = [desc[0] for desc in cursor.description]
-        for foto in fotos_recientes:
-            foto_dict = dict(zip(columns, foto))
-            print(f"🔍 Procesando foto: {foto_dict['nombre']}")
-            print(f"🔗 URL: {foto_dict['nombre_archivo']}")
-
-            # Usar la misma lógica que en debug_processing.py
-            api_key = os.getenv('FACEPP_API_KEY')
-            api_secret = os.getenv('FACEPP_API_SECRET')
-
-            if not api_key or not api_secret:
-                print("❌ Face++ credentials not found")
-                continue
-
-            # Detectar caras
-            detect_url = "https://api-us.faceplusplus.com/facepp/v3/detect"
-            data = {
-                'api_key': api_key,
-                'api_secret': api_secret,
-                'image_url': foto_dict['nombre_archivo'],
-                'return_attributes': 'age,gender'
-            }
-
-            try:
-                print(f"📡 Enviando request a Face++...")
-                response = requests.post(detect_url, data=data, timeout=30)
-                result = response.json()
-
-                print(f"📥 Respuesta Face++: {result}")
-
-                if 'faces' in result and len(result['faces']) > 0:
-                    faces = result['faces']
-                    print(f"✅ Detectadas {len(faces)} caras")
-
-                    # Procesar cada cara
-                    for idx, cara in enumerate(faces):
-                        print(f"✂️ Procesando cara {idx + 1}")
-
-                        face_rectangle = cara['face_rectangle']
-                        face_token = cara['face_token']
-
-                        # Crear recorte usando PIL
-                        from PIL import Image
-                        from io import BytesIO
-
-                        img_response = requests.get(foto_dict['nombre_archivo'])
-                        if img_response.status_code == 200:
-                            image = Image.open(BytesIO(img_response.content))
-
-                            # Recortar cara
-                            left = face_rectangle['left']
-                            top = face_rectangle['top']
-                            width = face_rectangle['width']
-                            height = face_rectangle['height']
-
-                            padding = int(min(width, height) * 0.1)
-                            left = max(0, left - padding)
-                            top = max(0, top - padding)
-                            right = min(image.width, left +
-                                        width + (padding * 2))
-                            bottom = min(image.height, top +
-                                         height + (padding * 2))
-
-                            face_crop = image.crop((left, top, right, bottom))
-                            face_crop = face_crop.resize(
-                                (200, 200), Image.Resampling.LANCZOS)
-
-                            # Convertir a buffer
-                            buffer = BytesIO()
-                            face_crop.save(buffer, format='JPEG', quality=90)
-                            buffer.seek(0)
-
-                            # Subir a Cloudinary
-                            import uuid
-                            temp_filename = f"temp_face_{uuid.uuid4().hex[:8]}.jpg"
-
-                            upload_result = cloudinary.uploader.upload(
-                                buffer,
-                                folder="temp_faces",
-                                public_id=temp_filename,
-                                resource_type="image",
-                                format="jpg"
-                            )
-
-                            if upload_result.get('secure_url'):
-                                caras_individuales.append({
-                                    'foto_id': foto_dict['id'],
-                                    'foto_nombre': foto_dict['nombre'],
-                                    'cara_index': idx,
-                                    'face_token': face_token,
-                                    'recorte_url': upload_result['secure_url'],
-                                    'recorte_public_id': upload_result['public_id'],
-                                    'cara_id': f"{foto_dict['id']}_{idx}"
-                                })
-                                print(
-                                    f"✅ Cara {idx + 1} procesada: {upload_result['secure_url']}")
-                            else:
-                                print(f"❌ Error subiendo cara {idx + 1}")
-                        else:
-                            print(
-                                f"❌ Error descargando imagen para cara {idx + 1}")
-                else:
-                    print(f"ℹ️ No se detectaron caras en {foto_dict['nombre']}")
-
-            except Exception as e:
-                print(f"❌ Error procesando {foto_dict['nombre']}: {e}")
-
-        print(f"🎯 RESUMEN FINAL:")
-        print(f"   - Fotos procesadas: {len(fotos_recientes)}")
-        print(f"   - Caras individuales generadas: {len(caras_individuales)}")
-
-        return render_template('etiquetar_caras_individuales.html',
-                               caras=caras_individuales,
-                               user=user)
-
-    except Exception as e:
-        print(f"❌ Error en endpoint de prueba: {e}")
-        import traceback
-        traceback.print_exc()
-        return render_template('error.html', message='Error procesando reconocimiento facial'), 500
-
 @app.route('/api/guardar-etiquetas-personas', methods=['POST'])
 @require_auth
 def api_guardar_etiquetas_personas():
@@ -4265,7 +2750,6 @@ def api_guardar_etiquetas_personas():
             return jsonify({'success': True, 'message': 'No hay etiquetas para guardar'})
 
         conn = get_db()
-        cursor = conn.cursor()
         personas_creadas = 0
         fotos_actualizadas = 0
 
@@ -4275,21 +2759,36 @@ def api_guardar_etiquetas_personas():
             personas_ids = []
 
             # Obtener datos de la foto para crear recortes
-            cursor.execute(
-                'SELECT nombre_archivo FROM photos WHERE id = %s AND user_id = %s',
-                (foto_id, user['id'])
-            )
-            foto_data = cursor.fetchone()
+            foto_url = repository.foto_del_usuario(conn, foto_id, user['id'])
 
-            if not foto_data:
+            if not foto_url:
                 continue
 
-            # Detectar caras de nuevo para obtener coordenadas de recorte
-            print(
-                f"🔍 Detectando caras para recortes en foto {foto_id}: {foto_data[0]}")
-            caras_detectadas = detect_faces_facepp(foto_data[0])
+            # Caras guardadas por el reconocimiento; solo se detectan si faltan o caducaron
+            caras = repository.caras_detectadas(conn, [foto_id]).get(int(foto_id))
+            if deteccion_vigente(caras):
+                caras_detectadas = caras_como_facepp(caras)
+            else:
+                print(
+                    f"🔍 Detectando caras para recortes en foto {foto_id}: {foto_url}")
+                caras_detectadas = detector.detect(foto_url)
+                if caras_detectadas is not None:
+                    repository.guardar_caras_detectadas(
+                        conn, {foto_id: caras_detectadas}, detector.token_expires())
+                caras_detectadas = caras_detectadas or []
             print(
-                f"📊 Caras detectadas para recortes: {len(caras_detectadas) if caras_detectadas else 0}")
+                f"📊 Caras detectadas para recortes: {len(caras_detectadas)}")
+
+            # Recortes hechos aquí con los rectángulos guardados (sin el detector): todas las
+            # caras con una sola descarga, y solo si alguna persona necesita imagen
+            recortes = []
+            asignaciones = []  # (foto_id, cara_index, persona_id)
+
+            def recorte_de_cara(idx):
+                if not recortes:
+                    recortes.extend(get_face_crops(
+                        foto_url, [cara['face_rectangle'] for cara in caras_detectadas], size=(400, 400)))
+                return recortes[idx]
 
             # Para cada persona mencionada en la foto
             for idx, nombre in enumerate(personas_nombres):
@@ -4300,39 +2799,31 @@ def api_guardar_etiquetas_personas():
                 print(f"👤 Procesando persona: '{nombre}' (índice {idx})")
 
                 # Verificar si la persona ya existe
-                cursor.execute(
-                    'SELECT id, imagen FROM personas WHERE nombre = %s', (
-                        nombre,)
-                )
-                persona_existente = cursor.fetchone()
+                persona_existente = repository.get_persona_por_nombre(conn, nombre)
 
                 if persona_existente:
                     print(
-                        f"✅ Persona existente encontrada: ID={persona_existente[0]}, imagen={persona_existente[1] or 'SIN IMAGEN'}")
-                    personas_ids.append(persona_existente[0])
+                        f"✅ Persona existente encontrada: ID={persona_existente.id}, imagen={persona_existente.imagen or 'SIN IMAGEN'}")
+                    personas_ids.append(persona_existente.id)
+                    if idx < len(caras_detectadas):
+                        asignaciones.append((foto_id, idx, persona_existente.id))
 
                     # Si la persona existe pero no tiene imagen, agregar recorte
-                    if not persona_existente[1] and idx < len(caras_detectadas):
+                    if not persona_existente.imagen and idx < len(caras_detectadas):
                         print(
                             f"🖼️ Creando recorte para persona existente: {nombre} (índice {idx})")
-                        face_token = caras_detectadas[idx]['face_token']
-                        print(f"🔑 Face token: {face_token}")
 
-                        face_crop = get_face_crop_from_facepp(
-                            foto_data[0], face_token)
+                        face_crop = recorte_de_cara(idx)
 
                         if face_crop:
                             print(
-                                f"✂️ Recorte obtenido de Face++, subiendo a Cloudinary...")
+                                f"✂️ Recorte creado, subiendo a Cloudinary...")
                             upload_result = upload_face_crop_to_cloudinary(
                                 face_crop, nombre)
                             if upload_result['success']:
                                 # Actualizar persona con imagen de recorte
-                                cursor.execute('''
-                                    UPDATE personas 
-                                    SET imagen = %s, updated_at = %s
-                                    WHERE id = %s
-                                ''', (upload_result['url'], datetime.now(), persona_existente[0]))
+                                repository.actualizar_imagen_persona(
+                                    conn, persona_existente.id, upload_result['url'])
                                 print(
                                     f"✅ Recorte guardado para persona existente: {nombre} -> {upload_result['url']}")
                             else:
@@ -4340,11 +2831,11 @@ def api_guardar_etiquetas_personas():
                                     f"❌ Error subiendo recorte para {nombre}: {upload_result.get('error', 'Unknown error')}")
                         else:
                             print(
-                                f"❌ No se pudo obtener recorte de Face++ para {nombre}")
+                                f"❌ No se pudo crear el recorte para {nombre}")
                     else:
-                        if persona_existente[1]:
+                        if persona_existente.imagen:
                             print(
-                                f"ℹ️ Persona {nombre} ya tiene imagen: {persona_existente[1]}")
+                                f"ℹ️ Persona {nombre} ya tiene imagen: {persona_existente.imagen}")
                         else:
                             print(
                                 f"⚠️ No hay cara detectada para índice {idx} (total: {len(caras_detectadas)})")
@@ -4354,12 +2845,10 @@ def api_guardar_etiquetas_personas():
 
                     # Si hay cara detectada para esta persona, crear recorte
                     if idx < len(caras_detectadas):
-                        face_token = caras_detectadas[idx]['face_token']
                         print(
-                            f"🖼️ Creando recorte para nueva persona: {nombre} con face_token: {face_token}")
+                            f"🖼️ Creando recorte para nueva persona: {nombre} (índice {idx})")
 
-                        face_crop = get_face_crop_from_facepp(
-                            foto_data[0], face_token)
+                        face_crop = recorte_de_cara(idx)
 
                         if face_crop:
                             upload_result = upload_face_crop_to_cloudinary(
@@ -4373,27 +2862,19 @@ def api_guardar_etiquetas_personas():
                                     f"❌ Error subiendo recorte para nueva persona {nombre}: {upload_result.get('error', 'Unknown error')}")
                         else:
                             print(
-                                f"❌ No se pudo obtener recorte de Face++ para nueva persona {nombre}")
+                                f"❌ No se pudo crear el recorte para nueva persona {nombre}")
 
                     # Crear nueva persona con o sin imagen
-                    cursor.execute('''
-                        INSERT INTO personas (nombre, imagen, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s)
-                        RETURNING id
-                    ''', (nombre, imagen_url, datetime.now(), datetime.now()))
-
-                    new_person_id = cursor.fetchone()[0]
+                    new_person_id = repository.crear_persona(conn, nombre, imagen_url)
                     personas_ids.append(new_person_id)
                     personas_creadas += 1
+                    if idx < len(caras_detectadas):
+                        asignaciones.append((foto_id, idx, new_person_id))
 
             # Actualizar la foto con las personas identificadas
             if personas_ids:
-                personas_ids_json = json.dumps(personas_ids)
-                cursor.execute('''
-                    UPDATE photos 
-                    SET personas_ids = %s, updated_at = %s
-                    WHERE id = %s AND user_id = %s
-                ''', (personas_ids_json, datetime.now(), foto_id, user['id']))
+                repository.reemplazar_personas_foto(conn, foto_id, user['id'], personas_ids)
+                repository.asignar_personas_caras(conn, asignaciones, user['id'])
                 fotos_actualizadas += 1
 
         conn.commit()
@@ -4415,6 +2896,31 @@ def api_guardar_etiquetas_personas():
                   f'User: {user["id"] if user else "Unknown"}')
         return jsonify({'success': False, 'message': 'Error interno del servidor'}), 500
 
+def copiar_recorte_a_personas(nombre, recorte_url, recorte_public_id):
+    """Copiar un recorte temporal de cara a la carpeta personas; devuelve la URL o None"""
+    try:
+        import uuid
+        new_filename = f"person_{nombre.replace(' ', '_')}_{uuid.uuid4().hex[:8]}.jpg"
+
+        copy_result = cloudinary.uploader.upload(
+            recorte_url,
+            folder="personas",
+            public_id=new_filename,
+            resource_type="image",
+            format="jpg"
+        )
+
+        # Eliminar imagen temporal
+        cloudinary.uploader.destroy(recorte_public_id)
+
+        if copy_result.get('secure_url'):
+            print(f"✅ Imagen copiada para {nombre}: {copy_result['secure_url']}")
+            return copy_result['secure_url']
+
+    except Exception as e:
+        print(f"⚠️ Error copiando imagen para {nombre}: {e}")
+    return None
+
 @app.route('/api/guardar-identificaciones-caras', methods=['POST'])
 @require_auth
 def api_guardar_identificaciones_caras():
@@ -4439,162 +2945,71 @@ def api_guardar_identificaciones_caras():
             print("⚠️ No hay identificaciones para guardar")
             return jsonify({'success': True, 'message': 'No hay identificaciones para guardar'})
 
-        conn = get_db()
-        cursor = conn.cursor()
-        personas_creadas = 0
-        fotos_actualizadas = {}  # Dict para evitar duplicados por foto
-
+        # Validar y agrupar por nombre (la primera identificación de cada nombre aporta el recorte)
+        validas = []
+        recortes = {}  # nombre -> (recorte_url, recorte_public_id)
         for identificacion in identificaciones:
             try:
                 nombre = identificacion['nombre'].strip()
-                foto_id = identificacion['foto_id']
-                recorte_url = identificacion['recorte_url']
-                recorte_public_id = identificacion['recorte_public_id']
-
-                if not nombre:
-                    continue
-
-                print(
-                    f"👤 Procesando identificación: '{nombre}' para foto {foto_id}")
-
-                # Verificar si la persona ya existe
-                cursor.execute(
-                    'SELECT id, imagen FROM personas WHERE nombre = %s', (nombre,)
-                )
-                persona_existente = cursor.fetchone()
-
-                if persona_existente:
-                    print(
-                        f"✅ Persona existente: {nombre} (ID: {persona_existente[0]})")
-                    persona_id = persona_existente[0]
-
-                    # Si no tiene imagen, usar el recorte como imagen permanente
-                    if not persona_existente[1]:
-                        # Mover de temp_faces a personas
-                        try:
-                            # Copiar imagen a carpeta personas
-                            import uuid
-                            new_filename = f"person_{nombre.replace(' ', '_')}_{uuid.uuid4().hex[:8]}.jpg"
-
-                            copy_result = cloudinary.uploader.upload(
-                                recorte_url,
-                                folder="personas",
-                                public_id=new_filename,
-                                resource_type="image",
-                                format="jpg"
-                            )
-
-                            if copy_result.get('secure_url'):
-                                # Actualizar persona con nueva imagen
-                                cursor.execute('''
-                                    UPDATE personas 
-                                    SET imagen = %s, updated_at = %s
-                                    WHERE id = %s
-                                ''', (copy_result['secure_url'], datetime.now(), persona_id))
-                                print(
-                                    f"✅ Imagen actualizada para {nombre}: {copy_result['secure_url']}")
-
-                            # Eliminar imagen temporal
-                            cloudinary.uploader.destroy(recorte_public_id)
-
-                        except Exception as e:
-                            print(f"⚠️ Error moviendo imagen para {nombre}: {e}")
-
-                else:
-                    # Crear nueva persona con el recorte como imagen
-                    print(f"🆕 Creando nueva persona: {nombre}")
-
-                    # Mover imagen de temp_faces a personas
-                    imagen_url = None
-                    try:
-                        import uuid
-                        new_filename = f"person_{nombre.replace(' ', '_')}_{uuid.uuid4().hex[:8]}.jpg"
-
-                        copy_result = cloudinary.uploader.upload(
-                            recorte_url,
-                            folder="personas",
-                            public_id=new_filename,
-                            resource_type="image",
-                            format="jpg"
-                        )
-
-                        if copy_result.get('secure_url'):
-                            imagen_url = copy_result['secure_url']
-                            print(
-                                f"✅ Imagen copiada para nueva persona {nombre}: {imagen_url}")
-
-                        # Eliminar imagen temporal
-                        cloudinary.uploader.destroy(recorte_public_id)
-
-                    except Exception as e:
-                        print(
-                            f"⚠️ Error copiando imagen para nueva persona {nombre}: {e}")
-
-                    # Crear persona
-                    cursor.execute('''
-                        INSERT INTO personas (nombre, imagen, created_at, updated_at)
-                        VALUES (%s, %s, %s, %s)
-                        RETURNING id
-                    ''', (nombre, imagen_url, datetime.now(), datetime.now()))
-
-                    persona_id = cursor.fetchone()[0]
-                    personas_creadas += 1
-                    print(f"✅ Nueva persona creada: {nombre} (ID: {persona_id})")
-
-                # Agregar persona a la foto (evitar duplicados)
-                if foto_id not in fotos_actualizadas:
-                    fotos_actualizadas[foto_id] = []
-                fotos_actualizadas[foto_id].append(persona_id)
-
+                foto_id = int(identificacion['foto_id'])
+                cara_index = int(identificacion.get('cara_index', -1))
+                recorte = (identificacion['recorte_url'], identificacion['recorte_public_id'])
             except KeyError as e:
                 print(f"⚠️ Error en identificación, falta clave: {e}")
                 continue
-            except Exception as e:
+            except (AttributeError, TypeError, ValueError) as e:
                 print(f"⚠️ Error procesando identificación: {e}")
                 continue
-
-        # Actualizar fotos con personas identificadas
-        for foto_id, personas_ids in fotos_actualizadas.items():
-            try:
-                # Obtener personas_ids existentes
-                cursor.execute(
-                    'SELECT personas_ids FROM photos WHERE id = %s AND user_id = %s',
-                    (foto_id, user['id'])
-                )
-                foto_actual = cursor.fetchone()
-
-                personas_existentes = []
-                if foto_actual and foto_actual[0]:
-                    try:
-                        # En PostgreSQL, los datos JSON se pueden almacenar como texto
-                        # pero también se pueden manejar como objetos JSON
-                        if isinstance(foto_actual[0], str):
-                            personas_existentes = json.loads(foto_actual[0])
-                        else:
-                            # Si ya es una lista (caso poco probable pero por si acaso)
-                            personas_existentes = list(foto_actual[0]) if isinstance(foto_actual[0], (list, tuple)) else []
-                    except Exception as e:
-                        print(f"⚠️ Error parseando personas_ids: {e}")
-                        personas_existentes = []
-
-                # Combinar con nuevas personas (evitar duplicados)
-                todas_personas = list(set(personas_existentes + personas_ids))
-                personas_ids_json = json.dumps(todas_personas)
-
-                cursor.execute('''
-                    UPDATE photos 
-                    SET personas_ids = %s, updated_at = %s
-                    WHERE id = %s AND user_id = %s
-                ''', (personas_ids_json, datetime.now(), foto_id, user['id']))
-
-                print(
-                    f"✅ Foto {foto_id} actualizada con personas: {todas_personas}")
-
-            except Exception as e:
-                print(f"⚠️ Error actualizando foto {foto_id}: {e}")
+            if not nombre:
                 continue
+            validas.append((nombre, foto_id, cara_index))
+            recortes.setdefault(nombre, recorte)
 
-        conn.commit()
+        # Resolver todos los nombres en una sola consulta
+        conn = get_db()
+        existentes = repository.personas_por_nombres(conn, list(recortes))
+        print(f"✅ {len(existentes)} personas existentes, {len(recortes) - len(existentes)} nuevas")
+
+        # Las personas nuevas o sin imagen usan su recorte como imagen permanente
+        sin_imagen = [nombre for nombre in recortes
+                      if nombre not in existentes or not existentes[nombre].imagen]
+        imagenes = {}
+        if sin_imagen:
+            with ThreadPoolExecutor(max_workers=min(4, len(sin_imagen))) as executor:
+                urls = executor.map(lambda nombre: copiar_recorte_a_personas(nombre, *recortes[nombre]),
+                                    sin_imagen)
+                imagenes = {nombre: url for nombre, url in zip(sin_imagen, urls) if url}
+
+        # Crear personas, completar imágenes y etiquetar fotos en una sola transacción
+        with repository.transaccion(conn):
+            nuevas = [(nombre, imagenes.get(nombre)) for nombre in recortes if nombre not in existentes]
+            creadas = repository.crear_personas(conn, nuevas)
+            personas_creadas = len(creadas)
+
+            ids = {nombre: persona.id for nombre, persona in existentes.items()}
+            ids.update(creadas)
+            pendientes = [nombre for nombre, _ in nuevas if nombre not in creadas]
+            if pendientes:
+                # Creadas a la vez por otra petición (ON CONFLICT DO NOTHING)
+                ids.update({nombre: persona.id for nombre, persona
+                            in repository.personas_por_nombres(conn, pendientes).items()})
+
+            repository.completar_imagenes_personas(
+                conn, [(ids[nombre], url) for nombre, url in imagenes.items() if nombre not in creadas])
+
+            # Añadir las personas a sus fotos en una sola sentencia (solo fotos del usuario)
+            pares = sorted({(foto_id, ids[nombre]) for nombre, foto_id, _ in validas})
+            fotos_actualizadas = {foto_id for foto_id, _ in pares}
+            repository.anadir_personas_fotos(conn, pares, user['id'])
+            confirmadas = repository.asignar_personas_caras(
+                conn, [(foto_id, cara_index, ids[nombre]) for nombre, foto_id, cara_index in validas
+                       if cara_index >= 0], user['id'])
+            print(f"✅ {personas_creadas} personas creadas, {len(fotos_actualizadas)} fotos actualizadas "
+                  f"con {len(pares)} identificaciones")
+
+        # Ya confirmadas: sus embeddings sirven para sugerir nombres en las próximas fotos
+        indexadas = indexar_confirmadas(confirmadas)
+        print(f"🧭 {indexadas} caras añadidas al índice de sugerencias")
 
         log_user_action(user['id'], 'SAVE_FACE_IDENTIFICATIONS',
                         f'Created {personas_creadas} persons, updated {len(fotos_actualizadas)} photos')
@@ -4622,13 +3037,16 @@ def robots_txt():
     """Servir robots.txt para SEO"""
     return app.send_static_file('robots.txt')
 
-@app.route('/init-db')
-def init_db_route():
-    init_db()
-    return "Database initialized"
-
 if __name__ == '__main__':
-    with app.app_context():
-        init_db()
+    migrations.migrar()
+    atexit.register(interaction_tracker.stop)
+    atexit.register(email_queue.stop)
+    atexit.register(health_checker.stop)
+    health_checker.start()
+    if MAINTENANCE_IN_PROCESS:
+        maintenance_scheduler.start()
+    if RECOGNITION_IN_PROCESS:
+        atexit.register(recognition_worker.stop)
+        recognition_worker.start()
     app_logger.info("APLICACION INICIADA")
     app.run( host='0.0.0.0', port=8000)
@@ -0,0 +1,216 @@
+"""
+Servicio de autenticación por código de email
+
+Todas las rutas de login y registro (HTMX y API JSON) y el cambio de email pasan
+por aquí. Hay un único almacén de códigos, verification_codes (un código vigente
+por email, índice único y caducidad CODE_TTL), y cada paso es una sola sentencia:
+
+    emitir_codigo_login / emitir_codigo_registro
+        comprueban si el usuario existe y guardan el código en el mismo INSERT
+    verificar_codigo
+        consume el código (DELETE ... RETURNING), crea el usuario si es un
+        registro y abre la sesión en sessions, todo en un viaje a la base de datos
+
+Así dos peticiones con el mismo código no pueden usarlo las dos: solo una
+consigue borrarlo.
+"""
+import secrets
+from datetime import datetime, timedelta
+
+from logger_config import log_database_operation
+from repository import ejecutar, instrumentada
+
+CODE_TTL = timedelta(minutes=10)
+SESSION_TTL = timedelta(hours=8)
+
+# Motivos de un código rechazado (los devuelve motivo_rechazo)
+CODIGO_NO_ENCONTRADO = 'not_found'
+CODIGO_INCORRECTO = 'invalid'
+CODIGO_CADUCADO = 'expired'
+EMAIL_EN_USO = 'email_in_use'
+
+
+def generar_codigo():
+    """Código numérico de 6 dígitos"""
+    return str(secrets.randbelow(900000) + 100000)
+
+
+@instrumentada
+def emitir_codigo_login(conn, email, code, ahora=None):
+    """Guardar un código de login si el email tiene cuenta; devuelve el nombre o None"""
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        INSERT INTO verification_codes (email, name, code, purpose, expires, created_at)
+        SELECT email, name, %s::text, 'login', %s::timestamp, %s::timestamp
+        FROM users WHERE email = %s
+        ORDER BY id LIMIT 1
+        ON CONFLICT (email) DO UPDATE SET
+            name = EXCLUDED.name, code = EXCLUDED.code, purpose = EXCLUDED.purpose,
+            expires = EXCLUDED.expires, created_at = EXCLUDED.created_at
+        RETURNING name
+    ''', (code, ahora + CODE_TTL, ahora, email), preparada=True)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@instrumentada
+def emitir_codigo_registro(conn, email, name, code, ahora=None):
+    """Guardar un código de registro si el email no tiene cuenta; False si ya existe"""
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        INSERT INTO verification_codes (email, name, code, purpose, expires, created_at)
+        SELECT %s::text, %s::text, %s::text, 'register', %s::timestamp, %s::timestamp
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE email = %s)
+        ON CONFLICT (email) DO UPDATE SET
+            name = EXCLUDED.name, code = EXCLUDED.code, purpose = EXCLUDED.purpose,
+            expires = EXCLUDED.expires, created_at = EXCLUDED.created_at
+        RETURNING 1
+    ''', (email, name, code, ahora + CODE_TTL, ahora, email), preparada=True)
+    return cursor.fetchone() is not None
+
+
+@instrumentada
+def verificar_codigo(conn, email, code, access_token, token_expires, ahora=None):
+    """Consumir el código y abrir la sesión en una sola sentencia
+
+    Devuelve {'id', 'name', 'created', 'generation'} o None si el código no es
+    válido. La sesión es una fila nueva de sessions (una por dispositivo);
+    access_token puede ser None (tokens firmados: no se guardan, se emiten
+    después con el id y la generación devueltos).
+    """
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH codigo AS (
+            DELETE FROM verification_codes
+            WHERE email = %s AND code = %s AND expires > %s
+            RETURNING email, name, purpose
+        ),
+        existente AS (
+            SELECT u.id, u.name, false AS created
+            FROM users u, codigo
+            WHERE u.id = (SELECT id FROM users WHERE email = codigo.email ORDER BY id LIMIT 1)
+        ),
+        alta AS (
+            INSERT INTO users (name, email, created_at, updated_at)
+            SELECT codigo.name, codigo.email, %s::timestamp, %s::timestamp
+            FROM codigo
+            WHERE codigo.purpose = 'register'
+              AND NOT EXISTS (SELECT 1 FROM users WHERE email = codigo.email)
+            RETURNING id, name, true AS created
+        ),
+        cuenta AS (
+            SELECT * FROM existente UNION ALL SELECT * FROM alta
+        ),
+        sesion AS (
+            INSERT INTO sessions (user_id, token, expires, created_at)
+            SELECT id, %s::text, %s::timestamp, %s::timestamp
+            FROM cuenta
+            WHERE %s::text IS NOT NULL
+        )
+        SELECT c.id, c.name, c.created, COALESCE(tg.generation, 0)
+        FROM cuenta c
+        LEFT JOIN token_generations tg ON tg.user_id = c.id
+        LIMIT 1
+    ''', (email, code, ahora,
+          ahora, ahora,
+          access_token, token_expires, ahora, access_token), preparada=True)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    user_id, name, created, generation = row
+    log_database_operation('INSERT', 'users' if created else 'sessions',
+                           f'Session created for user {user_id} (code verified)')
+    return {'id': user_id, 'name': name, 'created': created, 'generation': generation}
+
+
+@instrumentada
+def motivo_rechazo(conn, email, code, ahora=None):
+    """Por qué no se aceptó un código (solo en el camino de error, para el mensaje)"""
+    cursor = conn.cursor()
+    cursor.execute('SELECT code, expires FROM verification_codes WHERE email = %s', (email,))
+    row = cursor.fetchone()
+    if not row:
+        return CODIGO_NO_ENCONTRADO
+    if row[0] != code:
+        return CODIGO_INCORRECTO
+    if row[1] <= (ahora or datetime.now()):
+        return CODIGO_CADUCADO
+    # Código correcto y vigente: la cuenta desapareció o otra petición lo consumió
+    return CODIGO_NO_ENCONTRADO
+
+
+@instrumentada
+def solicitar_cambio_email(conn, user_id, new_email, code, ahora=None):
+    """Guardar la solicitud de cambio de email si nadie usa new_email; False si está en uso"""
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO email_change_requests (user_id, new_email, verification_code, expires, created_at)
+        SELECT %s::integer, %s::text, %s::text, %s::timestamp, %s::timestamp
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE email = %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            new_email = EXCLUDED.new_email, verification_code = EXCLUDED.verification_code,
+            expires = EXCLUDED.expires, created_at = EXCLUDED.created_at
+        RETURNING 1
+    ''', (user_id, new_email, code, ahora + CODE_TTL, ahora, new_email))
+    return cursor.fetchone() is not None
+
+
+@instrumentada
+def solicitud_cambio_email_pendiente(conn, user_id, ahora=None):
+    """(new_email, expires) de la solicitud vigente del usuario, o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT new_email, expires FROM email_change_requests
+        WHERE user_id = %s AND expires > %s
+    ''', (user_id, ahora or datetime.now()), preparada=True)
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+
+@instrumentada
+def confirmar_cambio_email(conn, user_id, code, ahora=None):
+    """Consumir la solicitud y cambiar el email en una sola sentencia; devuelve el nuevo email o None"""
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    cursor.execute('''
+        WITH solicitud AS (
+            DELETE FROM email_change_requests r
+            WHERE r.user_id = %s AND r.verification_code = %s AND r.expires > %s
+              AND NOT EXISTS (SELECT 1 FROM users otro WHERE otro.email = r.new_email)
+            RETURNING r.new_email
+        )
+        UPDATE users
+        SET email = solicitud.new_email, updated_at = %s
+        FROM solicitud
+        WHERE users.id = %s
+        RETURNING users.email
+    ''', (user_id, code, ahora, ahora, user_id))
+    row = cursor.fetchone()
+    if row:
+        log_database_operation('UPDATE', 'users', f'Email changed for user {user_id}')
+    return row[0] if row else None
+
+
+@instrumentada
+def motivo_rechazo_cambio_email(conn, user_id, code, ahora=None):
+    """Por qué no se aceptó el código de cambio de email (solo en el camino de error)"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT r.verification_code, r.expires,
+               EXISTS (SELECT 1 FROM users WHERE email = r.new_email)
+        FROM email_change_requests r WHERE r.user_id = %s
+    ''', (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return CODIGO_NO_ENCONTRADO
+    if row[0] != code:
+        return CODIGO_INCORRECTO
+    if row[1] <= (ahora or datetime.now()):
+        return CODIGO_CADUCADO
+    if row[2]:
+        return EMAIL_EN_USO
+    return CODIGO_NO_ENCONTRADO
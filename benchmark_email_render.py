@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Mensajes de verificación construidos por segundo
+
+    python benchmark_email_render.py            # 5000 mensajes por variante
+    python benchmark_email_render.py -n 20000
+
+Compara EmailService.build_verification_message (plantillas compiladas y
+partes MIME precodificadas) con construir el mismo mensaje con MIMEMultipart y
+serializarlo, como hacía send_message() en cada envío. No envía nada.
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+os.environ.setdefault('SMTP_EMAIL', 'benchmark@example.com')
+
+from email_service import VERIFICATION_HTML, VERIFICATION_TEXT, EmailService
+
+
+def con_mimemultipart(service, to_email, name, code):
+    """Construcción anterior: objetos email.mime y serialización completa por mensaje"""
+    context = {
+        'name': name,
+        'code': code,
+        'sent_at': datetime.now().strftime('%d/%m/%Y a las %H:%M'),
+        'app_name': service.from_name,
+    }
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = f'Código de verificación: {code}'
+    msg['From'] = f'{service.from_name} <{service.smtp_email}>'
+    msg['To'] = to_email
+    msg.attach(MIMEText(VERIFICATION_TEXT.render(context), 'plain', 'utf-8'))
+    msg.attach(MIMEText(VERIFICATION_HTML.render(context), 'html', 'utf-8'))
+    return msg.as_bytes()
+
+
+def precodificado(service, to_email, name, code):
+    return service.build_verification_message(to_email, name, code).data
+
+
+def medir(nombre, construir, service, n):
+    construir(service, 'usuario@example.com', 'Usuario', '123456')  # calentamiento
+    inicio = time.perf_counter()
+    for i in range(n):
+        construir(service, f'usuario{i}@example.com', f'Usuario {i}', str(100000 + i % 900000))
+    total = time.perf_counter() - inicio
+    print(f"{nombre:28} {n / total:10.0f} mensajes/s   {total / n * 1e6:8.1f} µs/mensaje")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de construcción de emails de verificación')
+    parser.add_argument('-n', type=int, default=5000, help='mensajes por variante')
+    args = parser.parse_args()
+
+    service = EmailService()
+    medir('MIMEMultipart + as_bytes', con_mimemultipart, service, args.n)
+    medir('precodificado', precodificado, service, args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Caras por segundo y recall de los detectores sobre un directorio de fixtures
+
+    python benchmark_face_detection.py fixtures/caras
+    python benchmark_face_detection.py fixtures/caras --detectors opencv --processes 4
+    python benchmark_face_detection.py fixtures/caras --facepp-latency 800 -r 3
+
+El directorio es el mismo que usa fake_facepp.py: imágenes y un faces.json con
+sus caras etiquetadas. fixtures/caras trae un juego pequeño de caras dibujadas
+(fixtures/generar_caras.py); para medir sobre fotos reales basta otro directorio
+con el mismo formato. Las imágenes se sirven con fake_facepp.py, que también
+hace de Face++ (con --facepp-latency ms de respuesta), así que el benchmark no
+sale de la máquina ni gasta cuota. De facepp no se da recall ni precisión: el
+servidor falso responde con las mismas caras de faces.json, así que solo se
+mide el rendimiento del camino remoto a igual concurrencia.
+
+Una cara detectada cuenta como acierto si su rectángulo tiene IoU >= --iou con
+una cara etiquetada que aún no se haya emparejado.
+"""
+
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_facepp import FakeFacePP
+from face_detectors import FacePPDetector, OpenCVDetector
+from recognition_jobs import RECOGNITION_THREADS
+
+
+def iou(a, b):
+    """Intersección sobre unión de dos face_rectangle"""
+    ancho = min(a['left'] + a['width'], b['left'] + b['width']) - max(a['left'], b['left'])
+    alto = min(a['top'] + a['height'], b['top'] + b['height']) - max(a['top'], b['top'])
+    if ancho <= 0 or alto <= 0:
+        return 0.0
+    interseccion = ancho * alto
+    return interseccion / (a['width'] * a['height'] + b['width'] * b['height'] - interseccion)
+
+
+def aciertos(detectadas, etiquetadas, umbral):
+    """Emparejar cada cara etiquetada con la detectada de mayor IoU (sin repetir)"""
+    libres = list(detectadas)
+    total = 0
+    for etiquetada in etiquetadas:
+        mejor = max(libres, key=lambda d: iou(d, etiquetada), default=None)
+        if mejor is not None and iou(mejor, etiquetada) >= umbral:
+            libres.remove(mejor)
+            total += 1
+    return total
+
+
+def medir(detector, fake, imagenes, threads, repeticiones, umbral, evaluar=True):
+    detector.detect(fake.fixture_url(imagenes[0]))  # calentamiento (arranca el pool de procesos)
+
+    def detectar(archivo):
+        inicio = time.perf_counter()
+        caras = detector.detect(fake.fixture_url(archivo))
+        return archivo, caras, time.perf_counter() - inicio
+
+    trabajos = imagenes * repeticiones
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        resultados = list(executor.map(detectar, trabajos))
+    total = time.perf_counter() - inicio
+
+    etiquetadas = detectadas = acertadas = fallos = 0
+    latencias = []
+    for archivo, caras, segundos in resultados:
+        latencias.append(segundos)
+        verdad = fake.caras.get(archivo, [])
+        etiquetadas += len(verdad)
+        if caras is None:
+            fallos += 1
+            continue
+        rectangulos = [cara['face_rectangle'] for cara in caras]
+        detectadas += len(rectangulos)
+        acertadas += aciertos(rectangulos, verdad, umbral)
+
+    if evaluar:
+        recall = f"{acertadas / etiquetadas if etiquetadas else float('nan'):5.2f}"
+        precision = f"{acertadas / detectadas if detectadas else float('nan'):5.2f}"
+    else:
+        recall = precision = '  n/a'
+    print(f"{detector.name:8} {len(trabajos) / total:8.1f} fotos/s {detectadas / total:8.1f} caras/s   "
+          f"p50 {statistics.median(latencias) * 1000:7.1f} ms   recall {recall}   "
+          f"precisión {precision}   fallos {fallos}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de los detectores de caras')
+    parser.add_argument('fixtures', help='directorio con las imágenes y faces.json')
+    parser.add_argument('--detectors', default='facepp,opencv', help='lista separada por comas')
+    parser.add_argument('--threads', type=int, default=RECOGNITION_THREADS,
+                        help='fotos en paralelo (como un trabajo de reconocimiento)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='procesos del detector opencv')
+    parser.add_argument('--facepp-latency', type=float, default=600, help='ms de respuesta del Face++ falso')
+    parser.add_argument('--iou', type=float, default=0.5, help='IoU mínimo para contar un acierto')
+    parser.add_argument('-r', '--repeticiones', type=int, default=1, help='pasadas por el directorio')
+    args = parser.parse_args()
+
+    fake = FakeFacePP(args.fixtures, latency=args.facepp_latency / 1000).start()
+    imagenes = sorted(fake.por_contenido.values())
+    if not imagenes:
+        parser.error(f'{args.fixtures} no tiene imágenes')
+    os.environ.setdefault('FACEPP_API_KEY', 'benchmark')
+    os.environ.setdefault('FACEPP_API_SECRET', 'benchmark')
+    print(f"{len(imagenes)} imágenes, {sum(len(c) for c in fake.caras.values())} caras etiquetadas, "
+          f"{args.threads} en paralelo")
+
+    detectores = {
+        'facepp': lambda: FacePPDetector(api_url=fake.detect_url),
+        'opencv': lambda: OpenCVDetector(processes=args.processes),
+    }
+    try:
+        for nombre in args.detectors.split(','):
+            detector = detectores[nombre.strip()]()
+            try:
+                # Las caras de facepp salen de faces.json: compararlas con él no mide nada
+                medir(detector, fake, imagenes, args.threads, args.repeticiones, args.iou,
+                      evaluar=nombre.strip() != 'facepp')
+            finally:
+                detector.close()
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
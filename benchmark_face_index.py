@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Latencia de las sugerencias de nombres con 10k y 100k caras en el índice
+
+    python benchmark_face_index.py
+    python benchmark_face_index.py --sizes 10000,100000,1000000 --faces 1,8 -r 200
+
+Crea índices temporales con vectores aleatorios normalizados de las
+dimensiones del modelo configurado (FACE_EMBEDDING_MODEL) y FACE_SUGGESTIONS
+sugerencias, y mide face_index.sugerir para una foto con --faces caras (un
+solo producto de matrices por foto, como en recognition_jobs.py) y lo que
+tarda añadir una confirmación. El umbral se pone a -1 para que todas las
+consultas recorran las sugerencias completas.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from face_index import FACE_SUGGESTIONS, FaceIndex, embedder
+
+
+def vectores_aleatorios(rng, n, dims):
+    vectores = rng.standard_normal((n, dims), dtype=np.float32)
+    return vectores / np.linalg.norm(vectores, axis=1, keepdims=True)
+
+
+def percentil(valores, p):
+    return sorted(valores)[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def medir(rng, filas, caras_por_foto, repeticiones, personas_por_cara):
+    with tempfile.TemporaryDirectory() as directorio:
+        indice = FaceIndex(directorio)
+        vectores = vectores_aleatorios(rng, filas, indice.dims)
+        personas = rng.integers(0, max(1, filas // personas_por_cara), filas)
+        inicio = time.perf_counter()
+        indice.reconstruir(zip(range(filas), personas, vectores))
+        reconstruir = time.perf_counter() - inicio
+
+        # Otro objeto, como otro worker: abre el índice como memmap en la primera consulta
+        lector = FaceIndex(directorio)
+        inicio = time.perf_counter()
+        lector.sugerir([vectores[0]], umbral=-1)
+        primera = time.perf_counter() - inicio
+        mb = lector.stats()['mb']
+
+        for n in caras_por_foto:
+            latencias = []
+            for _ in range(repeticiones):
+                consultas = list(vectores_aleatorios(rng, n, indice.dims))
+                inicio = time.perf_counter()
+                lector.sugerir(consultas, k=FACE_SUGGESTIONS, umbral=-1)
+                latencias.append(time.perf_counter() - inicio)
+            print(f"{filas:>9,} caras  {n:2d} por foto   p50 {statistics.median(latencias) * 1000:7.2f} ms   "
+                  f"p95 {percentil(latencias, 0.95) * 1000:7.2f} ms")
+
+        latencias = []
+        for i in range(max(1, repeticiones // 10)):
+            inicio = time.perf_counter()
+            indice.agregar([(filas + i, 0, vectores_aleatorios(rng, 1, indice.dims)[0])])
+            latencias.append(time.perf_counter() - inicio)
+        print(f"{filas:>9,} caras  índice {mb} MB, reconstruir {reconstruir:.2f} s, "
+              f"primera consulta {primera * 1000:.1f} ms, añadir una cara p50 "
+              f"{statistics.median(latencias) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de las sugerencias del índice de caras')
+    parser.add_argument('--sizes', default='10000,100000', help='caras en el índice, separadas por comas')
+    parser.add_argument('--faces', default='1,8', help='caras por foto, separadas por comas')
+    parser.add_argument('--caras-por-persona', type=int, default=20)
+    parser.add_argument('-r', '--repeticiones', type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    caras_por_foto = [int(n) for n in args.faces.split(',')]
+    print(f"Modelo {embedder.name} ({embedder.dims} dimensiones), {FACE_SUGGESTIONS} sugerencias por cara")
+    for filas in args.sizes.split(','):
+        medir(rng, int(filas), caras_por_foto, args.repeticiones, args.caras_por_persona)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Coste por comprobación de rate limit: memory:// frente a pgpool:// (PostgreSQL)
+
+    python benchmark_rate_limit.py                 # 2000 comprobaciones por backend
+    python benchmark_rate_limit.py -n 5000 --workers 4
+
+Con --workers N lanza N procesos contra el mismo límite para comprobar que
+pgpool:// lo comparte (memory:// deja pasar N veces más peticiones).
+"""
+
+import argparse
+import multiprocessing
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from limits import parse, strategies
+from limits.storage import storage_from_string
+
+import rate_limit_storage  # noqa: F401  registra pgpool://
+
+ESTRATEGIAS = {
+    'fixed-window': strategies.FixedWindowRateLimiter,
+    'sliding-window-counter': strategies.SlidingWindowCounterRateLimiter,
+}
+
+
+def medir(uri, estrategia, n):
+    """Latencias (s) de n llamadas a hit() con claves distintas"""
+    limiter = ESTRATEGIAS[estrategia](storage_from_string(uri))
+    item = parse('1000000 per hour')
+    latencias = []
+    for i in range(n):
+        inicio = time.perf_counter()
+        limiter.hit(item, 'benchmark', str(i % 200))
+        latencias.append(time.perf_counter() - inicio)
+    # No dejar las claves de prueba en la tabla compartida
+    for i in range(min(n, 200)):
+        limiter.clear(item, 'benchmark', str(i))
+    return latencias
+
+
+def resumen(nombre, latencias):
+    latencias = sorted(latencias)
+    p95 = latencias[int(len(latencias) * 0.95) - 1]
+    print(f"{nombre:40} media {statistics.mean(latencias) * 1e6:8.1f} µs   "
+          f"p95 {p95 * 1e6:8.1f} µs")
+
+
+def _golpear(args):
+    uri, estrategia, intentos = args
+    limiter = ESTRATEGIAS[estrategia](storage_from_string(uri))
+    item = parse('50 per minute')
+    return sum(limiter.hit(item, 'benchmark', 'compartido') for _ in range(intentos))
+
+
+def compartido(uri, estrategia, workers):
+    """Peticiones aceptadas entre todos los procesos para un límite de 50/minuto"""
+    storage = storage_from_string(uri)
+    limiter = ESTRATEGIAS[estrategia](storage)
+    limiter.clear(parse('50 per minute'), 'benchmark', 'compartido')
+    with multiprocessing.get_context('fork').Pool(workers) as pool:
+        aceptadas = sum(pool.map(_golpear, [(uri, estrategia, 100)] * workers))
+    limiter.clear(parse('50 per minute'), 'benchmark', 'compartido')
+    return aceptadas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del almacenamiento de rate limit')
+    parser.add_argument('-n', type=int, default=2000, help='comprobaciones por backend')
+    parser.add_argument('--workers', type=int, default=0, help='procesos para la prueba de límite compartido')
+    args = parser.parse_args()
+
+    for estrategia in ESTRATEGIAS:
+        for uri in ('memory://', 'pgpool://'):
+            medir(uri, estrategia, 50)  # calentamiento (pool y conexiones)
+            resumen(f'{uri} {estrategia}', medir(uri, estrategia, args.n))
+
+    if args.workers:
+        for uri in ('memory://', 'pgpool://'):
+            aceptadas = compartido(uri, 'sliding-window-counter', args.workers)
+            print(f"{uri:12} {args.workers} procesos, límite 50/minuto: {aceptadas} aceptadas")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,32 @@ Configuración para la aplicación Flask SMS Auth
 import os
 from datetime import timedelta
 
+# Configuración de la base de datos PostgreSQL
+DATABASE_CONFIG = {
+    'host': os.getenv('DATABASE_HOST', 'ep-divine-sea-a2tsh7q5.eu-central-1.pg.koyeb.app'),
+    'database': os.getenv('DATABASE_NAME', 'koyebdb'),
+    'user': os.getenv('DATABASE_USER', 'koyeb-adm'),
+    'password': os.getenv('DATABASE_PASSWORD', 'npg_dGpMKX9j8qnm'),
+    'port': os.getenv('DATABASE_PORT', '5432'),
+    'connect_timeout': 10,
+    'sslmode': os.getenv('DATABASE_SSLMODE', 'require')
+}
+
+# Pool de conexiones por worker (ver db_pool.py)
+DB_POOL_CONFIG = {
+    'minconn': int(os.getenv('DB_POOL_MIN', 1)),
+    'maxconn': int(os.getenv('DB_POOL_MAX', 8)),
+    'max_lifetime': int(os.getenv('DB_POOL_MAX_LIFETIME', 1800)),  # segundos
+    'checkout_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),  # segundos
+    'health_check_after': int(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', 30)),  # segundos inactiva
+}
+
+# Réplica de solo lectura opcional (DSN libpq: "host=... dbname=..." o "postgresql://...")
+REPLICA_DATABASE_CONFIG = {
+    'dsn': os.getenv('DATABASE_REPLICA_DSN'),
+    'connect_timeout': 10,
+} if os.getenv('DATABASE_REPLICA_DSN') else None
+
 class Config:
     # Clave secreta para sesiones
     SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production-2024')
@@ -18,6 +44,24 @@ class Config:
     SESSION_COOKIE_SAMESITE = 'Lax'
     SESSION_COOKIE_NAME = 'sms_auth_session'
     
+    # Fotos por página en las galerías (paginación keyset)
+    GALLERY_PAGE_SIZE = int(os.environ.get('GALLERY_PAGE_SIZE', 48))
+
+    # Segundos que las lecturas de una sesión siguen en el primario después de escribir
+    DB_REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', 10))
+
+    # Avisar (N+1) si una misma sentencia se ejecuta más de estas veces en una petición
+    SQL_REPEAT_WARN = int(os.environ.get('SQL_REPEAT_WARN', 5))
+
+    # Tokens de acceso firmados con SECRET_KEY (session_tokens.py) en lugar de aleatorios
+    SIGNED_ACCESS_TOKENS = os.environ.get('SIGNED_ACCESS_TOKENS', 'false').lower() == 'true'
+
+    # Flask-Limiter: contadores compartidos por los workers en PostgreSQL (rate_limit_storage.py);
+    # "memory://" vuelve a los contadores por proceso. Si la base de datos falla, se usa memoria
+    RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'pgpool://')
+    RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY', 'sliding-window-counter')
+    RATELIMIT_IN_MEMORY_FALLBACK_ENABLED = True
+    
     # Configuración de desarrollo
     DEBUG = True
     PORT = 5001
@@ -0,0 +1,92 @@
+"""
+Fixtures de las pruebas con PostgreSQL
+
+Las pruebas que usan la base de datos necesitan TEST_DATABASE_DSN, el DSN libpq
+de un servidor de pruebas (nunca el de producción):
+
+    TEST_DATABASE_DSN="host=localhost user=postgres dbname=postgres" python -m pytest -q
+
+Cada sesión crea una base de datos vacía, le aplica las migraciones y la borra
+al terminar (las pruebas de migraciones crean además las suyas con
+nueva_base_de_datos). Sin TEST_DATABASE_DSN esas pruebas se saltan.
+"""
+import os
+import uuid
+
+import psycopg2
+import pytest
+from psycopg2.extensions import make_dsn
+
+TEST_DATABASE_DSN = os.getenv('TEST_DATABASE_DSN')
+
+
+@pytest.fixture(scope='session')
+def nueva_base_de_datos():
+    """Fábrica de bases de datos vacías (DSN) que se borran al terminar la sesión"""
+    if not TEST_DATABASE_DSN:
+        pytest.skip('TEST_DATABASE_DSN no configurado')
+    try:
+        admin = psycopg2.connect(TEST_DATABASE_DSN)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'Servidor de pruebas no disponible: {e}')
+    admin.autocommit = True
+    creadas = []
+
+    def crear():
+        nombre = f'fotos_test_{uuid.uuid4().hex[:12]}'
+        admin.cursor().execute(f'CREATE DATABASE {nombre}')
+        creadas.append(nombre)
+        return make_dsn(TEST_DATABASE_DSN, dbname=nombre)
+
+    try:
+        yield crear
+    finally:
+        for nombre in creadas:
+            admin.cursor().execute(f'DROP DATABASE IF EXISTS {nombre} WITH (FORCE)')
+        admin.close()
+
+
+@pytest.fixture(scope='session')
+def test_database(nueva_base_de_datos):
+    """DSN de una base de datos vacía creada para esta sesión"""
+    return nueva_base_de_datos()
+
+
+@pytest.fixture(scope='session')
+def migrated_database(test_database):
+    """DSN de la base de datos de pruebas con todas las migraciones aplicadas"""
+    import migrations
+    conn = psycopg2.connect(test_database)
+    conn.autocommit = True
+    try:
+        migrations.migrar(conn)
+    finally:
+        conn.close()
+    return test_database
+
+
+@pytest.fixture
+def pool(migrated_database):
+    """Pool pequeño (2 conexiones) sobre la base de datos de pruebas"""
+    from db_pool import ConnectionPool
+    pool = ConnectionPool({'dsn': migrated_database}, minconn=0, maxconn=2, checkout_timeout=0.5,
+                          name='test')
+    yield pool
+    pool.closeall()
+
+
+@pytest.fixture
+def conn(pool):
+    """Conexión del pool (autocommit, con sentencias preparadas como en la app)"""
+    conn = pool.getconn()
+    yield conn
+    pool.putconn(conn)
+
+
+@pytest.fixture
+def user_id(conn):
+    """Usuario nuevo para la prueba"""
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO users (name, email) VALUES (%s, %s) RETURNING id',
+                   ('Prueba', f'{uuid.uuid4().hex[:12]}@example.com'))
+    return cursor.fetchone()[0]
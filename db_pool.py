@@ -0,0 +1,295 @@
+"""
+Pool de conexiones PostgreSQL por proceso (worker de gunicorn)
+
+Cada worker crea su propio pool en el hook post_fork de gunicorn.conf.py, de
+forma que ninguna conexión se comparte entre procesos forkeados. get_db() y
+close_db() en app.py piden y devuelven conexiones a este pool.
+
+Si hay réplica de lectura (DATABASE_REPLICA_DSN) cada worker tiene un segundo
+pool, REPLICA, que usa get_read_db() en app.py para las vistas de solo lectura.
+"""
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from config import DATABASE_CONFIG, DB_POOL_CONFIG, REPLICA_DATABASE_CONFIG
+from logger_config import app_logger
+from query_tracker import TrackedCursor
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """No se pudo obtener una conexión del pool dentro del tiempo límite"""
+
+
+class PooledConnection(extensions.connection):
+    """Conexión del pool; recuerda las sentencias preparadas (PREPARE) de su sesión
+    y anota las consultas en el RequestQueries de la petición que la tiene"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+        self.cursor_factory = TrackedCursor
+        self.query_tracker = None
+
+
+# Limpieza al devolver una conexión: como DISCARD ALL pero sin DEALLOCATE ALL,
+# para que las sentencias preparadas de repository.py sobrevivan entre peticiones
+RESET_SESSION_SQL = 'CLOSE ALL; RESET ALL; UNLISTEN *; SELECT pg_advisory_unlock_all(); DISCARD TEMP'
+
+
+class ConnectionPool:
+    """Pool de conexiones thread-safe con health check, reset y tiempo de vida máximo"""
+
+    def __init__(self, db_config, minconn=1, maxconn=8, max_lifetime=1800,
+                 checkout_timeout=10, health_check_after=30, name='primary'):
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self.name = name
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._idle = []  # [(conn, created_at, last_used)]
+        self._created_at = {}  # id(conn) -> created_at
+        self._size = 0  # conexiones abiertas (en uso + libres + en creación)
+        self._closed = False
+
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'broken': 0,
+            'expired': 0,
+        }
+
+        for _ in range(minconn):
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                app_logger.error(f"DB POOL {self.name} - Error creando conexión inicial: {str(e)}")
+                break
+            with self._cond:
+                self._size += 1
+                self._idle.append((conn, self._created_at[id(conn)], time.monotonic()))
+
+    def _connect(self):
+        """Abrir una conexión física nueva"""
+        params = dict(self.db_config)
+        dsn = params.pop('dsn', None)
+        params.setdefault('connect_timeout', 10)
+        if dsn is None:
+            params.setdefault('sslmode', 'require')
+        conn = psycopg2.connect(dsn, connection_factory=PooledConnection, **params)
+        conn.autocommit = True
+        now = time.monotonic()
+        with self._cond:
+            self._created_at[id(conn)] = now
+            self._stats['connections_created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        """Cerrar una conexión y liberar su hueco en el pool (llamar sin el lock)"""
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        """Comprobar la conexión antes de entregarla"""
+        if conn.closed:
+            return False
+        if conn.info.transaction_status not in (extensions.TRANSACTION_STATUS_IDLE,):
+            return False
+        # Solo hacer ping si la conexión ha estado inactiva un tiempo
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Obtener una conexión del pool, esperando si está agotado"""
+        if self._closed:
+            raise psycopg2.OperationalError(f"DB pool {self.name} cerrado")
+
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        waited = False
+
+        while True:
+            entry = None
+            must_connect = False
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        must_connect = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f"DB pool {self.name} agotado ({self.maxconn} conexiones en uso)")
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if must_connect:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                break
+
+            conn, created_at, last_used = entry
+            if self.max_lifetime and time.monotonic() - created_at > self.max_lifetime:
+                with self._cond:
+                    self._stats['expired'] += 1
+                self._discard(conn)
+                continue
+            if not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._stats['broken'] += 1
+                app_logger.warning(f"DB POOL {self.name} - Conexión rota descartada")
+                self._discard(conn)
+                continue
+            break
+
+        wait_time = time.monotonic() - start
+        with self._cond:
+            self._stats['checkouts'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """Devolver una conexión al pool, restableciendo el estado de sesión"""
+        if broken or conn.closed or self._closed or os.getpid() != self.pid:
+            if broken and not conn.closed:
+                with self._cond:
+                    self._stats['broken'] += 1
+            self._discard(conn)
+            return
+
+        conn.query_tracker = None
+        try:
+            # Deshacer transacciones abiertas y restaurar parámetros de sesión (SET ...)
+            if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(RESET_SESSION_SQL)
+        except psycopg2.Error:
+            with self._cond:
+                self._stats['broken'] += 1
+            self._discard(conn)
+            return
+
+        with self._cond:
+            created_at = self._created_at.get(id(conn), time.monotonic())
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Cerrar todas las conexiones libres y marcar el pool como cerrado"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Estadísticas del pool para dimensionarlo bajo carga"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'name': self.name,
+                'pid': self.pid,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'minconn': self.minconn,
+                'maxconn': self.maxconn,
+            })
+        stats['wait_time_avg'] = (stats['wait_time_total'] / stats['waits']) if stats['waits'] else 0.0
+        return stats
+
+
+# Pools del proceso actual: {PRIMARY: pool, REPLICA: pool (si hay réplica)}
+PRIMARY = 'primary'
+REPLICA = 'replica'
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def init_pool():
+    """Crear los pools del proceso actual (llamado desde post_fork de gunicorn)"""
+    global _pools
+    with _pool_lock:
+        primary = _pools.get(PRIMARY)
+        if primary is not None and primary.pid == os.getpid():
+            return primary
+        # Un pool heredado del proceso padre no se toca: sus sockets son del padre
+        configs = {PRIMARY: DATABASE_CONFIG}
+        if REPLICA_DATABASE_CONFIG:
+            configs[REPLICA] = REPLICA_DATABASE_CONFIG
+        _pools = {name: ConnectionPool(db_config, name=name, **DB_POOL_CONFIG)
+                  for name, db_config in configs.items()}
+        app_logger.info(
+            f"DB POOL creado en pid {os.getpid()} ({', '.join(_pools)}; "
+            f"min={DB_POOL_CONFIG['minconn']}, max={DB_POOL_CONFIG['maxconn']})")
+        return _pools[PRIMARY]
+
+
+def get_pool(name=PRIMARY):
+    """Obtener un pool del proceso, creándolos si aún no existen (servidor de desarrollo)
+
+    Devuelve None para REPLICA si no hay réplica configurada.
+    """
+    primary = _pools.get(PRIMARY)
+    if primary is None or primary.pid != os.getpid():
+        init_pool()
+    return _pools.get(name)
+
+
+def close_pool():
+    """Cerrar los pools del proceso actual (llamado al salir el worker)"""
+    global _pools
+    with _pool_lock:
+        for pool in _pools.values():
+            if pool.pid == os.getpid():
+                app_logger.info(f"DB POOL {pool.name} cerrado - Stats: {pool.stats()}")
+                pool.closeall()
+        _pools = {}
+
+
+def pool_stats(name=PRIMARY):
+    """Estadísticas de un pool del proceso actual (o None si no existe)"""
+    pool = _pools.get(name)
+    if pool is None or pool.pid != os.getpid():
+        return None
+    return pool.stats()
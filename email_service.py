@@ -1,16 +1,88 @@
 """
 Servicio de Email para autenticación
+
+Los emails no se envían dentro de la petición: send_verification_code() solo
+construye el mensaje y lo deja en la cola del worker (email_queue). Un hilo la
+vacía manteniendo abierta una única sesión SMTP autenticada (STARTTLS y login
+una sola vez, no por mensaje), reintenta los fallos transitorios con espera
+exponencial y lleva estadísticas de profundidad de cola y latencia de envío.
+
+Los cuerpos salen de templates/emails/ (Jinja), compilados una vez al importar.
+La estructura MIME del mensaje (cabeceras fijas, separadores y cabeceras de cada
+parte) se codifica una sola vez por servicio; en cada envío solo se renderizan
+el nombre, el código y la fecha y se codifican en base64 los dos cuerpos.
 """
+import base64
 import smtplib
 import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import queue
+import secrets
+import threading
+import time
+from collections import deque
+from email.header import Header
+from email.utils import formataddr, formatdate, make_msgid
 from datetime import datetime
+from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemLoader, select_autoescape
 from logger_config import (
     log_email_attempt, log_email_success, log_email_error, 
     log_smtp_config, email_logger
 )
 
+load_dotenv()
+
+# Errores que merece la pena reintentar (red, desconexiones y respuestas 4xx)
+TRANSIENT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError, OSError)
+
+
+# Plantillas de email compiladas una sola vez (sin comprobar cambios en disco)
+EMAIL_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'emails')
+_templates = Environment(loader=FileSystemLoader(EMAIL_TEMPLATES_DIR),
+                         autoescape=select_autoescape(['html']), auto_reload=False)
+VERIFICATION_HTML = _templates.get_template('verification_code.html')
+VERIFICATION_TEXT = _templates.get_template('verification_code.txt')
+
+# Asunto: la parte fija ya codificada (RFC 2047); el código va detrás en ASCII
+VERIFICATION_SUBJECT = Header('Código de verificación:', 'utf-8').encode()
+
+
+class PreparedEmail:
+    """Mensaje listo para SMTP: remitente, destinatario y bytes ya codificados"""
+
+    __slots__ = ('sender', 'to', 'data')
+
+    def __init__(self, sender, to, data):
+        self.sender = sender
+        self.to = to
+        self.data = data
+
+
+def _base64_crlf(text):
+    """Cuerpo en base64 con líneas de 76 caracteres terminadas en CRLF (SMTP)"""
+    return base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n')
+
+
+def _header_value(value):
+    """Valor de cabecera seguro: sin saltos de línea y codificado si no es ASCII"""
+    if '\r' in value or '\n' in value:
+        raise ValueError(f"Salto de línea en cabecera de email: {value!r}")
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode()
+
+
+def is_transient(error):
+    """¿Se puede reintentar el envío tras este error?"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
 class EmailService:
     def __init__(self):
         self.smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
@@ -18,109 +90,260 @@ class EmailService:
         self.smtp_email = os.getenv('SMTP_EMAIL')
         self.smtp_password = os.getenv('SMTP_PASSWORD')
         self.from_name = os.getenv('SMTP_FROM_NAME', 'Auth App')
-        
+        # SMTP_USE_TLS=false para un servidor local de pruebas (aiosmtpd) sin STARTTLS ni login
+        self.use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() == 'true'
+        self.timeout = int(os.getenv('SMTP_TIMEOUT', 30))
+        # Segundos sin enviar tras los que se cierra la sesión (Gmail corta las inactivas)
+        self.idle_timeout = int(os.getenv('SMTP_IDLE_SECONDS', 120))
+        self._server = None
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+        self._prepare_mime()
+
+    def _prepare_mime(self):
+        """Codificar una vez las partes fijas del mensaje multipart/alternative"""
+        boundary = f'=_fotos_{secrets.token_hex(12)}'  # '=_' no aparece en base64
+        self._msgid_domain = (self.smtp_email or 'localhost').rpartition('@')[2] or 'localhost'
+        self._mime_head = (
+            f'From: {formataddr((self.from_name, self.smtp_email or ""), charset="utf-8")}\r\n'
+            'MIME-Version: 1.0\r\n'
+            f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n'
+        ).encode('ascii')
+        part = (f'--{boundary}\r\n'
+                'Content-Type: text/{}; charset="utf-8"\r\n'
+                'Content-Transfer-Encoding: base64\r\n\r\n')
+        self._mime_text = ('\r\n' + part.format('plain')).encode('ascii')
+        self._mime_html = ('\r\n' + part.format('html')).encode('ascii')
+        self._mime_end = f'\r\n--{boundary}--\r\n'.encode('ascii')
+
     def is_configured(self):
         """Verificar si SMTP está configurado"""
+        if not self.use_tls:
+            return bool(self.smtp_email)
         return bool(self.smtp_email and self.smtp_password)
-    
-    def send_verification_code(self, to_email, name, code):
-        """Enviar código de verificación por email"""
+
+    def _connect(self):
+        """Abrir y autenticar una sesión SMTP"""
+        email_logger.info(f"Conectando a {self.smtp_server}:{self.smtp_port}")
+        if self.smtp_port == 465:
+            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
         try:
-            # Log del intento
-            log_email_attempt(to_email, name, code)
-            log_smtp_config(self.smtp_server, self.smtp_port, self.smtp_email, bool(self.smtp_password))
-            
-            if not self.is_configured():
-                error_msg = "SMTP no configurado - faltan credenciales"
-                log_email_error(to_email, error_msg)
-                return False
-                
-            # Crear mensaje
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = f'Código de verificación: {code}'
-            msg['From'] = f'{self.from_name} <{self.smtp_email}>'
-            msg['To'] = to_email
-            
-            # Plantilla HTML
-            html_body = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <style>
-                    body {{ font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-                    .container {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; overflow: hidden; box-shadow: 0 4px 15px rgba(0,0,0,0.1); }}
-                    .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; }}
-                    .content {{ padding: 30px; }}
-                    .code-box {{ background: #f8f9fa; border: 2px dashed #007bff; border-radius: 8px; padding: 20px; text-align: center; margin: 20px 0; }}
-                    .code {{ font-size: 32px; font-weight: bold; color: #007bff; letter-spacing: 5px; }}
-                    .footer {{ background: #f8f9fa; padding: 20px; text-align: center; color: #666; font-size: 14px; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="header">
-                        <h1>🔐 Código de Verificación</h1>
-                        <p>Hola {name}, aquí tienes tu código</p>
-                    </div>
-                    <div class="content">
-                        <p>Has solicitado acceso a tu cuenta. Usa el siguiente código para completar la verificación:</p>
-                        
-                        <div class="code-box">
-                            <div class="code">{code}</div>
-                            <p style="margin: 10px 0 0 0; color: #666;">Código de 6 dígitos</p>
-                        </div>
-                        
-                        <p><strong>⏰ Este código expira en 10 minutos</strong></p>
-                        <p>Si no solicitaste este código, puedes ignorar este email.</p>
-                    </div>
-                    <div class="footer">
-                        <p>📧 Email enviado el {datetime.now().strftime('%d/%m/%Y a las %H:%M')}</p>
-                        <p>🔒 Este es un email automático, no respondas a este mensaje</p>
-                    </div>
-                </div>
-            </body>
-            </html>
-            """
-            
-            # Versión texto plano
-            text_body = f"""
-            Código de Verificación
-            
-            Hola {name},
-            
-            Tu código de verificación es: {code}
-            
-            Este código expira en 10 minutos.
-            
-            Si no solicitaste este código, ignora este email.
-            
-            ---
-            Email enviado el {datetime.now().strftime('%d/%m/%Y a las %H:%M')}
-            """
-            
-            # Adjuntar ambas versiones
-            msg.attach(MIMEText(text_body, 'plain', 'utf-8'))
-            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
-            
-            # Enviar email
-            email_logger.info(f"Conectando a {self.smtp_server}:{self.smtp_port}")
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.ehlo()  # Identificarse primero
+            server.ehlo()  # Identificarse primero
+            if self.use_tls and self.smtp_port != 465:
                 server.starttls()  # Iniciar TLS
                 server.ehlo()  # Identificarse de nuevo después de TLS
+            if self.smtp_password:
                 server.login(self.smtp_email, self.smtp_password)
-                server.send_message(msg)
-            
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _get_server(self):
+        """Sesión SMTP reutilizable; se reabre si ha caducado o el servidor la cerró"""
+        if self._server is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+
+    def deliver(self, msg):
+        """Enviar un PreparedEmail por la sesión persistente (lanza la excepción si falla)"""
+        with self._lock:
+            for intento in (1, 2):
+                server = self._get_server()
+                try:
+                    server.sendmail(msg.sender, [msg.to], msg.data)
+                except smtplib.SMTPServerDisconnected:
+                    # El servidor cerró la sesión reutilizada: un intento más con una nueva
+                    self._discard()
+                    if intento == 2:
+                        raise
+                    continue
+                except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                    # La sesión sigue siendo válida; el error es del mensaje
+                    self._last_used = time.monotonic()
+                    raise
+                except Exception:
+                    self._discard()
+                    raise
+                self._last_used = time.monotonic()
+                return
+
+    def close(self):
+        """Cerrar la sesión SMTP (QUIT)"""
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+
+    def _discard(self):
+        server, self._server = self._server, None
+        if server is not None:
+            server.close()
+
+    def build_verification_message(self, to_email, name, code, now=None):
+        """Mensaje (texto y HTML) con el código de verificación"""
+        now = now or datetime.now()
+        context = {
+            'name': name,
+            'code': code,
+            'sent_at': now.strftime('%d/%m/%Y a las %H:%M'),
+            'app_name': self.from_name,
+        }
+        headers = (
+            f'To: {_header_value(to_email)}\r\n'
+            f'Subject: {VERIFICATION_SUBJECT} {_header_value(str(code))}\r\n'
+            f'Date: {formatdate(now.timestamp(), localtime=True)}\r\n'
+            f'Message-ID: {make_msgid(domain=self._msgid_domain)}\r\n'
+        ).encode('ascii')
+        data = b''.join((
+            self._mime_head, headers,
+            self._mime_text, _base64_crlf(VERIFICATION_TEXT.render(context)),
+            self._mime_html, _base64_crlf(VERIFICATION_HTML.render(context)),
+            self._mime_end,
+        ))
+        return PreparedEmail(self.smtp_email, to_email, data)
+
+    def send_verification_code(self, to_email, name, code):
+        """Encolar el código de verificación; True si el email queda pendiente de envío"""
+        # Log del intento
+        log_email_attempt(to_email, name, code)
+        log_smtp_config(self.smtp_server, self.smtp_port, self.smtp_email, bool(self.smtp_password))
+        return email_queue.enqueue(self.build_verification_message(to_email, name, code))
+
+
+class EmailQueue:
+    """Cola de envío del worker con un hilo que reutiliza la sesión SMTP"""
+
+    def __init__(self, service, max_attempts=5, backoff=2.0, max_backoff=60.0):
+        self.service = service
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._draining = threading.Event()  # parando: sin más esperas entre reintentos
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=200)  # (encolado -> enviado, duración del envío)
+        self._stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'retries': 0, 'last_error': None}
+
+    def enqueue(self, msg):
+        """Dejar un mensaje para el hilo de envío (no bloquea la petición)"""
+        if not self.service.is_configured():
+            log_email_error(msg.to, "SMTP no configurado - faltan credenciales")
+            return False
+        self._queue.put((msg, time.monotonic()))
+        with self._lock:
+            self._stats['enqueued'] += 1
+        self._ensure_thread()
+        return True
+
+    def stats(self):
+        """Profundidad de la cola, contadores y latencias (ms) de este worker"""
+        with self._lock:
+            latencias = list(self._latencies)
+            data = dict(self._stats)
+        data['pid'] = os.getpid()
+        data['depth'] = self._queue.qsize()
+        if latencias:
+            esperas = sorted(total for total, _ in latencias)
+            data['latency_avg_ms'] = round(sum(esperas) / len(esperas) * 1000, 1)
+            data['latency_p95_ms'] = round(esperas[min(len(esperas) - 1, int(len(esperas) * 0.95))] * 1000, 1)
+            data['send_avg_ms'] = round(sum(envio for _, envio in latencias) / len(latencias) * 1000, 1)
+        return data
+
+    def stop(self, timeout=10):
+        """Parar el hilo tras intentar vaciar la cola (salida del worker)
+
+        Lo encolado se envía sin esperas entre reintentos (un intento más como mucho);
+        lo que no sale en `timeout` segundos se da por fallido y queda en el log.
+        """
+        self._draining.set()
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+        self._stop.set()
+
+        descartados = 0
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                continue
+            log_email_error(item[0].to, "Cola de correo detenida antes de enviarlo (se descarta)")
+            descartados += 1
+        if descartados:
+            with self._lock:
+                self._stats['failed'] += descartados
+            email_logger.error(f"EMAIL QUEUE - {descartados} emails sin enviar al parar el worker {os.getpid()}")
+        self.service.close()
+
+    def _ensure_thread(self):
+        # Un hilo por proceso: el heredado de un fork no corre en el hijo
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._draining = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='email-sender', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=self.service.idle_timeout)
+            except queue.Empty:
+                # Sin correo pendiente: liberar la sesión SMTP inactiva
+                self.service.close()
+                continue
+            if item is None:
+                break
+            self._send(*item)
+
+    def _send(self, msg, enqueued_at):
+        to_email = msg.to
+        for attempt in range(1, self.max_attempts + 1):
+            inicio = time.monotonic()
+            try:
+                self.service.deliver(msg)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                with self._lock:
+                    self._stats['last_error'] = error
+                if not is_transient(e) or attempt == self.max_attempts or self._draining.is_set():
+                    log_email_error(to_email, f"{error} (intento {attempt}, se descarta)")
+                    with self._lock:
+                        self._stats['failed'] += 1
+                    return False
+                espera = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+                email_logger.warning(f"EMAIL RETRY - To: {to_email}, {error}; reintento en {espera:.1f}s")
+                with self._lock:
+                    self._stats['retries'] += 1
+                # stop() corta la espera: último intento y, si falla, se descarta
+                self._draining.wait(espera)
+                continue
+
+            ahora = time.monotonic()
+            with self._lock:
+                self._stats['sent'] += 1
+                self._latencies.append((ahora - enqueued_at, ahora - inicio))
             log_email_success(to_email)
             return True
-            
-        except Exception as e:
-            import traceback
-            traceback_str = traceback.format_exc()
-            log_email_error(to_email, f"{type(e).__name__}: {str(e)}")
-            email_logger.error(f"Traceback completo:\n{traceback_str}")
-            return False
+        return False
+
 
-# Instancia global
-email_service = EmailService()
\ No newline at end of file
+# Instancias globales
+email_service = EmailService()
+email_queue = EmailQueue(email_service, max_attempts=int(os.getenv('EMAIL_MAX_ATTEMPTS', 5)))
@@ -0,0 +1,224 @@
+"""
+Detectores de caras intercambiables
+
+FACE_DETECTOR elige el que usan el reconocimiento (recognition_jobs.py) y el
+etiquetado (app.py):
+
+    facepp   API de Face++ (por defecto): una petición HTTP por foto, con coste
+             por llamada; sus face_token caducan a las 72 horas
+    opencv   detección local en CPU con OpenCV (Haar cascade, o YuNet si
+             FACE_DETECTOR_MODEL apunta a su modelo .onnx) en un pool de
+             procesos; sin claves, sin coste y sin caducidad
+
+Todos devuelven lo mismo que Face++: una lista de
+{'face_rectangle': {'top', 'left', 'width', 'height'}, 'face_token': ...}
+([] si no hay caras) o None si la foto no se pudo analizar.
+
+FACEPP_API_URL permite apuntar a otro servidor compatible con Face++, como
+fake_facepp.py, para probar el camino remoto sin conexión.
+"""
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FACE_DETECTOR = os.getenv('FACE_DETECTOR', 'facepp').lower()
+FACEPP_API_URL = os.getenv('FACEPP_API_URL', 'https://api-us.faceplusplus.com/facepp/v3/detect')
+FACE_DETECTOR_PROCESSES = int(os.getenv('FACE_DETECTOR_PROCESSES', 2))
+FACE_DETECTOR_MODEL = os.getenv('FACE_DETECTOR_MODEL', '')  # YuNet .onnx; vacío = Haar cascade
+FACE_DETECTOR_MAX_SIDE = int(os.getenv('FACE_DETECTOR_MAX_SIDE', 1280))  # px, para detectar más rápido
+
+# Un face_token de Face++ caduca a las 72 horas si no se guarda en un FaceSet
+FACE_TOKEN_TTL = timedelta(hours=72)
+
+
+class FaceDetector:
+    """Interfaz común de los detectores"""
+
+    name = None
+    token_ttl = None  # caducidad de los face_token (None = no caducan)
+
+    def detect(self, image_url):
+        """Caras de la imagen con la forma de Face++, [] si no hay o None si falla"""
+        raise NotImplementedError
+
+    def token_expires(self, ahora=None):
+        """Fecha de caducidad de los face_token emitidos ahora (None si no caducan)"""
+        if self.token_ttl is None:
+            return None
+        return (ahora or datetime.now()) + self.token_ttl
+
+    def close(self):
+        """Liberar los recursos del detector (salida del worker)"""
+
+
+class FacePPDetector(FaceDetector):
+    """API de detección de Face++ (o un servidor compatible en api_url)"""
+
+    name = 'facepp'
+    token_ttl = FACE_TOKEN_TTL
+
+    def __init__(self, api_url=FACEPP_API_URL, timeout=15):
+        self.api_url = api_url
+        self.timeout = timeout
+
+    def detect(self, image_url):
+        api_key = os.getenv('FACEPP_API_KEY')
+        api_secret = os.getenv('FACEPP_API_SECRET')
+
+        if not api_key or not api_secret:
+            print("⚠️ Face++ credentials not configured")
+            return None
+
+        data = {
+            'api_key': api_key,
+            'api_secret': api_secret,
+            'image_url': image_url,
+            'return_attributes': 'age,gender'
+        }
+
+        try:
+            response = requests.post(self.api_url, data=data, timeout=self.timeout)
+            result = response.json()
+
+            if 'faces' in result:
+                return result['faces']
+            else:
+                print(f"⚠️ No faces detected or error: {result.get('error_message', 'Unknown')}")
+                return None
+
+        except Exception as e:
+            print(f"❌ Error in FacePPDetector.detect: {e}")
+            return None
+
+
+# Modelo de OpenCV de cada proceso del pool (lo crea _cargar_modelo al arrancar el proceso)
+_modelo = None
+
+
+def _cargar_modelo(model_path):
+    global _modelo
+    import cv2
+    cv2.setNumThreads(1)  # el paralelismo lo da el pool de procesos
+    if model_path:
+        _modelo = cv2.FaceDetectorYN.create(model_path, '', (320, 320), 0.8)
+    else:
+        _modelo = cv2.CascadeClassifier(
+            os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml'))
+
+
+def _detectar(datos, max_side):
+    """Decodificar y detectar en el proceso del pool; devuelve los rectángulos en px del original"""
+    import cv2
+    import numpy as np
+
+    yunet = not isinstance(_modelo, cv2.CascadeClassifier)
+    # Sin aplicar la orientación EXIF: los recortes (services.get_face_crops) tampoco la aplican
+    flags = (cv2.IMREAD_COLOR if yunet else cv2.IMREAD_GRAYSCALE) | cv2.IMREAD_IGNORE_ORIENTATION
+    imagen = cv2.imdecode(np.frombuffer(datos, np.uint8), flags)
+    if imagen is None:
+        raise ValueError('Imagen no válida')
+
+    alto, ancho = imagen.shape[:2]
+    escala = min(1.0, max_side / max(alto, ancho))
+    if escala < 1.0:
+        imagen = cv2.resize(imagen, (round(ancho * escala), round(alto * escala)),
+                            interpolation=cv2.INTER_AREA)
+
+    if yunet:
+        _modelo.setInputSize((imagen.shape[1], imagen.shape[0]))
+        _, caras = _modelo.detect(imagen)
+        cajas = [] if caras is None else [cara[:4] for cara in caras]
+    else:
+        imagen = cv2.equalizeHist(imagen)
+        minimo = max(24, min(imagen.shape[:2]) // 25)
+        cajas = _modelo.detectMultiScale(imagen, scaleFactor=1.1, minNeighbors=5,
+                                         minSize=(minimo, minimo))
+
+    rectangulos = []
+    for x, y, w, h in cajas:
+        left, top = max(0, int(x / escala)), max(0, int(y / escala))
+        rectangulos.append({
+            'top': top,
+            'left': left,
+            'width': min(int(w / escala), ancho - left),
+            'height': min(int(h / escala), alto - top),
+        })
+    return rectangulos
+
+
+class OpenCVDetector(FaceDetector):
+    """Detección local en CPU: descarga en el hilo que llama, decodifica y detecta en un pool de procesos"""
+
+    name = 'opencv'
+
+    def __init__(self, processes=FACE_DETECTOR_PROCESSES, model_path=FACE_DETECTOR_MODEL,
+                 max_side=FACE_DETECTOR_MAX_SIDE, timeout=15):
+        self.processes = processes
+        self.model_path = model_path
+        self.max_side = max_side
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def _get_pool(self):
+        # Un pool por proceso: el heredado de un fork no sirve en el hijo
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                # spawn y no fork: los workers de gunicorn tienen otros hilos en marcha
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_cargar_modelo, initargs=(self.model_path,))
+            return self._pool
+
+    def detect(self, image_url):
+        try:
+            response = requests.get(image_url, timeout=self.timeout)
+            if response.status_code != 200:
+                print(f"⚠️ Error downloading image: {response.status_code}")
+                return None
+            rectangulos = self._get_pool().submit(_detectar, response.content, self.max_side).result()
+        except BrokenProcessPool as e:
+            # Murió un proceso del pool: se crea otro en la siguiente detección
+            print(f"❌ Error in OpenCVDetector.detect: {e}")
+            self.close()
+            return None
+        except Exception as e:
+            print(f"❌ Error in OpenCVDetector.detect: {e}")
+            return None
+        return [{'face_rectangle': rectangulo, 'face_token': f'local_{secrets.token_hex(16)}'}
+                for rectangulo in rectangulos]
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+DETECTORES = {
+    FacePPDetector.name: FacePPDetector,
+    OpenCVDetector.name: OpenCVDetector,
+}
+
+
+def crear_detector(nombre=FACE_DETECTOR, **kwargs):
+    """Instanciar el detector configurado"""
+    try:
+        return DETECTORES[nombre](**kwargs)
+    except KeyError:
+        raise ValueError(f"FACE_DETECTOR desconocido: {nombre!r} (opciones: {', '.join(DETECTORES)})") from None
+
+
+# Instancia global
+detector = crear_detector()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Índice de embeddings de caras para sugerir nombres al etiquetar
+
+Cada cara que recorta el reconocimiento (recognition_jobs.py) se convierte en un
+vector normalizado (calcular_embedding) que se guarda en faces.embedding. Cuando
+/api/guardar-identificaciones-caras confirma quién es, su vector se añade al
+índice: una matriz float32 en FACE_INDEX_DIR, con el persona_id y el id de la
+cara de cada fila, que cada proceso abre como memmap. Las sugerencias de las
+caras nuevas salen de un solo producto de matrices (similitud coseno) contra
+todas las caras confirmadas.
+
+    python face_index.py rebuild    # reconstruir el índice desde la tabla faces
+    python face_index.py stats
+
+FACE_EMBEDDING_MODEL elige cómo se calculan los vectores:
+
+    dct      por defecto, sin dependencias: coeficientes de baja frecuencia de la
+             cara en gris ecualizada; sirve para la misma persona en fotos
+             parecidas, no para reconocer de verdad, así que sus sugerencias
+             solo se ofrecen como botones y el nombre queda vacío
+    sface    OpenCV FaceRecognizerSF con el modelo .onnx de
+             FACE_EMBEDDING_MODEL_PATH (requiere opencv-python-headless)
+
+Las filas se añaden bajo un flock, así que los workers de gunicorn comparten el
+índice; cada proceso lo vuelve a abrir cuando cambia su cabecera (index.json).
+Al cambiar de modelo hay que reconstruirlo.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import threading
+from collections import namedtuple
+from io import BytesIO
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+load_dotenv()
+
+from logger_config import app_logger, log_error
+
+FACE_INDEX_DIR = os.getenv('FACE_INDEX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'face_index'))
+FACE_EMBEDDING_MODEL = os.getenv('FACE_EMBEDDING_MODEL', 'dct').lower()
+FACE_EMBEDDING_MODEL_PATH = os.getenv('FACE_EMBEDDING_MODEL_PATH', '')  # SFace .onnx
+FACE_SUGGESTIONS = int(os.getenv('FACE_SUGGESTIONS', 3))  # personas sugeridas por cara
+FACE_SUGGESTION_MIN_SCORE = os.getenv('FACE_SUGGESTION_MIN_SCORE', '')  # vacío = el del modelo
+
+CABECERA = 'index.json'
+BLOQUEO = 'index.lock'
+EMBEDDINGS = 'embeddings.f32'
+PERSONAS = 'personas.i32'
+CARAS = 'caras.i64'
+CAPACIDAD_INICIAL = 1024
+BORRADA = -1  # persona_id de las filas sustituidas por una confirmación posterior de la misma cara
+CANDIDATOS_POR_SUGERENCIA = 20  # filas más parecidas que se miran por cada persona sugerida
+
+Sugerencia = namedtuple('Sugerencia', 'persona_id similitud')
+
+
+# ---------------------------------------------------------------------------
+# Modelos
+# ---------------------------------------------------------------------------
+
+class DCTEmbedder:
+    """Coeficientes DCT de baja frecuencia de la cara en gris ecualizada (sin el brillo medio)"""
+
+    name = 'dct'
+    lado = 64
+    coeficientes = 16
+    dims = coeficientes * coeficientes
+    umbral = 0.85  # los vectores de dos caras cualesquiera ya se parecen bastante
+    identifica = False  # no distingue personas: sus sugerencias nunca se escriben solas en el nombre
+
+    def __init__(self):
+        n = np.arange(self.lado)
+        k = np.arange(self.coeficientes)[:, None]
+        self._base = np.cos(np.pi * (2 * n + 1) * k / (2 * self.lado)).astype(np.float32)
+
+    def embed(self, imagen):
+        gris = ImageOps.equalize(imagen.convert('L')).resize((self.lado, self.lado), Image.Resampling.BILINEAR)
+        coeficientes = self._base @ (np.asarray(gris, dtype=np.float32) / 255) @ self._base.T
+        coeficientes[0, 0] = 0
+        return coeficientes.ravel()
+
+
+class SFaceEmbedder:
+    """OpenCV FaceRecognizerSF sobre el recorte (ya centrado en la cara, sin alinear)"""
+
+    name = 'sface'
+    dims = 128
+    umbral = 0.363  # umbral coseno recomendado por OpenCV para SFace
+    identifica = True
+
+    def __init__(self, model_path=FACE_EMBEDDING_MODEL_PATH):
+        if not model_path:
+            raise ValueError('FACE_EMBEDDING_MODEL=sface necesita FACE_EMBEDDING_MODEL_PATH')
+        self.model_path = model_path
+        self._local = threading.local()  # un modelo por hilo: no es seguro compartirlo
+
+    def embed(self, imagen):
+        import cv2
+        modelo = getattr(self._local, 'modelo', None)
+        if modelo is None:
+            modelo = self._local.modelo = cv2.FaceRecognizerSF.create(self.model_path, '')
+        rgb = np.asarray(imagen.convert('RGB').resize((112, 112), Image.Resampling.BILINEAR))
+        return modelo.feature(np.ascontiguousarray(rgb[:, :, ::-1])).ravel()
+
+
+EMBEDDERS = {
+    DCTEmbedder.name: DCTEmbedder,
+    SFaceEmbedder.name: SFaceEmbedder,
+}
+
+
+def crear_embedder(nombre=FACE_EMBEDDING_MODEL):
+    """Instanciar el modelo de embeddings configurado"""
+    try:
+        return EMBEDDERS[nombre]()
+    except KeyError:
+        raise ValueError(f"FACE_EMBEDDING_MODEL desconocido: {nombre!r} (opciones: {', '.join(EMBEDDERS)})") from None
+
+
+# Instancia global
+embedder = crear_embedder()
+
+
+def calcular_embedding(recorte):
+    """Vector normalizado (float32) de un recorte de cara (BytesIO, bytes o imagen PIL), o None si falla
+
+    Un BytesIO queda en la misma posición, listo para subirlo después.
+    """
+    try:
+        if isinstance(recorte, bytes):
+            recorte = BytesIO(recorte)
+        if isinstance(recorte, BytesIO):
+            posicion = recorte.tell()
+            with Image.open(recorte) as imagen:
+                vector = embedder.embed(imagen)
+            recorte.seek(posicion)
+        else:
+            vector = embedder.embed(recorte)
+        vector = np.asarray(vector, dtype=np.float32)
+        norma = np.linalg.norm(vector)
+        return vector / norma if norma > 0 else None
+    except Exception as e:
+        print(f"❌ Error in calcular_embedding: {e}")
+        return None
+
+
+def embedding_a_bytes(vector):
+    """Vector para faces.embedding (BYTEA), o None"""
+    return None if vector is None else np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def embedding_desde_bytes(datos):
+    """Vector de faces.embedding (bytes o memoryview de psycopg2), o None"""
+    return None if datos is None else np.frombuffer(bytes(datos), dtype=np.float32)
+
+
+# ---------------------------------------------------------------------------
+# Índice
+# ---------------------------------------------------------------------------
+
+class FaceIndex:
+    """Matriz de embeddings de caras confirmadas en disco, compartida por los procesos"""
+
+    def __init__(self, directorio=FACE_INDEX_DIR, modelo=None, dims=None):
+        self.directorio = directorio
+        self.modelo = modelo or embedder.name
+        self.dims = dims or embedder.dims
+        self._lock = threading.Lock()
+        self._firma = None  # (inodo, mtime) de la cabecera abierta
+        self._abrir(None)
+
+    def _ruta(self, nombre):
+        return os.path.join(self.directorio, nombre)
+
+    def _vacia(self):
+        return {'modelo': self.modelo, 'dims': self.dims, 'filas': 0, 'capacidad': 0, 'borradas': 0}
+
+    def _leer_cabecera(self):
+        """Cabecera del índice en disco, o None si no existe o es de otro modelo"""
+        try:
+            with open(self._ruta(CABECERA), encoding='utf-8') as f:
+                cabecera = json.load(f)
+        except FileNotFoundError:
+            return None
+        if (cabecera.get('modelo'), cabecera.get('dims')) != (self.modelo, self.dims):
+            app_logger.warning(f"FACE_INDEX - El índice de {self.directorio} es de otro modelo "
+                               f"({cabecera.get('modelo')}); hay que reconstruirlo")
+            return None
+        return cabecera
+
+    def _mapas(self, capacidad, modo):
+        """(embeddings, personas, caras) en disco como memmap"""
+        return (np.memmap(self._ruta(EMBEDDINGS), dtype=np.float32, mode=modo, shape=(capacidad, self.dims)),
+                np.memmap(self._ruta(PERSONAS), dtype=np.int32, mode=modo, shape=(capacidad,)),
+                np.memmap(self._ruta(CARAS), dtype=np.int64, mode=modo, shape=(capacidad,)))
+
+    def _abrir(self, cabecera):
+        if not cabecera or not cabecera['capacidad']:
+            self._cabecera = cabecera or self._vacia()
+            self._embeddings = np.empty((0, self.dims), dtype=np.float32)
+            self._personas = np.empty(0, dtype=np.int32)
+            return
+        self._embeddings, self._personas, _ = self._mapas(cabecera['capacidad'], 'r')
+        self._cabecera = cabecera
+
+    def _refrescar(self):
+        """Volver a abrir el índice si otro proceso lo ha cambiado (con self._lock)"""
+        try:
+            st = os.stat(self._ruta(CABECERA))
+            firma = (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            firma = None
+        if firma == self._firma:
+            return
+        self._firma = firma
+        self._abrir(self._leer_cabecera() if firma else None)
+
+    def _escribir_cabecera(self, cabecera):
+        temporal = self._ruta(CABECERA + '.tmp')
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(cabecera, f)
+        os.replace(temporal, self._ruta(CABECERA))
+        self._firma = None
+
+    def _bloqueo(self):
+        """flock exclusivo entre procesos para escribir el índice"""
+        os.makedirs(self.directorio, exist_ok=True)
+        bloqueo = open(self._ruta(BLOQUEO), 'a')
+        fcntl.flock(bloqueo, fcntl.LOCK_EX)
+        return bloqueo
+
+    def _crecer(self, capacidad):
+        # Solo se alarga: los memmap ya abiertos por otros procesos siguen siendo válidos
+        for nombre, bytes_fila in ((EMBEDDINGS, 4 * self.dims), (PERSONAS, 4), (CARAS, 8)):
+            with open(self._ruta(nombre), 'ab') as f:
+                f.truncate(capacidad * bytes_fila)
+
+    def agregar(self, entradas):
+        """Añadir caras confirmadas [(face_id, persona_id, embedding)]; devuelve las filas añadidas
+
+        Si una cara ya estaba en el índice (se ha vuelto a identificar), su fila
+        anterior se marca como borrada.
+        """
+        unicas = {int(cara): (int(persona), vector) for cara, persona, vector in entradas
+                  if vector is not None and len(vector) == self.dims}
+        if not unicas:
+            return 0
+        caras = np.fromiter(unicas, dtype=np.int64, count=len(unicas))
+        personas = np.array([persona for persona, _ in unicas.values()], dtype=np.int32)
+        vectores = np.stack([np.asarray(vector, dtype=np.float32) for _, vector in unicas.values()])
+
+        with self._lock, self._bloqueo():
+            cabecera = self._leer_cabecera()
+            if cabecera is None:
+                # Índice nuevo (o de otro modelo): se empieza de cero en archivos nuevos
+                self._reemplazar(self._vacia(), [], [], np.empty((0, self.dims), dtype=np.float32))
+                cabecera = self._vacia()
+            filas = cabecera['filas']
+            total = filas + len(caras)
+            if total > cabecera['capacidad']:
+                cabecera['capacidad'] = max(CAPACIDAD_INICIAL, cabecera['capacidad'] * 2, total)
+                self._crecer(cabecera['capacidad'])
+
+            mapa_embeddings, mapa_personas, mapa_caras = self._mapas(cabecera['capacidad'], 'r+')
+            repetidas = np.isin(mapa_caras[:filas], caras) & (mapa_personas[:filas] != BORRADA)
+            mapa_personas[:filas][repetidas] = BORRADA
+            mapa_embeddings[filas:total] = vectores
+            mapa_personas[filas:total] = personas
+            mapa_caras[filas:total] = caras
+            for mapa in (mapa_embeddings, mapa_personas, mapa_caras):
+                mapa.flush()
+            del mapa_embeddings, mapa_personas, mapa_caras
+
+            cabecera['filas'] = total
+            cabecera['borradas'] += int(repetidas.sum())
+            self._escribir_cabecera(cabecera)
+        return len(caras)
+
+    def _reemplazar(self, cabecera, caras, personas, vectores):
+        """Escribir el índice completo en archivos nuevos y cambiarlos de golpe (con el flock)"""
+        capacidad = cabecera['capacidad']
+        for nombre, datos, dtype in ((EMBEDDINGS, vectores, np.float32), (PERSONAS, personas, np.int32),
+                                     (CARAS, caras, np.int64)):
+            temporal = self._ruta(nombre + '.tmp')
+            datos = np.asarray(datos, dtype=dtype)
+            with open(temporal, 'wb') as f:
+                f.write(datos.tobytes())
+                f.truncate(capacidad * datos.itemsize * (self.dims if nombre == EMBEDDINGS else 1))
+            os.replace(temporal, self._ruta(nombre))
+        self._escribir_cabecera(cabecera)
+
+    def reconstruir(self, entradas):
+        """Sustituir todo el índice por [(face_id, persona_id, embedding)]; devuelve las filas"""
+        entradas = [(int(cara), int(persona), vector) for cara, persona, vector in entradas
+                    if vector is not None and len(vector) == self.dims]
+        vectores = (np.stack([np.asarray(vector, dtype=np.float32) for _, _, vector in entradas])
+                    if entradas else np.empty((0, self.dims), dtype=np.float32))
+        cabecera = self._vacia()
+        cabecera['filas'] = len(entradas)
+        cabecera['capacidad'] = max(CAPACIDAD_INICIAL, len(entradas))
+        with self._lock, self._bloqueo():
+            self._reemplazar(cabecera, [e[0] for e in entradas], [e[1] for e in entradas], vectores)
+        return len(entradas)
+
+    def sugerir(self, vectores, k=FACE_SUGGESTIONS, umbral=None):
+        """Para cada vector (o None), hasta k Sugerencia de las personas más parecidas
+
+        Todas las caras se comparan con todo el índice en un solo producto de matrices.
+        """
+        if umbral is None:
+            umbral = float(FACE_SUGGESTION_MIN_SCORE) if FACE_SUGGESTION_MIN_SCORE else embedder.umbral
+        resultado = [[] for _ in vectores]
+        validos = [i for i, vector in enumerate(vectores) if vector is not None and len(vector) == self.dims]
+        with self._lock:
+            self._refrescar()
+            filas = self._cabecera['filas']
+            borradas = self._cabecera['borradas']
+            embeddings = self._embeddings[:filas]
+            personas = self._personas[:filas]
+        if not filas or not validos or k <= 0:
+            return resultado
+
+        consultas = np.stack([np.asarray(vectores[i], dtype=np.float32) for i in validos])
+        similitudes = embeddings @ consultas.T  # (filas, caras)
+        if borradas:
+            similitudes[personas == BORRADA] = -np.inf
+
+        # Solo se ordenan las mejores filas de cada cara, no todo el índice
+        candidatos = min(filas, k * CANDIDATOS_POR_SUGERENCIA)
+        if candidatos < filas:
+            mejores = np.argpartition(similitudes, filas - candidatos, axis=0)[filas - candidatos:]
+        else:
+            mejores = np.broadcast_to(np.arange(filas)[:, None], (filas, len(validos)))
+
+        for columna, i in enumerate(validos):
+            filas_cara = mejores[:, columna]
+            puntuaciones = similitudes[filas_cara, columna]
+            vistas = set()
+            for orden in np.argsort(-puntuaciones):
+                if puntuaciones[orden] < umbral:
+                    break
+                persona = int(personas[filas_cara[orden]])
+                if persona in vistas:
+                    continue
+                vistas.add(persona)
+                resultado[i].append(Sugerencia(persona, float(puntuaciones[orden])))
+                if len(resultado[i]) == k:
+                    break
+        return resultado
+
+    def stats(self):
+        with self._lock:
+            self._refrescar()
+            cabecera = dict(self._cabecera)
+            personas = self._personas[:cabecera['filas']]
+            cabecera['personas'] = int(np.unique(personas[personas != BORRADA]).size)
+        cabecera['mb'] = round(cabecera['capacidad'] * (4 * self.dims + 12) / 1024 / 1024, 1)
+        return cabecera
+
+
+# Instancia global (se abre al primer uso y se comparte entre los procesos)
+face_index = FaceIndex()
+
+
+def indexar_confirmadas(confirmadas):
+    """Añadir al índice las caras recién identificadas (repository.CaraConfirmada)
+
+    El índice se puede reconstruir desde faces, así que un error no se propaga.
+    """
+    try:
+        return face_index.agregar([(cara.face_id, cara.persona_id, embedding_desde_bytes(cara.embedding))
+                                   for cara in confirmadas if cara.embedding_model == face_index.modelo])
+    except Exception as e:
+        log_error('indexar_confirmadas', e, f'{len(confirmadas)} caras')
+        return 0
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description='Índice de embeddings de caras para sugerir nombres')
+    parser.add_argument('comando', nargs='?', default='stats', choices=['stats', 'rebuild'])
+    args = parser.parse_args()
+
+    if args.comando == 'rebuild':
+        import db_pool
+        import repository
+        db_pool.init_pool()
+        conn = db_pool.get_pool().getconn()
+        try:
+            filas = face_index.reconstruir(
+                (cara.face_id, cara.persona_id, embedding_desde_bytes(cara.embedding))
+                for cara in repository.caras_confirmadas(conn, face_index.modelo))
+        finally:
+            db_pool.get_pool().putconn(conn)
+            db_pool.close_pool()
+        app_logger.info(f"FACE_INDEX - Índice reconstruido con {filas} caras ({face_index.modelo})")
+    print(face_index.stats())
+
+
+if __name__ == "__main__":
+    main()
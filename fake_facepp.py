@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Servidor que imita la API de detección de Face++, para probar sin conexión
+
+    python fake_facepp.py fixtures/caras                    # http://127.0.0.1:8090
+    python fake_facepp.py fixtures/caras --latency 800 --error-rate 0.05
+
+y en la app FACEPP_API_URL=http://127.0.0.1:8090/facepp/v3/detect (con
+cualquier FACEPP_API_KEY y FACEPP_API_SECRET). El directorio tiene las
+imágenes y un faces.json con sus caras:
+
+    {"familia.jpg": [{"top": 120, "left": 340, "width": 96, "height": 96}, ...]}
+
+POST /facepp/v3/detect responde como Face++: la imagen se identifica por el
+nombre de archivo de image_url (o por su contenido si llega en image_file) y
+se devuelven sus caras de faces.json con un face_token nuevo cada vez; una
+imagen del directorio sin entrada no tiene caras. Las imágenes se sirven en
+/fixtures/<archivo>, así que las fotos de prueba pueden apuntar aquí.
+--latency simula el tiempo de respuesta del servicio real y --error-rate
+devuelve CONCURRENCY_LIMIT_EXCEEDED (403) como cuando se supera la cuota.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DETECT_PATH = '/facepp/v3/detect'
+FIXTURES_PATH = '/fixtures/'
+
+
+def cargar_fixtures(directorio):
+    """({archivo: [rectángulos]}, {sha1 del contenido: archivo}) de un directorio de fixtures"""
+    ruta = os.path.join(directorio, 'faces.json')
+    caras = {}
+    if os.path.exists(ruta):
+        with open(ruta, encoding='utf-8') as f:
+            caras = json.load(f)
+    por_contenido = {}
+    for archivo in os.listdir(directorio):
+        if archivo != 'faces.json' and os.path.isfile(os.path.join(directorio, archivo)):
+            with open(os.path.join(directorio, archivo), 'rb') as f:
+                por_contenido[hashlib.sha1(f.read()).hexdigest()] = archivo
+    return caras, por_contenido
+
+
+def leer_formulario(content_type, body):
+    """Campos de un POST urlencoded o multipart: {nombre: str o bytes}"""
+    if content_type.startswith('multipart/form-data'):
+        mensaje = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        campos = {}
+        for parte in mensaje.iter_parts():
+            nombre = parte.get_param('name', header='content-disposition')
+            contenido = parte.get_payload(decode=True)
+            campos[nombre] = contenido if parte.get_filename() else contenido.decode()
+        return campos
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+
+class FakeFacePP:
+    """Servidor HTTP compatible con /facepp/v3/detect, en un hilo"""
+
+    def __init__(self, directorio, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0):
+        self.directorio = directorio
+        self.latency = latency  # segundos por petición de detección
+        self.error_rate = error_rate
+        self.caras, self.por_contenido = cargar_fixtures(directorio)
+        self.detecciones = 0  # peticiones a /facepp/v3/detect atendidas
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def detect_url(self):
+        return self.url + DETECT_PATH
+
+    def fixture_url(self, archivo):
+        return self.url + FIXTURES_PATH + archivo
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """Atender en un hilo (para benchmarks y pruebas en el mismo proceso)"""
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-facepp', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def detectar(self, campos):
+        """(status, respuesta JSON) para los campos de una petición de detección"""
+        inicio = time.perf_counter()
+        if not campos.get('api_key') or not campos.get('api_secret'):
+            return 401, {'error_message': 'AUTHENTICATION_ERROR'}
+        if self.error_rate and random.random() < self.error_rate:
+            return 403, {'error_message': 'CONCURRENCY_LIMIT_EXCEEDED'}
+
+        if 'image_url' in campos:
+            archivo = os.path.basename(unquote(urlsplit(campos['image_url']).path))
+            if not os.path.isfile(os.path.join(self.directorio, archivo)) or archivo == 'faces.json':
+                return 400, {'error_message': 'INVALID_IMAGE_URL'}
+        elif isinstance(campos.get('image_file'), bytes):
+            archivo = self.por_contenido.get(hashlib.sha1(campos['image_file']).hexdigest())
+        else:
+            return 400, {'error_message': 'MISSING_ARGUMENTS: image_url, image_file, image_base64'}
+
+        if self.latency:
+            time.sleep(self.latency)
+        atributos = campos.get('return_attributes')
+        caras = []
+        for rectangulo in self.caras.get(archivo, []):
+            cara = {'face_token': secrets.token_hex(16), 'face_rectangle': dict(rectangulo)}
+            if atributos and atributos != 'none':
+                cara['attributes'] = {'gender': {'value': 'Female'}, 'age': {'value': 30}}
+            caras.append(cara)
+        with self._lock:
+            self.detecciones += 1
+        return 200, {
+            'request_id': f'{int(time.time())},{secrets.token_hex(8)}',
+            'time_used': int((time.perf_counter() - inicio) * 1000),
+            'image_id': secrets.token_hex(11),
+            'face_num': len(caras),
+            'faces': caras,
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if urlsplit(self.path).path != DETECT_PATH:
+                    return self._json(404, {'error_message': 'API_NOT_FOUND'})
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    campos = leer_formulario(self.headers.get('Content-Type', ''), body)
+                except Exception:
+                    return self._json(400, {'error_message': 'BAD_ARGUMENTS'})
+                self._json(*fake.detectar(campos))
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                archivo = os.path.basename(unquote(path[len(FIXTURES_PATH):]))
+                ruta = os.path.join(fake.directorio, archivo)
+                if not path.startswith(FIXTURES_PATH) or not os.path.isfile(ruta):
+                    self.send_error(404)
+                    return
+                with open(ruta, 'rb') as f:
+                    datos = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def _json(self, status, datos):
+                cuerpo = json.dumps(datos).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description='Servidor falso de la API de detección de Face++')
+    parser.add_argument('fixtures', help='directorio con las imágenes y faces.json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0, help='ms por detección')
+    parser.add_argument('--error-rate', type=float, default=0, help='fracción de respuestas 403')
+    args = parser.parse_args()
+
+    fake = FakeFacePP(args.fixtures, args.host, args.port, args.latency / 1000, args.error_rate)
+    print(f"Face++ falso en {fake.detect_url} ({len(fake.caras)} imágenes con caras en faces.json)")
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Generar las imágenes de fixtures/caras y su faces.json
+
+    python fixtures/generar_caras.py            # reescribe fixtures/caras
+
+Son caras dibujadas (óvalo, pelo, cejas, ojos, nariz y boca, con desenfoque y
+ruido), no fotos: se pueden distribuir sin licencia de terceros y la etiqueta de
+cada cara es exacta, el rectángulo del óvalo dibujado. Cubren fotos de grupo,
+tamaños de cara de 28 a 260 px, tonos de piel, poca luz, caras giradas y fotos
+sin caras (para los falsos positivos). La semilla es fija: volver a generarlas
+da los mismos archivos.
+"""
+
+import json
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+DIRECTORIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'caras')
+SEMILLA = 20240501
+
+PIELES = [(232, 196, 170), (214, 176, 150), (176, 130, 98), (120, 84, 60), (88, 60, 44)]
+PELOS = [(40, 28, 20), (90, 60, 30), (160, 120, 70), (20, 20, 20), (200, 200, 200)]
+
+# (archivo, ancho, alto, fondo, [(left, top, ancho de la cara, piel, pelo, giro en grados)], brillo)
+ESCENAS = [
+    ('retrato.jpg', 640, 800, (110, 140, 170), [(200, 180, 240, 1, 0, 0)], 1.0),
+    ('pareja.jpg', 1024, 683, (170, 150, 120), [(220, 200, 180, 0, 1, 0), (600, 230, 170, 3, 3, 0)], 1.0),
+    ('grupo.jpg', 1280, 853, (80, 110, 90), [
+        (100, 200, 120, 2, 0, 0), (330, 180, 130, 0, 2, 0), (570, 210, 115, 4, 3, 0),
+        (800, 190, 125, 1, 4, 0), (1030, 220, 110, 3, 1, 0),
+    ], 1.0),
+    ('lejos.jpg', 1280, 960, (150, 170, 190), [
+        (300, 400, 48, 1, 0, 0), (500, 410, 40, 2, 1, 0), (900, 420, 28, 0, 3, 0),
+    ], 1.0),
+    ('poca_luz.jpg', 1024, 768, (60, 50, 45), [(380, 220, 200, 1, 0, 0), (700, 260, 150, 3, 3, 0)], 0.35),
+    ('giradas.jpg', 1024, 683, (140, 120, 150), [(150, 200, 170, 0, 1, 12), (600, 180, 180, 2, 0, -30)], 1.0),
+    ('primer_plano.jpg', 800, 800, (190, 190, 180), [(270, 170, 260, 4, 3, 0)], 1.0),
+    ('paisaje.jpg', 1024, 683, (120, 160, 200), [], 1.0),
+    ('mesa.jpg', 1024, 768, (150, 110, 80), [], 1.0),
+]
+
+
+def dibujar_cara(s, piel, pelo):
+    """Cara de ancho s sobre fondo transparente, con el centro del óvalo en el centro de la capa"""
+    capa = Image.new('RGBA', (round(s * 1.3), round(s * 1.6)), (0, 0, 0, 0))
+    d = ImageDraw.Draw(capa)
+    x, y = 0.15 * s, 0.2 * s
+    d.ellipse([x - 0.08 * s, y - 0.18 * s, x + 1.08 * s, y + 0.55 * s], fill=pelo)
+    d.ellipse([x, y, x + s, y + 1.2 * s], fill=piel)
+    ceja = tuple(int(c * 0.5) for c in pelo)
+    d.rectangle([x + 0.16 * s, y + 0.30 * s, x + 0.42 * s, y + 0.35 * s], fill=ceja)
+    d.rectangle([x + 0.58 * s, y + 0.30 * s, x + 0.84 * s, y + 0.35 * s], fill=ceja)
+    for ojo in (0.20, 0.60):
+        d.ellipse([x + ojo * s, y + 0.40 * s, x + (ojo + 0.20) * s, y + 0.50 * s], fill=(245, 245, 240))
+        d.ellipse([x + (ojo + 0.06) * s, y + 0.41 * s, x + (ojo + 0.14) * s, y + 0.49 * s], fill=(30, 20, 15))
+    sombra = tuple(int(c * 0.75) for c in piel)
+    d.polygon([(x + 0.5 * s, y + 0.5 * s), (x + 0.42 * s, y + 0.75 * s), (x + 0.58 * s, y + 0.75 * s)],
+              fill=sombra)
+    d.ellipse([x + 0.33 * s, y + 0.85 * s, x + 0.67 * s, y + 0.95 * s], fill=(120, 40, 40))
+    return capa
+
+
+def fondo(rng, ancho, alto, color):
+    """Degradado con manchas, para que el detector no trabaje sobre un color liso"""
+    base = np.linspace(0.8, 1.2, alto)[:, None, None] * np.array(color, float)[None, None, :]
+    imagen = Image.fromarray(np.clip(np.repeat(base, ancho, axis=1), 0, 255).astype(np.uint8))
+    d = ImageDraw.Draw(imagen)
+    for _ in range(25):
+        x, y = rng.integers(0, ancho), rng.integers(0, alto)
+        r = rng.integers(10, 120)
+        tono = tuple(int(v) for v in rng.integers(30, 230, 3))
+        if rng.random() < 0.5:
+            d.rectangle([x, y, x + r, y + r * rng.uniform(0.3, 2)], fill=tono)
+        else:
+            d.ellipse([x, y, x + r, y + r], fill=tono)
+    return imagen
+
+
+def generar(directorio=DIRECTORIO):
+    """Escribir las imágenes de ESCENAS y faces.json; devuelve las etiquetas"""
+    rng = np.random.default_rng(SEMILLA)
+    os.makedirs(directorio, exist_ok=True)
+    etiquetas = {}
+    for archivo, ancho, alto, color, caras, brillo in ESCENAS:
+        imagen = fondo(rng, ancho, alto, color)
+        rectangulos = []
+        for left, top, s, piel, pelo, giro in caras:
+            capa = dibujar_cara(s, PIELES[piel], PELOS[pelo])
+            if giro:
+                capa = capa.rotate(giro, resample=Image.BICUBIC, expand=True)
+            # El centro de la capa (también tras girarla) cae en el centro del óvalo
+            centro_x, centro_y = left + s / 2, top + 0.6 * s
+            imagen.paste(capa, (round(centro_x - capa.width / 2), round(centro_y - capa.height / 2)), capa)
+            # La etiqueta es el óvalo sin girar, centrado en la cara (como se marcaría a mano)
+            rectangulos.append({'top': int(top), 'left': int(left), 'width': int(s), 'height': int(1.2 * s)})
+        imagen = imagen.filter(ImageFilter.GaussianBlur(1.2))
+        pixeles = np.asarray(imagen, float) * brillo + rng.normal(0, 6, (alto, ancho, 3))
+        Image.fromarray(np.clip(pixeles, 0, 255).astype(np.uint8)).save(
+            os.path.join(directorio, archivo), quality=85)
+        if rectangulos:
+            etiquetas[archivo] = rectangulos
+    with open(os.path.join(directorio, 'faces.json'), 'w') as f:
+        json.dump(etiquetas, f, indent=2)
+        f.write('\n')
+    return etiquetas
+
+
+if __name__ == "__main__":
+    etiquetas = generar()
+    print(f"{len(ESCENAS)} imágenes, {sum(len(c) for c in etiquetas.values())} caras en {DIRECTORIO}")
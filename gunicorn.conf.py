@@ -1,8 +1,13 @@
 import multiprocessing
+import os
 
 # Número de workers
 workers = multiprocessing.cpu_count() * 2 + 1
 threads = 4 # Añadido para manejar más peticiones concurrentes
+# Con threads > 1 gunicorn usa workers gthread. Cada pestaña abierta mantiene un
+# hilo ocupado con /api/events (como mucho SSE_STREAM_SECONDS, luego reconecta),
+# así que cada worker acepta como mucho SSE_MAX_STREAMS canales (por defecto 2)
+# y las demás pestañas usan el sondeo HTMX. SSE_MAX_STREAMS debe ser menor que threads.
 
 # Timeouts
 timeout = 120  # 120 segundos
@@ -10,4 +15,43 @@ keepalive = 5
 
 # Logs
 accesslog = "-"
-errorlog = "-"
\ No newline at end of file
+errorlog = "-"
+
+# Pool de conexiones PostgreSQL: uno por worker, creado después del fork
+def post_fork(server, worker):
+    import db_pool
+    db_pool.init_pool()
+    # Mantenimiento en segundo plano: un hilo por worker, solo trabaja el líder
+    import maintenance
+    if maintenance.MAINTENANCE_IN_PROCESS:
+        maintenance.maintenance_scheduler.start()
+    # Comprobaciones de /ready en segundo plano (health.py)
+    from health import health_checker
+    health_checker.start()
+    # Cola de reconocimiento facial: un hilo por worker (o aparte con recognition_jobs.py)
+    import recognition_jobs
+    if recognition_jobs.RECOGNITION_IN_PROCESS:
+        recognition_jobs.recognition_worker.start()
+
+def worker_exit(server, worker):
+    import db_pool
+    from interaction_tracker import interaction_tracker
+    interaction_tracker.stop()  # volcar los días de interacción pendientes
+    from email_service import email_queue
+    email_queue.stop()  # enviar los emails encolados y cerrar la sesión SMTP
+    from maintenance import maintenance_scheduler
+    maintenance_scheduler.stop()
+    from health import health_checker
+    health_checker.stop()
+    from recognition_jobs import recognition_worker
+    recognition_worker.stop()  # un trabajo a medias lo retoma otro worker al caducar su reserva
+    from face_detectors import detector
+    detector.close()  # procesos del detector local (FACE_DETECTOR=opencv)
+    db_pool.close_pool()
+
+# Migraciones del esquema: una vez por despliegue en el master, antes de crear
+# los workers (RUN_MIGRATIONS=0 si se ejecutan aparte con `python migrations.py`)
+def on_starting(server):
+    if os.getenv('RUN_MIGRATIONS', '1') != '0':
+        import migrations
+        migrations.migrar()
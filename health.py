@@ -0,0 +1,210 @@
+"""
+Comprobaciones de dependencias para /ready, en segundo plano
+
+/health es la sonda de vida y no toca nada. /ready informa del estado del pool
+de PostgreSQL, Cloudinary, Face++ y SMTP, pero no lo calcula en la petición: un
+hilo por worker repite las comprobaciones cada READY_CHECK_INTERVAL segundos y
+/ready solo lee el último resultado, así que una sonda nunca espera a un
+servicio externo ni multiplica la carga sobre ellos.
+
+Para Cloudinary y Face++ basta con abrir una conexión TCP con su API (no gasta
+cuota); para SMTP se saluda al servidor (EHLO/NOOP) sin autenticarse. Solo la
+base de datos es imprescindible: sin ella /ready responde 503, los demás
+servicios solo marcan el estado como degradado.
+"""
+import os
+import smtplib
+import socket
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import db_pool
+from face_detectors import FACE_DETECTOR, FACEPP_API_URL
+from logger_config import app_logger
+
+READY_CHECK_INTERVAL = int(os.getenv('READY_CHECK_INTERVAL', 30))  # segundos
+READY_CHECK_TIMEOUT = float(os.getenv('READY_CHECK_TIMEOUT', 5))
+
+CLOUDINARY_HOST = 'api.cloudinary.com'
+FACEPP_HOST = urlsplit(FACEPP_API_URL).hostname
+FACEPP_PORT = urlsplit(FACEPP_API_URL).port or 443
+
+
+class CheckNotConfigured(Exception):
+    """El servicio no está configurado en este despliegue"""
+
+
+def check_database(timeout=READY_CHECK_TIMEOUT):
+    """SELECT 1 con una conexión del pool del worker"""
+    pool = db_pool.get_pool()
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor()
+        # putconn() restaura los parámetros de sesión al devolverla
+        cursor.execute('SET statement_timeout = %s', (int(timeout * 1000),))
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+    except Exception:
+        pool.putconn(conn, broken=True)
+        raise
+    pool.putconn(conn)
+    return db_pool.pool_stats()
+
+
+def check_tcp(host, port=443, timeout=READY_CHECK_TIMEOUT):
+    """Abrir y cerrar una conexión TCP con el servicio"""
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+
+
+def check_cloudinary(timeout=READY_CHECK_TIMEOUT):
+    if not os.getenv('CLOUDINARY_CLOUD_NAME'):
+        raise CheckNotConfigured('CLOUDINARY_CLOUD_NAME')
+    check_tcp(CLOUDINARY_HOST, timeout=timeout)
+
+
+def check_facepp(timeout=READY_CHECK_TIMEOUT):
+    if FACE_DETECTOR != 'facepp':
+        raise CheckNotConfigured('FACE_DETECTOR=facepp')  # se detecta en local
+    if not (os.getenv('FACEPP_API_KEY') and os.getenv('FACEPP_API_SECRET')):
+        raise CheckNotConfigured('FACEPP_API_KEY')
+    check_tcp(FACEPP_HOST, FACEPP_PORT, timeout=timeout)
+
+
+def check_smtp(timeout=READY_CHECK_TIMEOUT):
+    """Saludar al servidor SMTP sin autenticarse (no usa la sesión de email_queue)"""
+    from email_service import email_service
+    if not email_service.is_configured():
+        raise CheckNotConfigured('SMTP_EMAIL')
+    if email_service.smtp_port == 465:
+        server = smtplib.SMTP_SSL(email_service.smtp_server, email_service.smtp_port, timeout=timeout)
+    else:
+        server = smtplib.SMTP(email_service.smtp_server, email_service.smtp_port, timeout=timeout)
+    try:
+        server.ehlo()
+        server.noop()
+    finally:
+        try:
+            server.quit()
+        except smtplib.SMTPException:
+            server.close()
+
+
+class HealthChecker:
+    """Último resultado de cada comprobación, refrescado por un hilo del worker"""
+
+    def __init__(self, checks, critical=('database',), interval=READY_CHECK_INTERVAL,
+                 timeout=READY_CHECK_TIMEOUT):
+        self.checks = checks  # nombre -> función(timeout); puede devolver detalles
+        self.critical = set(critical)
+        self.interval = interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._results = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = None
+
+    def run_checks(self):
+        """Ejecutar todas las comprobaciones una vez (desde el hilo de fondo)"""
+        for name, check in self.checks.items():
+            inicio = time.perf_counter()
+            ahora = datetime.now()
+            try:
+                details = check(timeout=self.timeout)
+                status, error = 'ok', None
+            except CheckNotConfigured as e:
+                details, status, error = None, 'not_configured', f'Falta {e}'
+            except Exception as e:
+                details, status, error = None, 'error', f'{type(e).__name__}: {e}'
+            latency_ms = round((time.perf_counter() - inicio) * 1000, 1)
+
+            with self._lock:
+                previo = self._results.get(name, {})
+                if status == 'error' and previo.get('status') != 'error':
+                    app_logger.warning(f"READY - {name} no responde: {error}")
+                elif status == 'ok' and previo.get('status') == 'error':
+                    app_logger.info(f"READY - {name} vuelve a responder")
+                resultado = {
+                    'status': status,
+                    'latency_ms': latency_ms,
+                    'last_checked': ahora,
+                    'last_success': ahora if status == 'ok' else previo.get('last_success'),
+                    'error': error,
+                }
+                if details:
+                    resultado['details'] = details
+                self._results[name] = resultado
+
+    def snapshot(self):
+        """(listo, informe) a partir de los últimos resultados, sin comprobar nada"""
+        self._ensure_thread()
+        ahora = datetime.now()
+        with self._lock:
+            results = {name: dict(r) for name, r in self._results.items()}
+
+        ready = True
+        degraded = []
+        informe = {}
+        for name in self.checks:
+            r = results.get(name)
+            if r is None:
+                r = {'status': 'pending', 'latency_ms': None, 'last_checked': None,
+                     'last_success': None, 'error': None}
+            elif (ahora - r['last_checked']).total_seconds() > 3 * self.interval + self.timeout * len(self.checks):
+                # El hilo no ha refrescado el resultado: no fiarse de él
+                r['status'] = 'stale'
+            if r['status'] not in ('ok', 'not_configured'):
+                if name in self.critical:
+                    ready = False
+                else:
+                    degraded.append(name)
+            for campo in ('last_checked', 'last_success'):
+                if r[campo] is not None:
+                    r[campo] = r[campo].isoformat(timespec='seconds')
+            informe[name] = r
+
+        return ready, {
+            'status': 'ready' if ready else 'not_ready',
+            'degraded': degraded,
+            'pid': os.getpid(),
+            'checks': informe,
+        }
+
+    def start(self):
+        self._ensure_thread()
+
+    def stop(self):
+        self._stop.set()
+
+    def _ensure_thread(self):
+        # Un hilo por proceso: el heredado de un fork no corre en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='health-checker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_checks()
+            except Exception as e:
+                app_logger.error(f"READY - Error en las comprobaciones: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+
+# Instancia global
+health_checker = HealthChecker({
+    'database': check_database,
+    'cloudinary': check_cloudinary,
+    'facepp': check_facepp,
+    'smtp': check_smtp,
+})
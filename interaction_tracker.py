@@ -0,0 +1,100 @@
+"""
+Días de interacción de los usuarios, con escrituras agrupadas por worker
+
+mark() solo anota "el usuario X ha estado activo el día D" en memoria; un hilo
+del worker vuelca las marcas pendientes cada `flush_interval` segundos con un
+UPDATE por día para todos los usuarios a la vez, y gunicorn.conf.py llama a
+flush() al salir el worker. Cada usuario se escribe como mucho una vez al día
+por worker, y el UPDATE es idempotente (solo suma si la última interacción es
+de un día anterior), así que varios workers no cuentan el mismo día dos veces.
+"""
+import os
+import threading
+from datetime import datetime
+
+import db_pool
+import repository
+from logger_config import app_logger
+
+
+class InteractionTracker:
+    """Marcas de actividad pendientes de escribir en users"""
+
+    def __init__(self, flush_interval=60):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}  # (user_id, día) -> última vez visto
+        self._written = set()  # (user_id, día) ya escritos por este worker
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = None
+
+    def mark(self, user_id):
+        """Anotar actividad del usuario hoy (sin tocar la base de datos)"""
+        ahora = datetime.now()
+        key = (user_id, ahora.date())
+        with self._lock:
+            if key in self._written:
+                return
+            self._pending[key] = ahora
+        self._ensure_thread()
+
+    def flush(self):
+        """Escribir las marcas pendientes; devuelve cuántos días nuevos se sumaron"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        pool = db_pool.get_pool()
+        conn = None
+        actualizados = 0
+        try:
+            conn = pool.getconn()
+            # Un UPDATE por día, en orden, para que un usuario con días seguidos sume ambos
+            for dia in sorted({dia for _, dia in pending}):
+                visitas = [(user_id, visto) for (user_id, d), visto in pending.items() if d == dia]
+                actualizados += repository.registrar_interacciones(conn, visitas)
+        except Exception as e:
+            # Se reintentan en el siguiente volcado
+            app_logger.error(f"Error guardando días de interacción: {e}")
+            with self._lock:
+                for key, visto in pending.items():
+                    self._pending.setdefault(key, visto)
+            if conn is not None:
+                pool.putconn(conn, broken=True)
+            return 0
+        pool.putconn(conn)
+
+        hoy = datetime.now().date()
+        with self._lock:
+            self._written = {key for key in self._written if key[1] == hoy}
+            self._written.update(key for key in pending if key[1] == hoy)
+        if actualizados:
+            app_logger.info(f"Días de interacción: {actualizados} nuevos guardados")
+        return actualizados
+
+    def stop(self):
+        """Parar el hilo y volcar lo pendiente (salida del worker)"""
+        self._stop.set()
+        self.flush()
+
+    def _ensure_thread(self):
+        # Un hilo por proceso: el heredado de un fork no corre en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='interaction-tracker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+# Instancia global
+interaction_tracker = InteractionTracker(flush_interval=int(os.getenv('INTERACTION_FLUSH_SECONDS', 60)))
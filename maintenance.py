@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Mantenimiento periódico de la base de datos y de Cloudinary
+
+Purga, en lotes acotados, los códigos de verificación caducados
+(verification_codes, email_verification, email_change_requests,
+users.verification_code), las sesiones caducadas (sessions, users.access_token),
+los recortes temporales de caras que nadie guardó (carpeta temp_faces) y los
+trabajos de reconocimiento facial terminados.
+Así las tablas de autenticación se mantienen pequeñas y sus índices en caché.
+
+Se puede ejecutar aparte (cron o proceso propio):
+
+    python maintenance.py           # una pasada
+    python maintenance.py loop      # cada MAINTENANCE_INTERVAL segundos
+
+o dentro de los workers con MAINTENANCE_IN_PROCESS=true: cada worker arranca un
+hilo, pero solo el que consigue el advisory lock de PostgreSQL (el líder) hace
+el trabajo; si su conexión cae, otro worker toma el relevo.
+"""
+
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import cloudinary
+import cloudinary.api
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from config import DATABASE_CONFIG
+from logger_config import app_logger, log_database_operation
+
+cloudinary.config(
+    cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
+    api_key=os.getenv('CLOUDINARY_API_KEY'),
+    api_secret=os.getenv('CLOUDINARY_API_SECRET')
+)
+
+# Clave de pg_advisory_lock del líder de mantenimiento
+MAINTENANCE_LOCK_ID = 727002
+
+MAINTENANCE_IN_PROCESS = os.getenv('MAINTENANCE_IN_PROCESS', 'false').lower() == 'true'
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', 900))  # segundos
+BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', 500))
+MAX_BATCHES = int(os.getenv('MAINTENANCE_MAX_BATCHES', 20))  # por tarea y pasada
+TEMP_FACES_MAX_AGE = timedelta(hours=int(os.getenv('TEMP_FACES_MAX_AGE_HOURS', 24)))
+
+# (tabla, sentencia que purga como mucho %(limite)s filas caducadas antes de %(ahora)s)
+PURGAS = [
+    ('verification_codes', '''
+        DELETE FROM verification_codes
+        WHERE id IN (
+            SELECT id FROM verification_codes
+            WHERE expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    ('email_verification', '''
+        DELETE FROM email_verification
+        WHERE email IN (
+            SELECT email FROM email_verification
+            WHERE expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    ('email_change_requests', '''
+        DELETE FROM email_change_requests
+        WHERE user_id IN (
+            SELECT user_id FROM email_change_requests
+            WHERE expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    ('sessions', '''
+        DELETE FROM sessions
+        WHERE id IN (
+            SELECT id FROM sessions
+            WHERE expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    ('users.verification_code', '''
+        UPDATE users
+        SET verification_code = NULL, code_expires = NULL
+        WHERE id IN (
+            SELECT id FROM users
+            WHERE code_expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    ('users.access_token', '''
+        UPDATE users
+        SET access_token = NULL, token_expires = NULL
+        WHERE id IN (
+            SELECT id FROM users
+            WHERE token_expires <= %(ahora)s
+            LIMIT %(limite)s
+        )
+    '''),
+    # Recortes de temp_faces que purgar_recortes_temporales ya ha borrado de Cloudinary:
+    # misma fecha (el created_at de Cloudinary) y mismo reloj que allí, y un <= que
+    # suelta la URL como muy tarde cuando el recurso desaparece
+    ('faces.crop_url', f'''
+        UPDATE faces
+        SET crop_url = NULL, crop_public_id = NULL, crop_created_at = NULL
+        WHERE id IN (
+            SELECT id FROM faces
+            WHERE crop_public_id LIKE 'temp_faces/%%'
+              AND crop_created_at <= %(ahora_utc)s - INTERVAL '{int(TEMP_FACES_MAX_AGE.total_seconds())} seconds'
+            LIMIT %(limite)s
+        )
+    '''),
+    # Trabajos de reconocimiento terminados: sus recortes temporales ya no existen
+    ('recognition_jobs', f'''
+        DELETE FROM recognition_jobs
+        WHERE id IN (
+            SELECT id FROM recognition_jobs
+            WHERE status IN ('done', 'failed')
+              AND finished_at <= %(ahora)s - INTERVAL '{int(TEMP_FACES_MAX_AGE.total_seconds())} seconds'
+            LIMIT %(limite)s
+        )
+    '''),
+]
+
+
+def connect_postgres():
+    """Conexión propia (fuera del pool) para el mantenimiento"""
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    conn.autocommit = True
+    return conn
+
+
+def purgar(conn, tabla, sql, batch_size=BATCH_SIZE, max_batches=MAX_BATCHES):
+    """Ejecutar una purga por lotes (cada lote en su propia transacción); devuelve las filas"""
+    cursor = conn.cursor()
+    total = 0
+    for _ in range(max_batches):
+        cursor.execute(sql, {'ahora': datetime.now(), 'ahora_utc': datetime.now(timezone.utc),
+                             'limite': batch_size})
+        total += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            break
+    if total:
+        log_database_operation('PURGE', tabla, f'{total} filas caducadas')
+    return total
+
+
+def purgar_recortes_temporales(max_age=TEMP_FACES_MAX_AGE, max_batches=MAX_BATCHES):
+    """Borrar de Cloudinary los recortes de temp_faces más antiguos que max_age"""
+    if not os.getenv('CLOUDINARY_CLOUD_NAME'):
+        return 0
+    limite = datetime.now(timezone.utc) - max_age
+    total = 0
+    next_cursor = None
+    for _ in range(max_batches):
+        kwargs = {'next_cursor': next_cursor} if next_cursor else {}
+        page = cloudinary.api.resources(type='upload', prefix='temp_faces/', max_results=100, **kwargs)
+        viejos = [r['public_id'] for r in page.get('resources', [])
+                  if datetime.fromisoformat(r['created_at'].replace('Z', '+00:00')) < limite]
+        if viejos:
+            cloudinary.api.delete_resources(viejos)
+            total += len(viejos)
+        next_cursor = page.get('next_cursor')
+        if not next_cursor:
+            break
+    if total:
+        app_logger.info(f"MANTENIMIENTO - {total} recortes temporales borrados de Cloudinary")
+    return total
+
+
+def run_once(conn=None):
+    """Una pasada completa de mantenimiento; devuelve {tarea: filas}"""
+    propia = conn is None
+    if propia:
+        conn = connect_postgres()
+    resultado = {}
+    # Cloudinary antes que faces.crop_url: la purga de la base de datos corta más
+    # tarde, así que suelta al menos las URL de todos los recursos ya borrados
+    try:
+        resultado['temp_faces'] = purgar_recortes_temporales()
+    except Exception as e:
+        app_logger.error(f"MANTENIMIENTO - Error purgando temp_faces: {e}")
+    try:
+        for tabla, sql in PURGAS:
+            try:
+                resultado[tabla] = purgar(conn, tabla, sql)
+            except psycopg2.Error as e:
+                app_logger.error(f"MANTENIMIENTO - Error purgando {tabla}: {e}")
+    finally:
+        if propia:
+            conn.close()
+    app_logger.info(f"MANTENIMIENTO - Pasada completada: {resultado}")
+    return resultado
+
+
+class MaintenanceScheduler:
+    """Hilo de mantenimiento; solo trabaja el worker que tiene el advisory lock"""
+
+    def __init__(self, interval=MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._conn = None  # conexión que mantiene el lock mientras este worker es líder
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._conn is not None and not self._conn.closed
+
+    def _try_lead(self):
+        """Intentar ser líder; la sesión que tiene el lock lo conserva hasta cerrarse"""
+        if self.is_leader:
+            try:
+                self._conn.cursor().execute('SELECT 1')
+                return True
+            except psycopg2.Error:
+                # Conexión perdida: el lock ya no es nuestro
+                self._release()
+        try:
+            conn = connect_postgres()
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (MAINTENANCE_LOCK_ID,))
+            if cursor.fetchone()[0]:
+                self._conn = conn
+                app_logger.info(f"MANTENIMIENTO - pid {os.getpid()} es el líder")
+                return True
+            conn.close()
+        except psycopg2.Error as e:
+            app_logger.warning(f"MANTENIMIENTO - No se pudo comprobar el liderazgo: {e}")
+        return False
+
+    def tick(self):
+        """Una vuelta del planificador: pasada de mantenimiento si somos líder"""
+        if not self._try_lead():
+            return None
+        return run_once(self._conn)
+
+    def start(self):
+        """Arrancar el hilo (una vez por proceso)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._release()
+
+    def _release(self):
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    def _run(self):
+        # Desfase inicial para que los workers recién forkeados no compitan a la vez
+        if self._stop.wait(min(self.interval, 5 + os.getpid() % 30)):
+            return
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                app_logger.error(f"MANTENIMIENTO - Error en la pasada: {e}")
+            self._stop.wait(self.interval)
+
+
+# Instancia global (el hilo solo se arranca con MAINTENANCE_IN_PROCESS=true)
+maintenance_scheduler = MaintenanceScheduler()
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description='Mantenimiento de la base de datos y de Cloudinary')
+    parser.add_argument('comando', nargs='?', default='run', choices=['run', 'loop'])
+    args = parser.parse_args()
+
+    if args.comando == 'run':
+        print(run_once())
+        return
+
+    try:
+        while True:
+            resultado = maintenance_scheduler.tick()
+            if resultado is None:
+                print("Otro proceso es el líder de mantenimiento; se reintenta más tarde")
+            time.sleep(maintenance_scheduler.interval)
+    except KeyboardInterrupt:
+        maintenance_scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
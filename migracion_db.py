@@ -9,6 +9,8 @@ import os
 from datetime import datetime
 import sys
 
+import migrations
+
 # Configuración de la base de datos SQLite (origen)
 SQLITE_DB_PATH = 'users.db'
 
@@ -19,6 +21,11 @@ PG_PASSWORD = os.getenv('DATABASE_PASSWORD', 'npg_dGpMKX9j8qnm')
 PG_DATABASE = os.getenv('DATABASE_NAME', 'koyebdb')
 PG_PORT = 5432
 
+# Último esquema sin las restricciones únicas que los datos antiguos pueden violar
+# (6: personas.nombre, 10: verification_codes.email); esas migraciones fusionan los
+# duplicados, así que se aplican después de importar
+VERSION_ESQUEMA_SQLITE = 5
+
 def connect_sqlite():
     """Conectar a la base de datos SQLite"""
     try:
@@ -47,98 +54,27 @@ def connect_postgres():
         sys.exit(1)
 
 def create_tables(pg_conn):
-    """Crear las tablas en PostgreSQL"""
+    """Crear las tablas en PostgreSQL con el esquema de los datos de SQLite (VERSION_ESQUEMA_SQLITE)"""
     try:
-        cursor = pg_conn.cursor()
-        
-        # Crear tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                alias TEXT,
-                phone TEXT,
-                email TEXT,
-                access_token TEXT,
-                token_expires TIMESTAMP,
-                verification_code TEXT,
-                code_expires TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_interaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_interaction_days INTEGER DEFAULT 1
-            )
-        ''')
-        
-        # Crear tabla de sesiones
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER,
-                token TEXT UNIQUE,
-                expires TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Crear tabla de códigos de verificación
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS verification_codes (
-                id SERIAL PRIMARY KEY,
-                email TEXT NOT NULL,
-                name TEXT,
-                code TEXT NOT NULL,
-                expires TIMESTAMP NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Crear tabla de fotos
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS photos (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER NOT NULL,
-                nombre TEXT,
-                nombre_archivo TEXT NOT NULL,
-                categoria TEXT,
-                mes INTEGER,
-                año INTEGER,
-                personas_ids TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
-            )
-        ''')
-        
-        # Crear tabla de personas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS personas (
-                id SERIAL PRIMARY KEY,
-                nombre TEXT NOT NULL,
-                imagen TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Crear índices
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_token ON sessions(token)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_email ON verification_codes(email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_verification_codes_code ON verification_codes(code)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_user_id ON photos(user_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_año ON photos(año)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photos_mes ON photos(mes)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_personas_nombre ON personas(nombre)')
-        
-        pg_conn.commit()
+        posteriores = [version for version, _, applied_at in migrations.estado(pg_conn)
+                       if applied_at and version > VERSION_ESQUEMA_SQLITE]
+        if posteriores:
+            print(f"La base de datos ya tiene migraciones posteriores a la {VERSION_ESQUEMA_SQLITE} "
+                  f"({posteriores}); importar los datos de SQLite en una base de datos nueva")
+            sys.exit(1)
+        migrations.migrar(pg_conn, hasta=VERSION_ESQUEMA_SQLITE)
         print("Tablas creadas exitosamente en PostgreSQL")
     except Exception as e:
         print(f"Error creando tablas en PostgreSQL: {e}")
-        pg_conn.rollback()
+        sys.exit(1)
+
+def finish_migrations(pg_conn):
+    """Aplicar las migraciones restantes sobre los datos importados (fusionan los duplicados)"""
+    try:
+        migrations.migrar(pg_conn)
+        print("Migraciones del esquema completadas")
+    except Exception as e:
+        print(f"Error aplicando las migraciones pendientes: {e}")
         sys.exit(1)
 
 def migrate_users(sqlite_conn, pg_conn):
@@ -344,6 +280,13 @@ def main():
         migrate_verification_codes(sqlite_conn, pg_conn)
         migrate_photos(sqlite_conn, pg_conn)
         migrate_personas(sqlite_conn, pg_conn)
+
+        # Las etiquetas llegan en photos.personas_ids; copiarlas a photo_personas
+        migrations.backfill_photo_personas(pg_conn.cursor())
+        pg_conn.commit()
+
+        # Restricciones únicas y demás migraciones, ya con los datos dentro
+        finish_migrations(pg_conn)
         
         print("¡Migración completada exitosamente!")
         
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+"""
+Migraciones versionadas del esquema PostgreSQL
+
+Cada migración tiene un número de versión y se aplica una sola vez; las
+aplicadas quedan registradas en la tabla schema_migrations. Se ejecutan una vez
+por despliegue (hook on_starting de gunicorn.conf.py o a mano con la CLI),
+nunca desde los workers ni desde una petición:
+
+    python migrations.py            # aplicar las pendientes
+    python migrations.py status     # ver qué versiones están aplicadas
+
+Las migraciones con índices (Indice) no son transaccionales: cada índice se
+crea con CREATE INDEX CONCURRENTLY en autocommit, así no bloquean las
+escrituras en photos mientras se construyen en una base de datos en uso.
+Para añadir una migración basta con añadirla al final de MIGRACIONES con la
+siguiente versión; nunca se edita una migración ya desplegada.
+"""
+
+import argparse
+import json
+import sys
+import time
+from collections import namedtuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from config import DATABASE_CONFIG
+from logger_config import app_logger
+
+# Clave de pg_advisory_lock para que dos despliegues no migren a la vez
+MIGRATIONS_LOCK_ID = 727001
+# Espera entre intentos de tomar el lock (segundos)
+MIGRATIONS_LOCK_POLL = 0.5
+
+
+class Migracion(namedtuple('Migracion', 'version nombre pasos transaccional opcional')):
+    """Migración: lista de pasos (SQL, Indice o función que recibe el cursor)"""
+    __slots__ = ()
+
+    def __new__(cls, version, nombre, pasos, transaccional=True, opcional=False):
+        return super().__new__(cls, version, nombre, pasos, transaccional, opcional)
+
+
+class Indice(namedtuple('Indice', 'nombre definicion unico')):
+    """Índice creado con CREATE [UNIQUE] INDEX CONCURRENTLY IF NOT EXISTS <nombre> ON <definicion>"""
+    __slots__ = ()
+
+    def __new__(cls, nombre, definicion, unico=False):
+        return super().__new__(cls, nombre, definicion, unico)
+
+    @property
+    def sql(self):
+        unique = 'UNIQUE ' if self.unico else ''
+        return f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {self.nombre} ON {self.definicion}'
+
+
+class MigrationError(Exception):
+    """Error aplicando una migración"""
+
+
+def parse_personas_ids(value):
+    """Convertir el texto de personas_ids en lista de enteros (ignora 'null', '[]', 'None'...)"""
+    if not value or value.strip() in ('null', '[]', 'None', ''):
+        return []
+    try:
+        ids = json.loads(value)
+    except (ValueError, TypeError):
+        return []
+    if not isinstance(ids, list):
+        return []
+    result = []
+    for persona_id in ids:
+        try:
+            result.append(int(persona_id))
+        except (ValueError, TypeError):
+            continue
+    return result
+
+
+def backfill_photo_personas(cursor):
+    """Copiar las etiquetas de photos.personas_ids a photo_personas (solo si está vacía)"""
+    # La app ya no escribe personas_ids: si photo_personas ya tiene datos,
+    # volver a copiar resucitaría etiquetas que se han quitado después
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM photo_personas)')
+    if cursor.fetchone()[0]:
+        return
+
+    cursor.execute('SELECT id, personas_ids FROM photos WHERE personas_ids IS NOT NULL')
+    rows = cursor.fetchall()
+    cursor.execute('SELECT id FROM personas')
+    personas_existentes = {row[0] for row in cursor.fetchall()}
+
+    pares = {(photo_id, persona_id)
+             for photo_id, personas_ids in rows
+             for persona_id in parse_personas_ids(personas_ids)
+             if persona_id in personas_existentes}
+    if pares:
+        execute_values(cursor, '''
+            INSERT INTO photo_personas (photo_id, persona_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        ''', sorted(pares))
+    app_logger.info(f"Migradas {len(pares)} etiquetas de {len(rows)} fotos a photo_personas")
+
+
+def crear_f_unaccent(cursor):
+    """Envoltorio IMMUTABLE de unaccent() para poder indexarlo"""
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS
+        $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    ''')
+
+
+def fusionar_personas_duplicadas(cursor):
+    """Dejar una sola persona por nombre (la más antigua), pasándole las etiquetas de las demás"""
+    cursor.execute('''
+        WITH duplicadas AS (
+            SELECT id, min(id) OVER (PARTITION BY nombre) AS conservar
+            FROM personas
+        ), movidas AS (
+            INSERT INTO photo_personas (photo_id, persona_id)
+            SELECT pp.photo_id, d.conservar
+            FROM photo_personas pp
+            JOIN duplicadas d ON d.id = pp.persona_id AND d.id <> d.conservar
+            ON CONFLICT DO NOTHING
+        )
+        DELETE FROM personas pe
+        USING duplicadas d
+        WHERE pe.id = d.id AND d.id <> d.conservar
+    ''')
+    if cursor.rowcount:
+        app_logger.warning(f"Fusionadas {cursor.rowcount} personas con nombre duplicado")
+
+
+def dejar_un_codigo_por_email(cursor):
+    """Conservar solo el código más reciente de cada email en verification_codes"""
+    cursor.execute('''
+        DELETE FROM verification_codes vc
+        USING verification_codes reciente
+        WHERE reciente.email = vc.email AND reciente.id > vc.id
+    ''')
+
+
+def unificar_codigos_verificacion(cursor):
+    """Pasar los códigos vigentes de email_verification y users.verification_code a verification_codes"""
+    cursor.execute('''
+        INSERT INTO verification_codes (email, name, code, purpose, expires, created_at)
+        SELECT ev.email, ev.name, ev.code,
+               CASE WHEN EXISTS (SELECT 1 FROM users u WHERE u.email = ev.email) THEN 'login' ELSE 'register' END,
+               ev.expires, ev.created_at
+        FROM email_verification ev
+        WHERE ev.code IS NOT NULL AND ev.expires > CURRENT_TIMESTAMP
+        ON CONFLICT (email) DO NOTHING
+    ''')
+    desde_email_verification = cursor.rowcount
+    cursor.execute('''
+        INSERT INTO verification_codes (email, name, code, purpose, expires)
+        SELECT DISTINCT ON (email) email, name, verification_code, 'login', code_expires
+        FROM users
+        WHERE email IS NOT NULL AND verification_code IS NOT NULL AND code_expires > CURRENT_TIMESTAMP
+        ORDER BY email, id
+        ON CONFLICT (email) DO NOTHING
+    ''')
+    app_logger.info(f"Códigos vigentes unificados: {desde_email_verification} de email_verification, "
+                    f"{cursor.rowcount} de users")
+
+
+def pasar_sesiones_a_sessions(cursor):
+    """Copiar las sesiones abiertas de users.access_token a sessions (una fila por dispositivo)"""
+    cursor.execute('''
+        INSERT INTO sessions (user_id, token, expires, created_at)
+        SELECT id, access_token, token_expires, COALESCE(updated_at, CURRENT_TIMESTAMP)
+        FROM users
+        WHERE access_token IS NOT NULL AND access_token NOT LIKE 'v1.%'
+          AND token_expires > CURRENT_TIMESTAMP
+        ON CONFLICT (token) DO NOTHING
+    ''')
+    app_logger.info(f"Sesiones abiertas copiadas a sessions: {cursor.rowcount}")
+
+
+MIGRACIONES = [
+    Migracion(1, 'esquema_inicial', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            alias TEXT,
+            phone TEXT,
+            email TEXT,
+            access_token TEXT,
+            token_expires TIMESTAMP,
+            verification_code TEXT,
+            code_expires TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_interaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_interaction_days INTEGER DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            token TEXT UNIQUE,
+            expires TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS verification_codes (
+            id SERIAL PRIMARY KEY,
+            email TEXT NOT NULL,
+            name TEXT,
+            code TEXT NOT NULL,
+            expires TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS photos (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            nombre TEXT,
+            nombre_archivo TEXT NOT NULL,
+            categoria TEXT,
+            mes INTEGER,
+            año INTEGER,
+            personas_ids TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS personas (
+            id SERIAL PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            imagen TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS email_change_requests (
+            user_id INTEGER PRIMARY KEY,
+            new_email TEXT NOT NULL,
+            verification_code TEXT NOT NULL,
+            expires TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS email_verification (
+            email TEXT PRIMARY KEY,
+            name TEXT,
+            code TEXT,
+            expires TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+
+    Migracion(2, 'indices_basicos', [
+        Indice('idx_users_email', 'users(email)'),
+        Indice('idx_users_phone', 'users(phone)'),
+        Indice('idx_sessions_user_id', 'sessions(user_id)'),
+        Indice('idx_sessions_token', 'sessions(token)'),
+        Indice('idx_verification_codes_email', 'verification_codes(email)'),
+        Indice('idx_verification_codes_code', 'verification_codes(code)'),
+        Indice('idx_photos_user_id', 'photos(user_id)'),
+        Indice('idx_photos_año', 'photos(año)'),
+        Indice('idx_photos_mes', 'photos(mes)'),
+        Indice('idx_personas_nombre', 'personas(nombre)'),
+    ], transaccional=False),
+
+    Migracion(3, 'photo_personas', [
+        '''
+        CREATE TABLE IF NOT EXISTS photo_personas (
+            photo_id INTEGER NOT NULL,
+            persona_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (photo_id, persona_id),
+            FOREIGN KEY (photo_id) REFERENCES photos (id) ON DELETE CASCADE,
+            FOREIGN KEY (persona_id) REFERENCES personas (id) ON DELETE CASCADE
+        )
+        ''',
+        backfill_photo_personas,
+    ]),
+
+    # Paginación keyset de las galerías: mismo orden que repository.GALERIA_ORDEN
+    Migracion(4, 'indices_galeria', [
+        Indice('idx_photo_personas_persona', 'photo_personas(persona_id, photo_id)'),
+        Indice('idx_photos_galeria', '''photos (
+            (COALESCE(año, 0)) DESC, (COALESCE(mes, 0)) DESC,
+            (COALESCE(created_at, '-infinity'::timestamp)) DESC, id DESC
+        )'''),
+        Indice('idx_photos_user_galeria', '''photos (
+            user_id, (COALESCE(año, 0)) DESC, (COALESCE(mes, 0)) DESC,
+            (COALESCE(created_at, '-infinity'::timestamp)) DESC, id DESC
+        )'''),
+    ], transaccional=False),
+
+    # Búsqueda por similitud; si el servidor no tiene pg_trgm/unaccent la app
+    # usa ILIKE y esta migración se reintenta en el siguiente despliegue
+    Migracion(5, 'busqueda_trigram', [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE EXTENSION IF NOT EXISTS unaccent',
+        crear_f_unaccent,
+        Indice('idx_photos_nombre_trgm', 'photos USING gin (f_unaccent(lower(nombre)) gin_trgm_ops)'),
+        Indice('idx_personas_nombre_trgm', 'personas USING gin (f_unaccent(lower(nombre)) gin_trgm_ops)'),
+    ], transaccional=False, opcional=True),
+
+    # Nombre único: permite crear personas en bloque con ON CONFLICT (nombre).
+    # Si el índice falla por un duplicado creado entretanto, el reintento vuelve a fusionar
+    Migracion(6, 'personas_nombre_unico', [
+        fusionar_personas_duplicadas,
+        Indice('idx_personas_nombre_unico', 'personas(nombre)', unico=True),
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_personas_nombre',
+    ], transaccional=False),
+
+    # Generación de los tokens firmados (session_tokens.py): subirla los revoca
+    Migracion(7, 'token_generations', [
+        '''
+        CREATE TABLE IF NOT EXISTS token_generations (
+            user_id INTEGER PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+
+    # Purgas por lotes de maintenance.py: localizar lo caducado sin recorrer las tablas
+    Migracion(8, 'indices_caducidad', [
+        Indice('idx_verification_codes_expires', 'verification_codes(expires)'),
+        Indice('idx_email_verification_expires', 'email_verification(expires)'),
+        Indice('idx_email_change_requests_expires', 'email_change_requests(expires)'),
+        Indice('idx_sessions_expires', 'sessions(expires)'),
+        Indice('idx_users_code_expires', 'users(code_expires) WHERE code_expires IS NOT NULL'),
+        Indice('idx_users_token_expires', 'users(token_expires) WHERE token_expires IS NOT NULL'),
+    ], transaccional=False),
+
+    # Contadores de Flask-Limiter compartidos por todos los workers (rate_limit_storage.py).
+    # UNLOGGED: sin WAL ni réplica; tras una caída de PostgreSQL empiezan de cero
+    Migracion(9, 'rate_limits', [
+        '''
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            expires DOUBLE PRECISION NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits(expires)',
+    ]),
+
+    # Un único almacén de códigos (auth_service.py): un código por email, con su propósito.
+    # email_verification y users.verification_code dejan de usarse
+    Migracion(10, 'codigos_verificacion', [
+        "ALTER TABLE verification_codes ADD COLUMN IF NOT EXISTS purpose TEXT NOT NULL DEFAULT 'login'",
+        dejar_un_codigo_por_email,
+        Indice('idx_verification_codes_email_unico', 'verification_codes(email)', unico=True),
+        unificar_codigos_verificacion,
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_verification_codes_email',
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_verification_codes_code',
+    ], transaccional=False),
+
+    # Sesiones por dispositivo en sessions (la búsqueda por token usa el índice de su
+    # UNIQUE, así que idx_sessions_token sobra). users.access_token deja de usarse
+    Migracion(11, 'sesiones_por_dispositivo', [
+        pasar_sesiones_a_sessions,
+        'DROP INDEX CONCURRENTLY IF EXISTS idx_sessions_token',
+    ], transaccional=False),
+
+    # Caras detectadas por Face++ (una fila por cara): etiquetar y recortar sin volver
+    # a llamar a la API. photos.faces_detected_at distingue "sin caras" de "sin detectar"
+    Migracion(12, 'caras_detectadas', [
+        '''
+        CREATE TABLE IF NOT EXISTS faces (
+            id SERIAL PRIMARY KEY,
+            photo_id INTEGER NOT NULL,
+            face_index INTEGER NOT NULL,
+            rect_left INTEGER NOT NULL,
+            rect_top INTEGER NOT NULL,
+            rect_width INTEGER NOT NULL,
+            rect_height INTEGER NOT NULL,
+            face_token TEXT,
+            token_expires TIMESTAMP,
+            attributes JSONB,
+            crop_url TEXT,
+            crop_public_id TEXT,
+            persona_id INTEGER,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (photo_id, face_index),
+            FOREIGN KEY (photo_id) REFERENCES photos (id) ON DELETE CASCADE,
+            FOREIGN KEY (persona_id) REFERENCES personas (id) ON DELETE SET NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_faces_persona_id ON faces(persona_id) WHERE persona_id IS NOT NULL',
+        'ALTER TABLE photos ADD COLUMN IF NOT EXISTS faces_detected_at TIMESTAMP',
+    ]),
+    # Cola de trabajos de reconocimiento facial (recognition_jobs.py): los workers
+    # toman los trabajos con FOR UPDATE SKIP LOCKED y anotan el progreso por foto
+    Migracion(13, 'cola_reconocimiento', [
+        '''
+        CREATE TABLE IF NOT EXISTS recognition_jobs (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            locked_until TIMESTAMP,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_recognition_jobs_pendientes
+        ON recognition_jobs(id) WHERE status IN ('queued', 'running')
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_recognition_jobs_user_id ON recognition_jobs(user_id)',
+        '''
+        CREATE TABLE IF NOT EXISTS recognition_job_photos (
+            job_id INTEGER NOT NULL,
+            photo_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            caras JSONB,
+            finished_at TIMESTAMP,
+            PRIMARY KEY (job_id, photo_id),
+            FOREIGN KEY (job_id) REFERENCES recognition_jobs (id) ON DELETE CASCADE,
+            FOREIGN KEY (photo_id) REFERENCES photos (id) ON DELETE CASCADE
+        )
+        ''',
+    ]),
+    # Vector de cada cara recortada (face_index.py): con él se reconstruye el índice
+    # de sugerencias y se añade al índice cuando se confirma quién es
+    Migracion(14, 'embeddings_caras', [
+        'ALTER TABLE faces ADD COLUMN IF NOT EXISTS embedding BYTEA',
+        'ALTER TABLE faces ADD COLUMN IF NOT EXISTS embedding_model TEXT',
+    ]),
+    # Fecha de subida del recorte según Cloudinary: maintenance.py caduca la URL y
+    # el recurso de temp_faces con la misma fecha (updated_at cambia al re-detectar)
+    Migracion(15, 'fecha_recorte_caras', [
+        'ALTER TABLE faces ADD COLUMN IF NOT EXISTS crop_created_at TIMESTAMPTZ',
+        'UPDATE faces SET crop_created_at = updated_at WHERE crop_url IS NOT NULL AND crop_created_at IS NULL',
+    ]),
+]
+
+
+def connect_postgres():
+    """Conexión propia (fuera del pool) para migrar"""
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    conn.autocommit = True
+    return conn
+
+
+def crear_tabla_migraciones(cursor):
+    """Crear schema_migrations si no existe"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            duracion_ms INTEGER,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def versiones_aplicadas(cursor):
+    """Devolver {version: applied_at} de las migraciones ya aplicadas"""
+    cursor.execute('SELECT version, applied_at FROM schema_migrations ORDER BY version')
+    return dict(cursor.fetchall())
+
+
+def _crear_indice(cursor, indice):
+    """Crear un índice sin bloquear la tabla, descartando antes uno INVALID de un intento fallido"""
+    cursor.execute('''
+        SELECT NOT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_catalog.pg_table_is_visible(c.oid)
+    ''', (indice.nombre,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        app_logger.warning(f"Índice {indice.nombre} inválido (CONCURRENTLY interrumpido); se vuelve a crear")
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {indice.nombre}')
+    cursor.execute(indice.sql)
+
+
+def _ejecutar_paso(cursor, paso):
+    if isinstance(paso, Indice):
+        _crear_indice(cursor, paso)
+    elif callable(paso):
+        paso(cursor)
+    else:
+        cursor.execute(paso)
+
+
+def aplicar_migracion(conn, migracion):
+    """Aplicar una migración y registrarla en schema_migrations"""
+    if migracion.transaccional and any(isinstance(p, Indice) for p in migracion.pasos):
+        raise MigrationError(f"{migracion.version}: CREATE INDEX CONCURRENTLY requiere transaccional=False")
+
+    inicio = time.monotonic()
+    cursor = conn.cursor()
+    if migracion.transaccional:
+        cursor.execute('BEGIN')
+        try:
+            for paso in migracion.pasos:
+                _ejecutar_paso(cursor, paso)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+    else:
+        # Autocommit: cada paso debe ser idempotente (IF NOT EXISTS) para poder reintentarlo
+        for paso in migracion.pasos:
+            _ejecutar_paso(cursor, paso)
+
+    duracion_ms = int((time.monotonic() - inicio) * 1000)
+    cursor.execute('''
+        INSERT INTO schema_migrations (version, nombre, duracion_ms)
+        VALUES (%s, %s, %s)
+    ''', (migracion.version, migracion.nombre, duracion_ms))
+    if migracion.transaccional:
+        cursor.execute('COMMIT')
+    return duracion_ms
+
+
+def tomar_lock_migraciones(cursor):
+    """Esperar el advisory lock de las migraciones con pg_try_advisory_lock.
+
+    pg_advisory_lock dejaría abierta la transacción del que espera, y CREATE INDEX
+    CONCURRENTLY del que migra espera a que terminen todas las transacciones:
+    Postgres lo detecta como deadlock y aborta a uno de los dos.
+    """
+    avisado = False
+    while True:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+        if cursor.fetchone()[0]:
+            return
+        if not avisado:
+            app_logger.info("Otro proceso está migrando; esperando el lock de migraciones")
+            avisado = True
+        time.sleep(MIGRATIONS_LOCK_POLL)
+
+
+def migrar(conn=None, hasta=None):
+    """Aplicar las migraciones pendientes en orden (hasta la versión `hasta` incluida,
+    si se indica); devuelve las versiones aplicadas"""
+    propia = conn is None
+    if propia:
+        conn = connect_postgres()
+    if not conn.autocommit:
+        conn.commit()
+        conn.autocommit = True
+
+    aplicadas = []
+    cursor = conn.cursor()
+    try:
+        tomar_lock_migraciones(cursor)
+        try:
+            crear_tabla_migraciones(cursor)
+            ya_aplicadas = versiones_aplicadas(cursor)
+            for migracion in MIGRACIONES:
+                if hasta is not None and migracion.version > hasta:
+                    break
+                if migracion.version in ya_aplicadas:
+                    continue
+                try:
+                    duracion_ms = aplicar_migracion(conn, migracion)
+                except psycopg2.Error as e:
+                    if not migracion.opcional:
+                        raise MigrationError(f"Migración {migracion.version} ({migracion.nombre}): {e}") from e
+                    app_logger.warning(f"Migración opcional {migracion.version} ({migracion.nombre}) "
+                                       f"no aplicada: {str(e).splitlines()[0]}")
+                    continue
+                aplicadas.append(migracion.version)
+                app_logger.info(f"Migración {migracion.version} ({migracion.nombre}) aplicada en {duracion_ms} ms")
+        finally:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+    finally:
+        if propia:
+            conn.close()
+
+    if not aplicadas:
+        app_logger.info("Esquema al día, no hay migraciones pendientes")
+    return aplicadas
+
+
+def estado(conn=None):
+    """Devolver [(version, nombre, applied_at o None)] de todas las migraciones"""
+    propia = conn is None
+    if propia:
+        conn = connect_postgres()
+    try:
+        cursor = conn.cursor()
+        crear_tabla_migraciones(cursor)
+        ya_aplicadas = versiones_aplicadas(cursor)
+    finally:
+        if propia:
+            conn.close()
+    return [(m.version, m.nombre, ya_aplicadas.get(m.version)) for m in MIGRACIONES]
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description='Migraciones del esquema PostgreSQL')
+    parser.add_argument('comando', nargs='?', default='upgrade', choices=['upgrade', 'status'])
+    args = parser.parse_args()
+
+    try:
+        if args.comando == 'status':
+            for version, nombre, applied_at in estado():
+                marca = applied_at.strftime('%Y-%m-%d %H:%M') if applied_at else 'pendiente'
+                print(f"{version:4d}  {nombre:<24} {marca}")
+        else:
+            aplicadas = migrar()
+            print(f"Migraciones aplicadas: {aplicadas}" if aplicadas else "Esquema al día")
+    except (MigrationError, psycopg2.Error) as e:
+        print(f"Error durante la migración: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
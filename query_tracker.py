@@ -0,0 +1,94 @@
+"""
+Instrumentación SQL por petición
+
+Las conexiones del pool (db_pool.PooledConnection) crean cursores TrackedCursor.
+Cuando get_db()/get_read_db() asignan a la conexión un RequestQueries, cada
+execute() queda anotado con su duración y su sentencia normalizada; al final de
+la petición app.py escribe el resumen en el log y en la cabecera Server-Timing,
+y avisa si una misma sentencia se repite demasiadas veces (patrón N+1).
+"""
+import re
+import time
+
+from psycopg2 import extensions
+
+_LITERALES = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTAS = re.compile(r'\(\s*(?:(?:%s|\?)\s*,\s*)+(?:%s|\?)\s*\)')
+_ESPACIOS = re.compile(r'\s+')
+_EXECUTE = re.compile(r'^\s*EXECUTE\s+(\w+)')
+
+# Nombre de sentencia preparada -> SQL original (lo rellena repository.ejecutar)
+PREPARED_SQL = {}
+
+
+def normalizar_sql(sql):
+    """Sentencia sin literales ni espacios sobrantes, para agrupar repeticiones"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    # EXECUTE repo_xxx (...) se agrupa y se muestra con el SQL que preparó
+    execute = _EXECUTE.match(sql)
+    if execute and execute.group(1) in PREPARED_SQL:
+        sql = PREPARED_SQL[execute.group(1)]
+    sql = _LITERALES.sub('?', sql)
+    sql = _LISTAS.sub('(...)', sql)
+    return _ESPACIOS.sub(' ', sql).strip()
+
+
+class RequestQueries:
+    """Consultas ejecutadas durante una petición"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = (0.0, None)  # (segundos, sentencia normalizada)
+        self.patterns = {}  # sentencia normalizada -> [veces, segundos]
+
+    def record(self, sql, duracion):
+        sql = normalizar_sql(sql)
+        self.count += 1
+        self.total += duracion
+        if duracion >= self.slowest[0]:
+            self.slowest = (duracion, sql)
+        pattern = self.patterns.setdefault(sql, [0, 0.0])
+        pattern[0] += 1
+        pattern[1] += duracion
+
+    def repeated(self, threshold):
+        """[(sentencia, veces, ms)] de las sentencias ejecutadas más de `threshold` veces"""
+        return sorted(((sql, veces, total * 1000)
+                       for sql, (veces, total) in self.patterns.items() if veces > threshold),
+                      key=lambda item: -item[1])
+
+    def server_timing(self):
+        """Valor de la cabecera Server-Timing"""
+        return f'db;desc="{self.count} queries";dur={self.total * 1000:.2f}'
+
+
+class TrackedCursor(extensions.cursor):
+    """Cursor que anota cada sentencia en el RequestQueries de su conexión"""
+
+    def execute(self, query, vars=None):
+        tracker = getattr(self.connection, 'query_tracker', None)
+        if tracker is None:
+            return super().execute(query, vars)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            tracker.record(self._texto(query), time.perf_counter() - inicio)
+
+    def executemany(self, query, vars_list):
+        tracker = getattr(self.connection, 'query_tracker', None)
+        if tracker is None:
+            return super().executemany(query, vars_list)
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            tracker.record(self._texto(query), time.perf_counter() - inicio)
+
+    def _texto(self, query):
+        # psycopg2.sql.Composed y similares
+        if isinstance(query, (str, bytes)):
+            return query
+        return query.as_string(self)
@@ -0,0 +1,186 @@
+"""
+Almacenamiento de Flask-Limiter compartido entre workers (storage_uri="pgpool://")
+
+Con "memory://" cada worker de gunicorn cuenta por su cuenta, así que un límite
+de "5 per minute" se multiplica por el número de workers. Aquí los contadores
+viven en la tabla UNLOGGED rate_limits de PostgreSQL (sin WAL: si el servidor
+cae se pierden, lo que para un rate limit es aceptable), se usan las conexiones
+del pool del worker y cada comprobación es una sola sentencia preparada.
+
+Soporta las estrategias fixed-window y sliding-window-counter. Las claves
+caducadas se borran por lotes como mucho una vez cada EVICT_INTERVAL segundos
+por worker.
+"""
+import threading
+import time
+from math import floor
+
+import psycopg2
+from limits.storage import SlidingWindowCounterSupport, Storage
+from limits.storage.base import TimestampedSlidingWindow
+
+import db_pool
+import repository
+from logger_config import app_logger
+
+EVICT_INTERVAL = 60  # segundos
+EVICT_BATCH = 1000
+
+# Incremento de una ventana fija: si la clave ha caducado se reinicia.
+# Parámetros: key, amount, expires nuevo, now, now
+_INCR_SQL = '''
+    INSERT INTO rate_limits (key, count, expires)
+    VALUES (%s, %s::integer, %s::float8)
+    ON CONFLICT (key) DO UPDATE SET
+        count = CASE WHEN rate_limits.expires <= %s::float8 THEN EXCLUDED.count
+                     ELSE rate_limits.count + EXCLUDED.count END,
+        expires = CASE WHEN rate_limits.expires <= %s::float8 THEN EXCLUDED.expires
+                       ELSE rate_limits.expires END
+    RETURNING count
+'''
+
+# Ventana deslizante: solo incrementa la ventana actual si el peso de la anterior
+# más la actual deja sitio; devuelve (contador anterior, contador actual) o nada.
+# Parámetros: previous, now, current, now, current, amount, expires nuevo,
+# weight, amount, limit, now, now
+_SLIDING_SQL = '''
+    WITH ventanas AS (
+        SELECT
+            COALESCE((SELECT count FROM rate_limits
+                      WHERE key = %s AND expires > %s::float8), 0) AS previous_count,
+            COALESCE((SELECT count FROM rate_limits
+                      WHERE key = %s AND expires > %s::float8), 0) AS current_count
+    )
+    INSERT INTO rate_limits (key, count, expires)
+    SELECT %s, %s::integer, %s::float8
+    FROM ventanas
+    WHERE floor(previous_count * %s::float8 + current_count) + %s::integer <= %s::integer
+    ON CONFLICT (key) DO UPDATE SET
+        count = CASE WHEN rate_limits.expires <= %s::float8 THEN EXCLUDED.count
+                     ELSE rate_limits.count + EXCLUDED.count END,
+        expires = CASE WHEN rate_limits.expires <= %s::float8 THEN EXCLUDED.expires
+                       ELSE rate_limits.expires END
+    RETURNING (SELECT previous_count FROM ventanas), count
+'''
+
+
+class PostgresStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """Contadores de rate limit en la tabla rate_limits (ver migrations.py)"""
+
+    STORAGE_SCHEME = ['pgpool']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        self._evict_lock = threading.Lock()
+        self._next_evict = 0.0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return psycopg2.Error
+
+    def _execute(self, sql, params=(), fetch=True):
+        """Ejecutar una sentencia (preparada) con una conexión del pool del worker"""
+        pool = db_pool.get_pool()
+        conn = pool.getconn()
+        try:
+            cursor = conn.cursor()
+            repository.ejecutar(cursor, sql, params, preparada=True)
+            return cursor.fetchone() if fetch else cursor.rowcount
+        except psycopg2.OperationalError:
+            pool.putconn(conn, broken=True)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                pool.putconn(conn)
+
+    def _maybe_evict(self, now):
+        # Un solo hilo del worker purga, y como mucho una vez por intervalo
+        if now < self._next_evict or not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_evict = now + EVICT_INTERVAL
+            borradas = self._execute('''
+                DELETE FROM rate_limits
+                WHERE key IN (SELECT key FROM rate_limits WHERE expires <= %s::float8 LIMIT %s::integer)
+            ''', (now, EVICT_BATCH), fetch=False)
+            if borradas:
+                app_logger.info(f"RATE LIMIT - {borradas} claves caducadas borradas")
+        except psycopg2.Error as e:
+            app_logger.warning(f"RATE LIMIT - Error purgando claves caducadas: {e}")
+        finally:
+            self._evict_lock.release()
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        self._maybe_evict(now)
+        return self._execute(_INCR_SQL, (key, amount, now + expiry, now, now))[0]
+
+    def decr(self, key, amount=1):
+        row = self._execute('''
+            UPDATE rate_limits SET count = GREATEST(count - %s::integer, 0)
+            WHERE key = %s AND expires > %s::float8
+            RETURNING count
+        ''', (amount, key, time.time()))
+        return row[0] if row else 0
+
+    def get(self, key):
+        row = self._execute('SELECT count FROM rate_limits WHERE key = %s AND expires > %s::float8',
+                            (key, time.time()))
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._execute('SELECT expires FROM rate_limits WHERE key = %s AND expires > %s::float8', (key, now))
+        return row[0] if row else now
+
+    def clear(self, key):
+        self._execute('DELETE FROM rate_limits WHERE key = %s', (key,), fetch=False)
+
+    def reset(self):
+        return self._execute('DELETE FROM rate_limits', fetch=False)
+
+    def check(self):
+        try:
+            return self._execute('SELECT 1')[0] == 1
+        except psycopg2.Error:
+            return False
+
+    # --- sliding-window-counter ---
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        self._maybe_evict(now)
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        weight = self._previous_weight(expiry, now)
+        # La ventana actual se guarda el doble de su duración: luego cuenta como anterior
+        row = self._execute(_SLIDING_SQL, (previous_key, now, current_key, now, current_key, amount,
+                                           now + 2 * expiry, weight, amount, limit, now, now))
+        if row is None:
+            return False
+        previous_count, current_count = row
+        if floor(previous_count * weight + current_count) > limit:
+            # Otro worker ganó la carrera entre la lectura y el incremento
+            self.decr(current_key, amount)
+            return False
+        return True
+
+    def get_sliding_window(self, key, expiry):
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self.get(previous_key)
+        current_count = self.get(current_key)
+        previous_ttl = self._previous_weight(expiry, now) * expiry if previous_count else 0.0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def clear_sliding_window(self, key, expiry):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, time.time())
+        self._execute('DELETE FROM rate_limits WHERE key IN (%s, %s)', (previous_key, current_key), fetch=False)
+
+    @staticmethod
+    def _previous_weight(expiry, now):
+        """Fracción de la ventana anterior que aún cuenta"""
+        return 1 - (((now - expiry) / expiry) % 1)
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+Cola de trabajos de reconocimiento facial en PostgreSQL
+
+/api/procesar-reconocimiento-facial ya no detecta, recorta ni sube nada durante
+la petición: encola un trabajo (una fila en recognition_jobs y una por foto en
+recognition_job_photos) y devuelve su id. Un worker lo toma con
+SELECT ... FOR UPDATE SKIP LOCKED, así varios workers reparten la cola sin
+esperarse ni tomar dos veces el mismo trabajo, y anota cada foto al terminarla;
+procesando_reconocimiento.html consulta /api/reconocimiento/<id> hasta que el
+trabajo acaba y entonces muestra las caras para etiquetar, cada una con los
+nombres que sugiere el índice de embeddings (face_index.py).
+
+    python recognition_jobs.py          # worker aparte (RECOGNITION_IN_PROCESS=false)
+    python recognition_jobs.py once     # vaciar la cola y salir
+
+o dentro de los workers de gunicorn con RECOGNITION_IN_PROCESS=true (un hilo por
+worker). Cada trabajo tomado queda reservado RECOGNITION_LEASE_SECONDS y la
+reserva se renueva con cada foto terminada y, mientras se procesa, desde un hilo
+(Latido) cada cuarto de reserva: una foto de grupo puede tardar más que la
+reserva entera. Si el worker muere, otro lo retoma al caducar (solo las fotos
+pendientes), hasta RECOGNITION_MAX_ATTEMPTS veces.
+"""
+
+import argparse
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import psycopg2
+
+import db_pool
+import repository
+from logger_config import app_logger, log_database_operation, log_user_action
+from repository import ejecutar, instrumentada
+from face_detectors import detector
+from face_index import calcular_embedding, embedder, embedding_a_bytes, face_index
+from services import get_face_crops, upload_temp_face_crop
+
+RECOGNITION_IN_PROCESS = os.getenv('RECOGNITION_IN_PROCESS', 'true').lower() == 'true'
+RECOGNITION_POLL_SECONDS = float(os.getenv('RECOGNITION_POLL_SECONDS', 2))
+RECOGNITION_LEASE = timedelta(seconds=int(os.getenv('RECOGNITION_LEASE_SECONDS', 120)))
+RECOGNITION_MAX_ATTEMPTS = int(os.getenv('RECOGNITION_MAX_ATTEMPTS', 3))
+RECOGNITION_HEARTBEAT = RECOGNITION_LEASE / 4  # renovación de la reserva durante el trabajo
+RECOGNITION_THREADS = 3  # fotos en paralelo por trabajo, para no sobrecargar Face++ y Cloudinary
+
+# Estados de recognition_jobs y recognition_job_photos
+EN_COLA = 'queued'
+EN_CURSO = 'running'
+TERMINADO = 'done'
+FALLIDO = 'failed'
+PENDIENTE = 'pending'
+ERROR = 'error'
+
+Trabajo = namedtuple('Trabajo', 'id user_id attempts')
+FotoTrabajo = namedtuple('FotoTrabajo', 'id nombre nombre_archivo')
+EstadoTrabajo = namedtuple('EstadoTrabajo', 'id status error total terminadas caras fotos')
+
+
+def deteccion_vigente(caras, ahora=None):
+    """Si una detección guardada sirve: existe y no ha caducado ningún face_token"""
+    ahora = ahora or datetime.now()
+    return caras is not None and all(
+        cara.token_expires is None or cara.token_expires > ahora for cara in caras)
+
+
+def caras_como_facepp(caras):
+    """Filas de faces con la forma de las caras que devuelven los detectores"""
+    return [{'face_rectangle': cara.face_rectangle, 'face_token': cara.face_token} for cara in caras]
+
+
+# ---------------------------------------------------------------------------
+# Cola
+# ---------------------------------------------------------------------------
+
+@instrumentada
+def encolar(conn, user_id, foto_ids):
+    """Crear un trabajo con esas fotos (ya comprobadas como del usuario); devuelve su id"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH trabajo AS (
+            INSERT INTO recognition_jobs (user_id, status, created_at)
+            VALUES (%s, 'queued', %s)
+            RETURNING id
+        ), fotos AS (
+            INSERT INTO recognition_job_photos (job_id, photo_id, position)
+            SELECT trabajo.id, f.photo_id, f.position
+            FROM trabajo, unnest(%s::int[]) WITH ORDINALITY AS f(photo_id, position)
+        )
+        SELECT id FROM trabajo
+    ''', (user_id, datetime.now(), [int(foto_id) for foto_id in foto_ids]), preparada=True)
+    job_id = cursor.fetchone()[0]
+    log_database_operation('INSERT', 'recognition_jobs', f'Trabajo {job_id} con {len(foto_ids)} fotos')
+    return job_id
+
+
+@instrumentada
+def tomar_trabajo(conn, ahora=None):
+    """Reservar el trabajo más antiguo libre (en cola o con la reserva caducada), o None"""
+    ahora = ahora or datetime.now()
+    cursor = conn.cursor()
+    # Los que ya agotaron sus intentos no se vuelven a tomar
+    ejecutar(cursor, '''
+        UPDATE recognition_jobs
+        SET status = 'failed', error = 'Demasiados intentos', finished_at = %s, locked_until = NULL
+        WHERE status = 'running' AND locked_until < %s AND attempts >= %s
+    ''', (ahora, ahora, RECOGNITION_MAX_ATTEMPTS), preparada=True)
+    ejecutar(cursor, '''
+        UPDATE recognition_jobs j
+        SET status = 'running', attempts = j.attempts + 1, locked_until = %s,
+            started_at = COALESCE(j.started_at, %s)
+        WHERE j.id = (
+            SELECT id FROM recognition_jobs
+            WHERE status = 'queued' OR (status = 'running' AND locked_until < %s)
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING j.id, j.user_id, j.attempts
+    ''', (ahora + RECOGNITION_LEASE, ahora, ahora), preparada=True)
+    row = cursor.fetchone()
+    return Trabajo._make(row) if row else None
+
+
+@instrumentada
+def fotos_pendientes(conn, trabajo):
+    """Fotos del trabajo que aún no se han procesado, en el orden en que se pidieron"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT p.id, p.nombre, p.nombre_archivo
+        FROM recognition_job_photos jp
+        JOIN photos p ON p.id = jp.photo_id AND p.user_id = %s
+        WHERE jp.job_id = %s AND jp.status = 'pending'
+        ORDER BY jp.position
+    ''', (trabajo.user_id, trabajo.id), preparada=True)
+    return [FotoTrabajo._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def terminar_foto(conn, trabajo, foto_id, status, caras):
+    """Anotar una foto terminada y renovar la reserva; False si el trabajo ya no es nuestro"""
+    ahora = datetime.now()
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH reserva AS (
+            UPDATE recognition_jobs SET locked_until = %s
+            WHERE id = %s AND attempts = %s AND status = 'running'
+            RETURNING id
+        )
+        UPDATE recognition_job_photos jp
+        SET status = %s, caras = %s::jsonb, finished_at = %s
+        FROM reserva
+        WHERE jp.job_id = reserva.id AND jp.photo_id = %s
+    ''', (ahora + RECOGNITION_LEASE, trabajo.id, trabajo.attempts,
+          status, json.dumps(caras), ahora, foto_id), preparada=True)
+    return cursor.rowcount > 0
+
+
+@instrumentada
+def renovar_reserva(conn, trabajo):
+    """Alargar la reserva del trabajo; False si ya no es nuestro (caducó y otro lo tomó)"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE recognition_jobs SET locked_until = %s
+        WHERE id = %s AND attempts = %s AND status = 'running'
+    ''', (datetime.now() + RECOGNITION_LEASE, trabajo.id, trabajo.attempts), preparada=True)
+    return cursor.rowcount > 0
+
+
+@instrumentada
+def terminar_trabajo(conn, trabajo, error=None):
+    """Marcar el trabajo como terminado (o fallido) si sigue reservado por nosotros"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE recognition_jobs
+        SET status = %s, error = %s, finished_at = %s, locked_until = NULL
+        WHERE id = %s AND attempts = %s AND status = 'running'
+    ''', (FALLIDO if error else TERMINADO, error, datetime.now(),
+          trabajo.id, trabajo.attempts), preparada=True)
+    return cursor.rowcount > 0
+
+
+@instrumentada
+def estado_trabajo(conn, job_id, user_id):
+    """Estado y progreso por foto de un trabajo del usuario (una consulta), o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT j.id, j.status, j.error,
+               count(*),
+               count(*) FILTER (WHERE jp.status <> 'pending'),
+               COALESCE(sum(jsonb_array_length(jp.caras)), 0)::int,
+               json_agg(json_build_object(
+                   'foto_id', jp.photo_id, 'foto_nombre', p.nombre, 'status', jp.status,
+                   'caras', jsonb_array_length(jp.caras)) ORDER BY jp.position)
+        FROM recognition_jobs j
+        JOIN recognition_job_photos jp ON jp.job_id = j.id
+        JOIN photos p ON p.id = jp.photo_id
+        WHERE j.id = %s AND j.user_id = %s
+        GROUP BY j.id
+    ''', (job_id, user_id), preparada=True)
+    row = cursor.fetchone()
+    return EstadoTrabajo._make(row) if row else None
+
+
+@instrumentada
+def caras_trabajo(conn, job_id, user_id):
+    """Caras recortadas de todas las fotos de un trabajo, para etiquetar_caras_individuales.html"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT jp.caras
+        FROM recognition_job_photos jp
+        JOIN recognition_jobs j ON j.id = jp.job_id AND j.user_id = %s
+        WHERE jp.job_id = %s AND jp.caras IS NOT NULL
+        ORDER BY jp.position
+    ''', (user_id, job_id), preparada=True)
+    return [cara for (caras,) in cursor.fetchall() for cara in caras]
+
+
+# ---------------------------------------------------------------------------
+# Procesamiento
+# ---------------------------------------------------------------------------
+
+def procesar_foto(foto, guardadas):
+    """Detectar (si hace falta), recortar y subir las caras de una foto
+
+    Devuelve (caras para la plantilla, con las personas sugeridas como
+    [(persona_id, similitud)], detección nueva del detector o None,
+    [(cara_index, url, public_id, created_at, embedding)] de los recortes subidos).
+    No toca la base de datos.
+    """
+    caras_foto = []
+    subidos = []
+    app_logger.info(f"RECONOCIMIENTO - Procesando foto {foto.id} ({foto.nombre})")
+
+    caras = guardadas.get(foto.id)
+    deteccion = None
+    if deteccion_vigente(caras):
+        faces = caras_como_facepp(caras)
+        app_logger.info(f"RECONOCIMIENTO - Usando {len(faces)} caras guardadas de la foto {foto.id}")
+    else:
+        faces = deteccion = detector.detect(foto.nombre_archivo)
+        if faces is None:
+            raise RuntimeError(f'{detector.name} no pudo analizar {foto.nombre}')
+
+    if not faces:
+        app_logger.info(f"RECONOCIMIENTO - No se detectaron caras en la foto {foto.id}")
+        return caras_foto, deteccion, subidos
+
+    # Recortar todas las caras con una sola descarga y decodificación
+    recortes = get_face_crops(foto.nombre_archivo, [cara['face_rectangle'] for cara in faces])
+
+    for idx, (cara, buffer) in enumerate(zip(faces, recortes)):
+        try:
+            if not buffer:
+                app_logger.error(f"RECONOCIMIENTO - Error creando el recorte de la cara {idx + 1} "
+                                 f"de la foto {foto.id}")
+                continue
+
+            embedding = calcular_embedding(buffer)
+            upload_result = upload_temp_face_crop(buffer)
+
+            if upload_result.get('secure_url'):
+                subidos.append((idx, upload_result['secure_url'], upload_result['public_id'],
+                                upload_result.get('created_at'), embedding))
+                caras_foto.append({
+                    'foto_id': foto.id,
+                    'foto_nombre': foto.nombre,
+                    'cara_index': idx,
+                    'face_token': cara['face_token'],
+                    'recorte_url': upload_result['secure_url'],
+                    'recorte_public_id': upload_result['public_id'],
+                    'cara_id': f"{foto.id}_{idx}"
+                })
+        except Exception as e:
+            app_logger.error(f"RECONOCIMIENTO - Error procesando la cara {idx + 1} de la foto {foto.id}: {e}")
+
+    # Todas las caras de la foto contra el índice en una sola pasada
+    sugerencias = face_index.sugerir([embedding for *_, embedding in subidos])
+    for cara, sugeridas in zip(caras_foto, sugerencias):
+        cara['sugerencias'] = sugeridas
+
+    return caras_foto, deteccion, subidos
+
+
+def nombrar_sugerencias(conn, caras_foto):
+    """Cambiar las sugerencias [(persona_id, similitud)] por {'nombre', 'similitud'} para la plantilla"""
+    nombres = repository.nombres_personas(
+        conn, {persona_id for cara in caras_foto for persona_id, _ in cara.get('sugerencias', [])})
+    for cara in caras_foto:
+        cara['sugerencias'] = [{'nombre': nombres[persona_id], 'similitud': round(similitud, 3)}
+                               for persona_id, similitud in cara.get('sugerencias', [])
+                               if persona_id in nombres]
+
+
+class Latido:
+    """Hilo que renueva la reserva de un trabajo cada `intervalo` mientras se procesa
+
+    Usa su propia conexión del pool en cada renovación: la del trabajo está en
+    medio de sus transacciones. Si la reserva ya no es nuestra, `perdida` se activa.
+    """
+
+    def __init__(self, trabajo, intervalo=RECOGNITION_HEARTBEAT):
+        self.trabajo = trabajo
+        self.intervalo = intervalo.total_seconds()
+        self.perdida = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f'recognition-lease-{self.trabajo.id}',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.intervalo):
+            pool = db_pool.get_pool()
+            conn = None
+            try:
+                conn = pool.getconn()
+                vigente = renovar_reserva(conn, self.trabajo)
+            except psycopg2.Error as e:
+                # Se reintenta en el siguiente latido; la reserva aún dura 3 intervalos más
+                app_logger.warning(f"RECONOCIMIENTO - No se pudo renovar la reserva del trabajo "
+                                   f"{self.trabajo.id}: {e}")
+                if conn is not None:
+                    pool.putconn(conn, broken=True)
+                continue
+            pool.putconn(conn)
+            if not vigente:
+                self.perdida.set()
+                return
+
+
+def procesar_trabajo(conn, trabajo):
+    """Procesar las fotos pendientes de un trabajo reservado, anotando cada una al terminar"""
+    fotos = fotos_pendientes(conn, trabajo)
+    guardadas = repository.caras_detectadas(conn, [foto.id for foto in fotos])
+    detecciones_nuevas = 0
+    total_caras = 0
+    inicio = datetime.now()
+
+    if fotos:
+        with Latido(trabajo) as latido, \
+                ThreadPoolExecutor(max_workers=min(RECOGNITION_THREADS, len(fotos))) as executor:
+            futuros = {executor.submit(procesar_foto, foto, guardadas): foto for foto in fotos}
+            for futuro in as_completed(futuros):
+                foto = futuros[futuro]
+                try:
+                    caras_foto, deteccion, subidos = futuro.result()
+                    status = TERMINADO
+                except Exception as e:
+                    app_logger.error(f"RECONOCIMIENTO - Error con el detector en la foto {foto.id}: {e}")
+                    caras_foto, deteccion, subidos, status = [], None, [], ERROR
+
+                nombrar_sugerencias(conn, caras_foto)
+                # Detección, recortes y progreso de la foto juntos
+                with repository.transaccion(conn):
+                    if deteccion is not None:
+                        detecciones_nuevas += 1
+                        repository.guardar_caras_detectadas(
+                            conn, {foto.id: deteccion}, detector.token_expires())
+                    repository.guardar_recortes_caras(
+                        conn, [(foto.id, idx, url, public_id, created_at, embedding_a_bytes(embedding))
+                               for idx, url, public_id, created_at, embedding in subidos], embedder.name)
+                    sigue_siendo_nuestro = terminar_foto(conn, trabajo, foto.id, status, caras_foto)
+                if not sigue_siendo_nuestro or latido.perdida.is_set():
+                    app_logger.warning(f"RECONOCIMIENTO - Trabajo {trabajo.id} retomado por otro worker")
+                    executor.shutdown(cancel_futures=True)
+                    return False
+                total_caras += len(caras_foto)
+
+    terminar_trabajo(conn, trabajo)
+    segundos = (datetime.now() - inicio).total_seconds()
+    log_user_action(trabajo.user_id, 'FACIAL_RECOGNITION_COMPLETED',
+                    f'Job {trabajo.id}: processed {len(fotos)} photos, {total_caras} faces '
+                    f'({detecciones_nuevas} new {detector.name} detections) in {segundos:.2f}s')
+    return True
+
+
+class RecognitionWorker:
+    """Bucle que toma trabajos de la cola y los procesa, uno cada vez"""
+
+    def __init__(self, poll_interval=RECOGNITION_POLL_SECONDS):
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._pid = None
+
+    def run_once(self):
+        """Tomar y procesar un trabajo; False si la cola estaba vacía"""
+        pool = db_pool.get_pool()
+        conn = pool.getconn()
+        try:
+            trabajo = tomar_trabajo(conn)
+            if trabajo is None:
+                pool.putconn(conn)
+                return False
+            app_logger.info(f"RECONOCIMIENTO - Trabajo {trabajo.id} (intento {trabajo.attempts}) "
+                            f"tomado por pid {os.getpid()}")
+            try:
+                procesar_trabajo(conn, trabajo)
+            except Exception as e:
+                app_logger.error(f"RECONOCIMIENTO - Error en el trabajo {trabajo.id}: {e}")
+                if trabajo.attempts >= RECOGNITION_MAX_ATTEMPTS:
+                    terminar_trabajo(conn, trabajo, error=str(e))
+                # Si no, se reintenta cuando caduque la reserva
+        except Exception:
+            pool.putconn(conn, broken=True)
+            raise
+        pool.putconn(conn)
+        return True
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                app_logger.error(f"RECONOCIMIENTO - Error tomando trabajos: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        self._ensure_thread()
+
+    def stop(self):
+        self._stop.set()
+
+    def _ensure_thread(self):
+        # Un hilo por proceso: el heredado de un fork no corre en el hijo
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self.run_forever, name='recognition-worker', daemon=True)
+            self._thread.start()
+
+
+# Instancia global (el hilo solo se arranca en los workers con RECOGNITION_IN_PROCESS=true)
+recognition_worker = RecognitionWorker()
+
+
+def main():
+    """Función principal"""
+    parser = argparse.ArgumentParser(description='Worker de la cola de reconocimiento facial')
+    parser.add_argument('comando', nargs='?', default='loop', choices=['loop', 'once'])
+    args = parser.parse_args()
+
+    db_pool.init_pool()
+    try:
+        if args.comando == 'once':
+            procesados = 0
+            while recognition_worker.run_once():
+                procesados += 1
+            print(f"Trabajos procesados: {procesados}")
+            return
+        app_logger.info(f"RECONOCIMIENTO - Worker iniciado (pid {os.getpid()})")
+        recognition_worker.run_forever()
+    except KeyboardInterrupt:
+        recognition_worker.stop()
+    finally:
+        db_pool.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,974 @@
+"""
+Capa de acceso a datos
+
+Todas las consultas de usuarios, fotos, personas y etiquetas pasan por aquí.
+Cada función recibe la conexión (get_db() en app.py), devuelve filas compactas
+(namedtuple o dict de usuario) y queda contada y cronometrada en query_stats().
+Las consultas más frecuentes se ejecutan como sentencias preparadas
+(PREPARE/EXECUTE) en las conexiones del pool de db_pool.py.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+import psycopg2
+
+from logger_config import app_logger, log_database_operation
+from query_tracker import PREPARED_SQL
+
+# Umbral para avisar de funciones lentas (milisegundos)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 500))
+
+
+# ---------------------------------------------------------------------------
+# Estadísticas por función
+# ---------------------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_query_stats = {}  # nombre -> [llamadas, tiempo_total, tiempo_max, errores]
+
+
+def instrumentada(f):
+    """Contar llamadas, errores y tiempo de una función del repositorio"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            duracion = time.perf_counter() - inicio
+            with _stats_lock:
+                stats = _query_stats.setdefault(f.__name__, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += duracion
+                stats[2] = max(stats[2], duracion)
+                stats[3] += error
+            if duracion * 1000 >= SLOW_QUERY_MS:
+                app_logger.warning(f"DB LENTA - {f.__name__}: {duracion * 1000:.1f} ms")
+    return wrapper
+
+
+def query_stats():
+    """Llamadas y tiempos (ms) por función del repositorio en este proceso"""
+    with _stats_lock:
+        items = list(_query_stats.items())
+    return {
+        nombre: {
+            'calls': llamadas,
+            'errors': errores,
+            'total_ms': round(total * 1000, 2),
+            'avg_ms': round(total * 1000 / llamadas, 2) if llamadas else 0.0,
+            'max_ms': round(maximo * 1000, 2),
+        }
+        for nombre, (llamadas, total, maximo, errores) in sorted(items)
+    }
+
+
+def reset_query_stats():
+    with _stats_lock:
+        _query_stats.clear()
+
+
+# ---------------------------------------------------------------------------
+# Sentencias preparadas
+# ---------------------------------------------------------------------------
+
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+
+def _sql_preparada(sql):
+    """Pasar los marcadores de psycopg2 (%s, %%) a los de PREPARE ($1, %)"""
+    contador = iter(range(1, 10000))
+    return _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f'${next(contador)}', sql)
+
+
+def ejecutar(cursor, sql, params=(), preparada=False):
+    """Ejecutar una consulta; con preparada=True usa PREPARE/EXECUTE si la conexión es del pool.
+
+    El nombre de la sentencia se deriva del SQL, así que cada variante de una consulta
+    (por ejemplo, con o sin cursor de paginación) tiene su propio plan preparado.
+    """
+    preparadas = getattr(cursor.connection, 'prepared_statements', None)
+    if not preparada or preparadas is None:
+        cursor.execute(sql, params or None)
+        return
+
+    nombre = 'repo_' + hashlib.md5(sql.encode()).hexdigest()[:16]
+    if nombre not in preparadas:
+        PREPARED_SQL.setdefault(nombre, sql)
+        cursor.execute(f'PREPARE {nombre} AS {_sql_preparada(sql)}')
+        preparadas.add(nombre)
+
+    params = tuple(params)
+    args = f" ({', '.join(['%s'] * len(params))})" if params else ''
+    try:
+        cursor.execute(f'EXECUTE {nombre}{args}', params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # La sesión perdió la sentencia (DISCARD/DEALLOCATE): se vuelve a preparar la próxima vez
+        preparadas.discard(nombre)
+        raise
+
+
+@contextmanager
+def transaccion(conn):
+    """Agrupar varias sentencias en una transacción (las conexiones del pool van en autocommit)"""
+    conn.autocommit = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+# ---------------------------------------------------------------------------
+# Usuarios
+# ---------------------------------------------------------------------------
+
+# Columnas de users que usan las vistas y plantillas
+USER_COLUMNS = 'id, name, email, phone, created_at, updated_at, token_expires'
+
+
+# Las mismas columnas con la caducidad de la sesión (sessions) en lugar de la de users
+SESSION_USER_COLUMNS = ('u.id, u.name, u.email, u.phone, u.created_at, u.updated_at, '
+                        's.expires AS token_expires')
+
+
+@instrumentada
+def get_user_by_token(conn, user_id, access_token):
+    """Usuario con sesión válida (dict) o None: índice único de sessions.token y un join"""
+    cursor = conn.cursor()
+    ejecutar(cursor, f'''
+        SELECT {SESSION_USER_COLUMNS}
+        FROM sessions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.token = %s AND s.user_id = %s AND s.expires > %s
+    ''', (access_token, user_id, datetime.now()), preparada=True)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    columns = [desc[0] for desc in cursor.description]
+    return dict(zip(columns, row))
+
+
+@instrumentada
+def get_user_by_id(conn, user_id):
+    """Usuario (dict) por id, sin comprobar el token (tokens firmados), o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, f'SELECT {USER_COLUMNS} FROM users WHERE id = %s', (user_id,), preparada=True)
+    row = cursor.fetchone()
+    if not row:
+        return None
+    columns = [desc[0] for desc in cursor.description]
+    return dict(zip(columns, row))
+
+
+@instrumentada
+def get_token_generation(conn, user_id):
+    """Generación vigente de los tokens firmados del usuario; None si el usuario no existe"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT COALESCE(tg.generation, 0)
+        FROM users u
+        LEFT JOIN token_generations tg ON tg.user_id = u.id
+        WHERE u.id = %s
+    ''', (user_id,), preparada=True)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@instrumentada
+def bump_token_generation(conn, user_id):
+    """Revocar todos los tokens firmados del usuario; devuelve la nueva generación"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO token_generations (user_id, generation, updated_at)
+        VALUES (%s, 1, %s)
+        ON CONFLICT (user_id) DO UPDATE
+        SET generation = token_generations.generation + 1, updated_at = EXCLUDED.updated_at
+        RETURNING generation
+    ''', (user_id, datetime.now()))
+    log_database_operation('UPDATE', 'token_generations', f'Tokens revoked for user {user_id}')
+    return cursor.fetchone()[0]
+
+
+@instrumentada
+def extend_session_token(conn, user_id, access_token, token_expires):
+    """Extender solo la sesión de este dispositivo"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE sessions
+        SET expires = %s
+        WHERE token = %s AND user_id = %s
+    ''', (token_expires, access_token, user_id))
+    log_database_operation('UPDATE', 'sessions', f'Session extended for user {user_id}')
+
+
+@instrumentada
+def clear_session_token(conn, user_id, access_token):
+    """Cerrar la sesión de este dispositivo (las demás siguen abiertas)"""
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM sessions WHERE token = %s AND user_id = %s', (access_token, user_id))
+    log_database_operation('DELETE', 'sessions', f'Cleared session for user {user_id}')
+
+
+@instrumentada
+def update_profile(conn, user_id, name, phone):
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE users
+        SET name = %s, phone = %s, updated_at = %s
+        WHERE id = %s
+    ''', (name, phone, datetime.now(), user_id))
+    log_database_operation('UPDATE', 'users', f'Profile updated for user {user_id}')
+
+
+@instrumentada
+def delete_user(conn, user_id, email):
+    """Eliminar la cuenta: verificaciones pendientes, sesión y el usuario (sus fotos en cascada)"""
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM verification_codes WHERE email = %s', (email,))
+    cursor.execute('DELETE FROM email_change_requests WHERE user_id = %s', (user_id,))
+    cursor.execute('DELETE FROM sessions WHERE user_id = %s', (user_id,))
+    cursor.execute('DELETE FROM users WHERE id = %s', (user_id,))
+    log_database_operation('DELETE', 'users', f'Account deleted: ID {user_id}')
+
+
+@instrumentada
+def contar_solicitudes_cambio_email(conn, user_id):
+    """Solicitudes de cambio de email del usuario (0 o 1: una por usuario), para el modal de borrado"""
+    cursor = conn.cursor()
+    ejecutar(cursor, 'SELECT count(*) FROM email_change_requests WHERE user_id = %s',
+             (user_id,), preparada=True)
+    return cursor.fetchone()[0]
+
+
+@instrumentada
+def registrar_interacciones(conn, visitas):
+    """Sumar un día de interacción a los usuarios [(user_id, visto)] cuya última fue otro día
+
+    Sin lectura previa e idempotente: repetirlo el mismo día no vuelve a sumar.
+    Devuelve cuántos usuarios se actualizaron.
+    """
+    if not visitas:
+        return 0
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE users u
+        SET last_interaction_date = v.visto,
+            total_interaction_days = COALESCE(u.total_interaction_days, 0) + 1
+        FROM unnest(%s::int[], %s::timestamp[]) AS v(id, visto)
+        WHERE u.id = v.id
+          AND (u.last_interaction_date IS NULL OR u.last_interaction_date::date < v.visto::date)
+    ''', ([int(user_id) for user_id, _ in visitas], [visto for _, visto in visitas]), preparada=True)
+    return cursor.rowcount
+
+
+# ---------------------------------------------------------------------------
+# Fotos de galería
+# ---------------------------------------------------------------------------
+
+class Foto(namedtuple('Foto', 'id nombre nombre_archivo mes año created_at usuario_nombre '
+                             'personas_ids personas_nombres rank')):
+    """Fila de galería; rank solo tiene valor en búsquedas por similitud"""
+    __slots__ = ()
+
+    @property
+    def necesita_etiquetado(self):
+        return not self.personas_ids
+
+
+# Columnas de fotos para galerías, con las personas etiquetadas (tabla photo_personas)
+FOTO_COLUMNS = '''
+    p.id, p.nombre, p.nombre_archivo, p.mes, p.año, p.created_at,
+    u.name as usuario_nombre,
+    COALESCE(pp.personas_ids, '{}') AS personas_ids,
+    COALESCE(pp.personas_nombres, '{}') AS personas_nombres
+'''
+FOTO_JOINS = '''
+    JOIN users u ON p.user_id = u.id
+    LEFT JOIN LATERAL (
+        SELECT array_agg(pe.id ORDER BY pe.nombre) AS personas_ids,
+               array_agg(pe.nombre ORDER BY pe.nombre) AS personas_nombres
+        FROM photo_personas ppx
+        JOIN personas pe ON pe.id = ppx.persona_id
+        WHERE ppx.photo_id = p.id
+    ) pp ON TRUE
+'''
+
+# Condición de búsqueda: el nombre de la foto o de alguna persona etiquetada contiene el texto
+FILTRO_BUSQUEDA_FOTOS = '''(
+    p.nombre ILIKE %s OR EXISTS (
+        SELECT 1 FROM photo_personas bpp
+        JOIN personas bpe ON bpe.id = bpp.persona_id
+        WHERE bpp.photo_id = p.id AND bpe.nombre ILIKE %s
+    )
+)'''
+
+# Orden de las galerías y su clave de paginación (keyset). Las expresiones deben
+# coincidir con las de idx_photos_galeria / idx_photos_user_galeria para usar el índice.
+# El cursor guarda los valores ya con esos COALESCE (clave_galeria), incluido SIN_FECHA.
+SIN_FECHA = '-infinity'
+GALERIA_CLAVE = f"(COALESCE(p.año, 0), COALESCE(p.mes, 0), COALESCE(p.created_at, '{SIN_FECHA}'::timestamp), p.id)"
+GALERIA_ORDEN = ("COALESCE(p.año, 0) DESC, COALESCE(p.mes, 0) DESC, "
+                 f"COALESCE(p.created_at, '{SIN_FECHA}'::timestamp) DESC, p.id DESC")
+
+# Búsqueda por similitud (pg_trgm + unaccent): fotos cuyo nombre o el de alguna persona
+# etiquetada contiene el texto o se le parece, con su relevancia. Cada rama usa los
+# índices trigram idx_photos_nombre_trgm / idx_personas_nombre_trgm.
+# Parámetros: (patrón, texto, patrón, texto) por cada rama.
+BUSQUEDA_RANKING = '''
+    JOIN (
+        SELECT c.photo_id, max(c.rank)::float8 AS rank
+        FROM (
+            SELECT bp.id AS photo_id,
+                   (f_unaccent(lower(bp.nombre)) LIKE %s)::int
+                   + word_similarity(%s, f_unaccent(lower(bp.nombre))) AS rank
+            FROM photos bp
+            WHERE f_unaccent(lower(bp.nombre)) LIKE %s
+               OR %s <%% f_unaccent(lower(bp.nombre))
+            UNION ALL
+            SELECT bpp.photo_id,
+                   (f_unaccent(lower(bpe.nombre)) LIKE %s)::int
+                   + word_similarity(%s, f_unaccent(lower(bpe.nombre)))
+            FROM personas bpe
+            JOIN photo_personas bpp ON bpp.persona_id = bpe.id
+            WHERE f_unaccent(lower(bpe.nombre)) LIKE %s
+               OR %s <%% f_unaccent(lower(bpe.nombre))
+        ) c
+        GROUP BY c.photo_id
+    ) r ON r.photo_id = p.id
+'''
+BUSQUEDA_CLAVE = '(r.rank, p.id)'
+BUSQUEDA_ORDEN = 'r.rank DESC, p.id DESC'
+
+# None = aún no comprobado en este proceso
+_busqueda_similitud = None
+
+
+def like_pattern(texto):
+    """Patrón ILIKE que busca el texto literal en cualquier posición"""
+    escaped = texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def normalizar_busqueda(texto):
+    """Minúsculas y sin acentos, igual que f_unaccent(lower(...)) en la BD"""
+    descompuesto = unicodedata.normalize('NFD', texto.lower())
+    return ''.join(c for c in descompuesto if unicodedata.category(c) != 'Mn')
+
+
+@instrumentada
+def busqueda_similitud_disponible(conn):
+    """Comprobar (una vez por proceso) si la BD tiene pg_trgm y f_unaccent"""
+    global _busqueda_similitud
+    if _busqueda_similitud is None:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')
+                   AND to_regprocedure('f_unaccent(text)') IS NOT NULL
+        ''')
+        _busqueda_similitud = cursor.fetchone()[0]
+        if not _busqueda_similitud:
+            app_logger.warning("Búsqueda sin pg_trgm/unaccent: se usa ILIKE sin ranking")
+    return _busqueda_similitud
+
+
+def clave_galeria(consulta, foto):
+    """Clave de paginación de una foto, con los mismos COALESCE que consulta['clave']"""
+    if consulta['por_ranking']:
+        return [foto.rank, foto.id]
+    return [foto.año or 0, foto.mes or 0, foto.created_at or SIN_FECHA, foto.id]
+
+
+def encode_galeria_cursor(valores):
+    """Cursor opaco con la clave de orden de la última foto de la página"""
+    clave = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in valores])
+    return base64.urlsafe_b64encode(clave.encode()).decode()
+
+
+def decode_galeria_cursor(valor, por_ranking=False):
+    """Decodificar un cursor de galería o de búsqueda por ranking; None si no es válido"""
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(valor.encode()).decode())
+        if por_ranking:
+            rank, photo_id = valores
+            return (float(rank), int(photo_id))
+        año, mes, created_at, photo_id = valores
+        # null: cursores emitidos antes de guardar SIN_FECHA
+        if created_at in (None, SIN_FECHA):
+            created_at = SIN_FECHA
+        else:
+            created_at = datetime.fromisoformat(created_at)
+        return (int(año), int(mes), created_at, int(photo_id))
+    except (ValueError, TypeError, UnicodeDecodeError):
+        return None
+
+
+def consulta_galeria(conn, condiciones=None, params=(), busqueda=None):
+    """Preparar joins, condiciones y orden de una galería, con búsqueda opcional.
+
+    Devuelve un dict con joins, join_params, condiciones, params, clave, orden y por_ranking.
+    """
+    consulta = {
+        'joins': '', 'join_params': [],
+        'condiciones': list(condiciones or []), 'params': list(params),
+        'clave': GALERIA_CLAVE, 'orden': GALERIA_ORDEN, 'por_ranking': False,
+    }
+    if not busqueda:
+        return consulta
+
+    if busqueda_similitud_disponible(conn):
+        texto = normalizar_busqueda(busqueda)
+        patron = like_pattern(texto)
+        consulta.update({
+            'joins': BUSQUEDA_RANKING,
+            'join_params': [patron, texto, patron, texto] * 2,
+            'clave': BUSQUEDA_CLAVE, 'orden': BUSQUEDA_ORDEN, 'por_ranking': True,
+        })
+    else:
+        patron = like_pattern(busqueda)
+        consulta['condiciones'].append(FILTRO_BUSQUEDA_FOTOS)
+        consulta['params'].extend([patron, patron])
+    return consulta
+
+
+@instrumentada
+def pagina_galeria(conn, consulta, limite, despues_de=None):
+    """Hasta `limite` fotos de la galería a partir de la clave `despues_de` (lista de Foto)"""
+    condiciones = list(consulta['condiciones'])
+    params = list(consulta['params'])
+    if despues_de:
+        marcadores = ', '.join(['%s'] * len(despues_de))
+        condiciones.append(f"{consulta['clave']} < ({marcadores})")
+        params.extend(despues_de)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    rank = 'r.rank' if consulta['por_ranking'] else 'NULL::float8 AS rank'
+
+    cursor = conn.cursor()
+    ejecutar(cursor, f'''
+        SELECT {FOTO_COLUMNS}, {rank}
+        FROM photos p
+        {FOTO_JOINS}
+        {consulta['joins']}
+        {where}
+        ORDER BY {consulta['orden']}
+        LIMIT %s
+    ''', consulta['join_params'] + params + [limite], preparada=True)
+    return [Foto._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def contar_fotos_galeria(conn, consulta):
+    """Total de fotos de una galería (sin los joins de usuario y personas)"""
+    condiciones = consulta['condiciones']
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    cursor = conn.cursor()
+    ejecutar(cursor, f"SELECT COUNT(*) FROM photos p {consulta['joins']} {where}",
+             consulta['join_params'] + consulta['params'], preparada=True)
+    return cursor.fetchone()[0]
+
+
+@instrumentada
+def fotos_por_ids(conn, foto_ids):
+    """Fotos de galería con esos ids, más recientes primero"""
+    cursor = conn.cursor()
+    ejecutar(cursor, f'''
+        SELECT {FOTO_COLUMNS}, NULL::float8 AS rank
+        FROM photos p
+        {FOTO_JOINS}
+        WHERE p.id = ANY(%s::int[])
+        ORDER BY p.created_at DESC
+    ''', ([int(foto_id) for foto_id in foto_ids],), preparada=True)
+    return [Foto._make(row) for row in cursor.fetchall()]
+
+
+# ---------------------------------------------------------------------------
+# Fotos del usuario
+# ---------------------------------------------------------------------------
+
+FotoReconocimiento = namedtuple('FotoReconocimiento',
+                                'id nombre nombre_archivo mes año created_at tiene_personas')
+FotoEditable = namedtuple('FotoEditable', 'id nombre nombre_archivo mes año')
+
+
+@instrumentada
+def insertar_foto(conn, user_id, nombre, nombre_archivo, mes, año):
+    """Guardar una foto subida y devolver su id"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        INSERT INTO photos (user_id, nombre, nombre_archivo, mes, año, created_at, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    ''', (user_id, nombre, nombre_archivo, mes, año, datetime.now(), datetime.now()), preparada=True)
+    return cursor.fetchone()[0]
+
+
+@instrumentada
+def foto_editable(conn, photo_id, user_id):
+    """Foto del usuario para el formulario de edición, o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, nombre, nombre_archivo, mes, año FROM photos
+        WHERE id = %s AND user_id = %s
+    ''', (photo_id, user_id), preparada=True)
+    row = cursor.fetchone()
+    return FotoEditable._make(row) if row else None
+
+
+@instrumentada
+def actualizar_nombre_foto(conn, photo_id, user_id, nombre):
+    """Renombrar una foto del usuario; False si no existe o no es suya"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE photos SET nombre = %s, updated_at = %s
+        WHERE id = %s AND user_id = %s
+        RETURNING id
+    ''', (nombre, datetime.now(), photo_id, user_id))
+    return cursor.fetchone() is not None
+
+
+@instrumentada
+def archivos_fotos_usuario(conn, foto_ids, user_id):
+    """[(id, nombre_archivo)] de las fotos indicadas que pertenecen al usuario"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, nombre_archivo FROM photos
+        WHERE id = ANY(%s::int[]) AND user_id = %s
+    ''', ([int(foto_id) for foto_id in foto_ids], user_id))
+    return cursor.fetchall()
+
+
+@instrumentada
+def borrar_fotos(conn, foto_ids, user_id):
+    """Borrar fotos del usuario (y sus etiquetas, en cascada); devuelve cuántas"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM photos
+        WHERE id = ANY(%s::int[]) AND user_id = %s
+    ''', ([int(foto_id) for foto_id in foto_ids], user_id))
+    log_database_operation('DELETE', 'photos', f'User {user_id}: {cursor.rowcount} photos')
+    return cursor.rowcount
+
+
+@instrumentada
+def fotos_para_reconocimiento(conn, foto_ids, user_id):
+    """Fotos del usuario con un indicador de si ya tienen personas etiquetadas"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT p.id, p.nombre, p.nombre_archivo, p.mes, p.año, p.created_at,
+               EXISTS (SELECT 1 FROM photo_personas pp WHERE pp.photo_id = p.id) AS tiene_personas
+        FROM photos p
+        WHERE p.id = ANY(%s::int[]) AND p.user_id = %s
+        ORDER BY p.created_at DESC
+    ''', ([int(foto_id) for foto_id in foto_ids], user_id), preparada=True)
+    return [FotoReconocimiento._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def nombres_personas_por_foto(conn, foto_ids):
+    """{photo_id: [nombres]} de las personas etiquetadas en esas fotos"""
+    personas_por_foto = {foto_id: [] for foto_id in foto_ids}
+    if not foto_ids:
+        return personas_por_foto
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT pp.photo_id, pe.nombre
+        FROM photo_personas pp
+        JOIN personas pe ON pe.id = pp.persona_id
+        WHERE pp.photo_id = ANY(%s::int[])
+        ORDER BY pe.nombre
+    ''', (list(foto_ids),), preparada=True)
+    for photo_id, nombre in cursor.fetchall():
+        personas_por_foto.setdefault(photo_id, []).append(nombre)
+    return personas_por_foto
+
+
+@instrumentada
+def foto_del_usuario(conn, photo_id, user_id):
+    """nombre_archivo de una foto del usuario, o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, 'SELECT nombre_archivo FROM photos WHERE id = %s AND user_id = %s',
+             (photo_id, user_id), preparada=True)
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# ---------------------------------------------------------------------------
+# Personas
+# ---------------------------------------------------------------------------
+
+Persona = namedtuple('Persona', 'id nombre imagen created_at')
+PersonaNombre = namedtuple('PersonaNombre', 'id nombre')
+PersonaImagen = namedtuple('PersonaImagen', 'id nombre imagen')
+
+
+@instrumentada
+def listar_personas(conn):
+    """Todas las personas por nombre; created_at como texto para las plantillas"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, nombre, imagen, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at
+        FROM personas
+        ORDER BY nombre ASC
+    ''', preparada=True)
+    return [Persona._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def listar_nombres_personas(conn):
+    """(id, nombre) de todas las personas, para filtros y buscadores"""
+    cursor = conn.cursor()
+    ejecutar(cursor, 'SELECT id, nombre FROM personas ORDER BY nombre ASC', preparada=True)
+    return [PersonaNombre._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def get_persona(conn, persona_id):
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, nombre, imagen FROM personas WHERE id = %s', (persona_id,))
+    row = cursor.fetchone()
+    return PersonaImagen._make(row) if row else None
+
+
+@instrumentada
+def get_persona_por_nombre(conn, nombre, excluir_id=None):
+    """Persona con ese nombre (opcionalmente distinta de excluir_id), o None"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, nombre, imagen FROM personas
+        WHERE nombre = %s AND id IS DISTINCT FROM %s
+    ''', (nombre, excluir_id), preparada=True)
+    row = cursor.fetchone()
+    return PersonaImagen._make(row) if row else None
+
+
+@instrumentada
+def personas_por_nombres(conn, nombres):
+    """{nombre: PersonaImagen} de las personas con esos nombres, en una sola consulta"""
+    if not nombres:
+        return {}
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, nombre, imagen FROM personas
+        WHERE nombre = ANY(%s::text[])
+    ''', (list(nombres),), preparada=True)
+    return {row[1]: PersonaImagen._make(row) for row in cursor.fetchall()}
+
+
+@instrumentada
+def nombres_personas(conn, persona_ids):
+    """{id: nombre} de esas personas (las borradas no aparecen), en una sola consulta"""
+    if not persona_ids:
+        return {}
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, nombre FROM personas
+        WHERE id = ANY(%s::int[])
+    ''', ([int(persona_id) for persona_id in persona_ids],), preparada=True)
+    return dict(cursor.fetchall())
+
+
+@instrumentada
+def crear_persona(conn, nombre, imagen):
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        INSERT INTO personas (nombre, imagen, created_at, updated_at)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    ''', (nombre, imagen, datetime.now(), datetime.now()), preparada=True)
+    return cursor.fetchone()[0]
+
+
+@instrumentada
+def crear_personas(conn, personas):
+    """Crear [(nombre, imagen)] en una sentencia; {nombre: id} de las creadas
+
+    Los nombres que ya existían (p. ej. creados a la vez por otra petición) no
+    se devuelven: hay que resolverlos después con personas_por_nombres().
+    """
+    if not personas:
+        return {}
+    cursor = conn.cursor()
+    ahora = datetime.now()
+    ejecutar(cursor, '''
+        INSERT INTO personas (nombre, imagen, created_at, updated_at)
+        SELECT v.nombre, v.imagen, %s, %s
+        FROM unnest(%s::text[], %s::text[]) AS v(nombre, imagen)
+        ON CONFLICT (nombre) DO NOTHING
+        RETURNING id, nombre
+    ''', (ahora, ahora, [n for n, _ in personas], [i for _, i in personas]), preparada=True)
+    creadas = {nombre: persona_id for persona_id, nombre in cursor.fetchall()}
+    if creadas:
+        log_database_operation('INSERT', 'personas', f'{len(creadas)} personas')
+    return creadas
+
+
+@instrumentada
+def actualizar_persona(conn, persona_id, nombre, imagen):
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE personas
+        SET nombre = %s, imagen = %s, updated_at = %s
+        WHERE id = %s
+    ''', (nombre, imagen, datetime.now(), persona_id))
+
+
+@instrumentada
+def actualizar_imagen_persona(conn, persona_id, imagen):
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE personas
+        SET imagen = %s, updated_at = %s
+        WHERE id = %s
+    ''', (imagen, datetime.now(), persona_id), preparada=True)
+
+
+@instrumentada
+def completar_imagenes_personas(conn, imagenes):
+    """Poner imagen a las personas [(id, url)] que todavía no tienen, en una sentencia"""
+    if not imagenes:
+        return
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE personas pe
+        SET imagen = v.imagen, updated_at = %s
+        FROM unnest(%s::int[], %s::text[]) AS v(id, imagen)
+        WHERE pe.id = v.id AND (pe.imagen IS NULL OR pe.imagen = '')
+    ''', (datetime.now(), [int(i) for i, _ in imagenes], [u for _, u in imagenes]), preparada=True)
+
+
+@instrumentada
+def borrar_persona(conn, persona_id):
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM personas WHERE id = %s', (persona_id,))
+    log_database_operation('DELETE', 'personas', f'ID: {persona_id}')
+
+
+# ---------------------------------------------------------------------------
+# Etiquetas (photo_personas)
+# ---------------------------------------------------------------------------
+
+@instrumentada
+def reemplazar_personas_foto(conn, foto_id, user_id, personas_ids):
+    """Dejar en la foto exactamente esas personas (solo si la foto es del usuario)"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH foto AS (
+            SELECT id FROM photos WHERE id = %s AND user_id = %s
+        ), borradas AS (
+            DELETE FROM photo_personas
+            WHERE photo_id IN (SELECT id FROM foto) AND persona_id <> ALL(%s::int[])
+        ), insertadas AS (
+            INSERT INTO photo_personas (photo_id, persona_id)
+            SELECT foto.id, unnest(%s::int[]) FROM foto
+            ON CONFLICT DO NOTHING
+        )
+        UPDATE photos SET updated_at = %s
+        WHERE id IN (SELECT id FROM foto)
+    ''', (foto_id, user_id, personas_ids, personas_ids, datetime.now()), preparada=True)
+
+
+@instrumentada
+def anadir_personas_fotos(conn, pares, user_id):
+    """Añadir pares (foto_id, persona_id) en una sola sentencia, solo en fotos del usuario"""
+    if not pares:
+        return
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH nuevas AS (
+            SELECT v.photo_id, v.persona_id
+            FROM unnest(%s::int[], %s::int[]) AS v(photo_id, persona_id)
+            JOIN photos p ON p.id = v.photo_id AND p.user_id = %s
+        ), insertadas AS (
+            INSERT INTO photo_personas (photo_id, persona_id)
+            SELECT photo_id, persona_id FROM nuevas
+            ON CONFLICT DO NOTHING
+        )
+        UPDATE photos SET updated_at = %s
+        WHERE id IN (SELECT photo_id FROM nuevas)
+    ''', ([int(f) for f, _ in pares], [int(p) for _, p in pares], user_id, datetime.now()),
+             preparada=True)
+
+
+# ---------------------------------------------------------------------------
+# Caras detectadas (faces)
+# ---------------------------------------------------------------------------
+
+class Cara(namedtuple('Cara', 'photo_id face_index rect_left rect_top rect_width rect_height '
+                              'face_token token_expires attributes crop_url crop_public_id persona_id')):
+    @property
+    def face_rectangle(self):
+        """Rectángulo con las claves de Face++ (left, top, width, height)"""
+        return {'left': self.rect_left, 'top': self.rect_top,
+                'width': self.rect_width, 'height': self.rect_height}
+
+
+CaraConfirmada = namedtuple('CaraConfirmada', 'face_id persona_id embedding embedding_model')
+
+
+@instrumentada
+def caras_detectadas(conn, foto_ids):
+    """{photo_id: [Cara]} de las fotos ya pasadas por el detector ([] si no tenían caras)
+
+    Las fotos que nunca se detectaron no aparecen en el resultado.
+    """
+    if not foto_ids:
+        return {}
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT p.id, f.face_index, f.rect_left, f.rect_top, f.rect_width, f.rect_height,
+               f.face_token, f.token_expires, f.attributes, f.crop_url, f.crop_public_id, f.persona_id
+        FROM photos p
+        LEFT JOIN faces f ON f.photo_id = p.id
+        WHERE p.id = ANY(%s::int[]) AND p.faces_detected_at IS NOT NULL
+        ORDER BY p.id, f.face_index
+    ''', ([int(foto_id) for foto_id in foto_ids],), preparada=True)
+    caras = {}
+    for row in cursor.fetchall():
+        lista = caras.setdefault(row[0], [])
+        if row[1] is not None:
+            lista.append(Cara._make(row))
+    return caras
+
+
+@instrumentada
+def guardar_caras_detectadas(conn, detecciones, token_expires):
+    """Guardar el resultado del detector {photo_id: [cara de Face++]} en una sola sentencia
+
+    Sustituye las caras anteriores de esas fotos; una cara con el mismo rectángulo
+    conserva su persona, su recorte y su embedding.
+    """
+    if not detecciones:
+        return
+    filas = [(int(photo_id), idx, cara['face_rectangle'], cara.get('face_token'), cara.get('attributes'))
+             for photo_id, caras in detecciones.items() for idx, cara in enumerate(caras)]
+    ahora = datetime.now()
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        WITH detectadas AS (
+            SELECT * FROM unnest(%s::int[], %s::int[]) AS d(photo_id, total)
+        ), borradas AS (
+            DELETE FROM faces f
+            USING detectadas d
+            WHERE f.photo_id = d.photo_id AND f.face_index >= d.total
+        ), guardadas AS (
+            INSERT INTO faces (photo_id, face_index, rect_left, rect_top, rect_width, rect_height,
+                               face_token, token_expires, attributes, detected_at, updated_at)
+            SELECT v.photo_id, v.face_index, v.rect_left, v.rect_top, v.rect_width, v.rect_height,
+                   v.face_token, %s::timestamp, v.attributes::jsonb, %s::timestamp, %s::timestamp
+            FROM unnest(%s::int[], %s::int[], %s::int[], %s::int[], %s::int[], %s::int[], %s::text[], %s::text[])
+                 AS v(photo_id, face_index, rect_left, rect_top, rect_width, rect_height, face_token, attributes)
+            JOIN detectadas d ON d.photo_id = v.photo_id
+            ON CONFLICT (photo_id, face_index) DO UPDATE SET
+                face_token = EXCLUDED.face_token,
+                token_expires = EXCLUDED.token_expires,
+                attributes = EXCLUDED.attributes,
+                detected_at = EXCLUDED.detected_at,
+                updated_at = EXCLUDED.updated_at,
+                rect_left = EXCLUDED.rect_left, rect_top = EXCLUDED.rect_top,
+                rect_width = EXCLUDED.rect_width, rect_height = EXCLUDED.rect_height,
+                persona_id = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                       = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                  THEN faces.persona_id END,
+                crop_url = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                     = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                THEN faces.crop_url END,
+                crop_public_id = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                           = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                      THEN faces.crop_public_id END,
+                crop_created_at = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                            = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                       THEN faces.crop_created_at END,
+                embedding = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                      = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                 THEN faces.embedding END,
+                embedding_model = CASE WHEN (faces.rect_left, faces.rect_top, faces.rect_width, faces.rect_height)
+                                            = (EXCLUDED.rect_left, EXCLUDED.rect_top, EXCLUDED.rect_width, EXCLUDED.rect_height)
+                                       THEN faces.embedding_model END
+        )
+        UPDATE photos SET faces_detected_at = %s
+        WHERE id IN (SELECT photo_id FROM detectadas)
+    ''', (
+        [int(photo_id) for photo_id in detecciones], [len(caras) for caras in detecciones.values()],
+        token_expires, ahora, ahora,
+        [f[0] for f in filas], [f[1] for f in filas],
+        [int(f[2]['left']) for f in filas], [int(f[2]['top']) for f in filas],
+        [int(f[2]['width']) for f in filas], [int(f[2]['height']) for f in filas],
+        [f[3] for f in filas], [json.dumps(f[4]) if f[4] is not None else None for f in filas],
+        ahora,
+    ), preparada=True)
+    log_database_operation('INSERT', 'faces', f'{len(filas)} caras de {len(detecciones)} fotos')
+
+
+@instrumentada
+def guardar_recortes_caras(conn, recortes, embedding_model=None):
+    """Anotar el recorte subido de cada cara y su embedding:
+    [(photo_id, face_index, crop_url, crop_public_id, crop_created_at, embedding en bytes o None)]
+
+    crop_created_at es el created_at que devuelve Cloudinary (ISO 8601, UTC): con él
+    caduca la URL en maintenance.py, igual que el recurso. Si falta se usa now().
+    """
+    if not recortes:
+        return
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE faces f
+        SET crop_url = v.crop_url, crop_public_id = v.crop_public_id,
+            crop_created_at = COALESCE(v.crop_created_at::timestamptz, now()),
+            embedding = v.embedding, embedding_model = CASE WHEN v.embedding IS NOT NULL THEN %s END,
+            updated_at = %s
+        FROM unnest(%s::int[], %s::int[], %s::text[], %s::text[], %s::text[], %s::bytea[])
+             AS v(photo_id, face_index, crop_url, crop_public_id, crop_created_at, embedding)
+        WHERE f.photo_id = v.photo_id AND f.face_index = v.face_index
+    ''', (embedding_model, datetime.now(), [int(r[0]) for r in recortes], [int(r[1]) for r in recortes],
+          [r[2] for r in recortes], [r[3] for r in recortes], [r[4] for r in recortes],
+          [psycopg2.Binary(r[5]) if r[5] is not None else None for r in recortes]), preparada=True)
+
+
+@instrumentada
+def asignar_personas_caras(conn, asignaciones, user_id):
+    """Anotar quién es cada cara: [(photo_id, face_index, persona_id)], solo en fotos del usuario
+
+    Devuelve las caras actualizadas (CaraConfirmada) para añadirlas al índice de sugerencias.
+    """
+    if not asignaciones:
+        return []
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        UPDATE faces f
+        SET persona_id = v.persona_id, updated_at = %s
+        FROM unnest(%s::int[], %s::int[], %s::int[]) AS v(photo_id, face_index, persona_id)
+        JOIN photos p ON p.id = v.photo_id AND p.user_id = %s
+        WHERE f.photo_id = v.photo_id AND f.face_index = v.face_index
+        RETURNING f.id, f.persona_id, f.embedding, f.embedding_model
+    ''', (datetime.now(), [int(a[0]) for a in asignaciones], [int(a[1]) for a in asignaciones],
+          [int(a[2]) for a in asignaciones], user_id), preparada=True)
+    return [CaraConfirmada._make(row) for row in cursor.fetchall()]
+
+
+@instrumentada
+def caras_confirmadas(conn, embedding_model):
+    """Caras con persona y embedding de ese modelo (CaraConfirmada), para reconstruir el índice"""
+    cursor = conn.cursor()
+    ejecutar(cursor, '''
+        SELECT id, persona_id, embedding, embedding_model FROM faces
+        WHERE persona_id IS NOT NULL AND embedding IS NOT NULL AND embedding_model = %s
+        ORDER BY id
+    ''', (embedding_model,), preparada=True)
+    return [CaraConfirmada._make(row) for row in cursor.fetchall()]
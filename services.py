@@ -8,6 +8,8 @@ import cloudinary
 import cloudinary.uploader
 import secrets
 
+from face_detectors import FacePPDetector
+
 # Configurar Cloudinary (asumiendo que se carga desde env en app.py, pero repetimos por independencia)
 cloudinary.config(
     cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
@@ -15,80 +17,90 @@ cloudinary.config(
     api_secret=os.getenv('CLOUDINARY_API_SECRET')
 )
 
+_facepp = FacePPDetector()
+
 def detect_faces_facepp(image_url):
     """
     Detecta caras en una imagen usando Face++ API con URL de imagen.
     Retorna lista de caras detectadas o None en error.
+    Para usar el detector configurado (FACE_DETECTOR) usar face_detectors.detector.
     """
-    api_key = os.getenv('FACEPP_API_KEY')
-    api_secret = os.getenv('FACEPP_API_SECRET')
-    
-    if not api_key or not api_secret:
-        print("⚠️ Face++ credentials not configured")
-        return None
-    
-    data = {
-        'api_key': api_key,
-        'api_secret': api_secret,
-        'image_url': image_url,
-        'return_attributes': 'age,gender'
-    }
-    
+    return _facepp.detect(image_url)
+
+FACE_CROP_SIZE = (200, 200)
+
+def _crop_face(image, face_rectangle, size=FACE_CROP_SIZE):
+    """Recorte con padding de una cara de una imagen ya decodificada, como JPEG en BytesIO"""
+    left = face_rectangle['left']
+    top = face_rectangle['top']
+    width = face_rectangle['width']
+    height = face_rectangle['height']
+
+    # Añadir padding para mejor encuadre
+    padding = int(min(width, height) * 0.1)
+    left = max(0, left - padding)
+    top = max(0, top - padding)
+    right = min(image.width, left + width + 2 * padding)
+    bottom = min(image.height, top + height + 2 * padding)
+
+    crop = image.crop((left, top, right, bottom))
+    crop = crop.resize(size, Image.Resampling.LANCZOS)
+    if crop.mode not in ('RGB', 'L'):
+        crop = crop.convert('RGB')  # JPEG no admite transparencia ni paleta
+
+    buffer = BytesIO()
+    crop.save(buffer, format='JPEG', quality=90)
+    buffer.seek(0)
+    return buffer
+
+def get_face_crops(image, face_rectangles, size=FACE_CROP_SIZE):
+    """
+    Recorta todas las caras de una imagen descargándola y decodificándola una sola vez.
+    image puede ser una URL, bytes o BytesIO. Retorna una lista con un BytesIO de
+    `size` por rectángulo (en el mismo orden), o None en los que fallen.
+    """
+    face_rectangles = list(face_rectangles)
+    recortes = [None] * len(face_rectangles)
+    if not face_rectangles:
+        return recortes
+
     try:
-        response = requests.post(
-            'https://api-us.faceplusplus.com/facepp/v3/detect',
-            data=data,
-            timeout=15  # Reducido de 30 a 15 segundos
-        )
-        result = response.json()
-        
-        if 'faces' in result:
-            return result['faces']
-        else:
-            print(f"⚠️ No faces detected or error: {result.get('error_message', 'Unknown')}")
-            return None
-            
+        if isinstance(image, str):
+            response = requests.get(image, timeout=10)  # Timeout para descarga de imagen
+            if response.status_code != 200:
+                print(f"⚠️ Error downloading image: {response.status_code}")
+                return recortes
+            image = response.content
+            del response
+        if isinstance(image, bytes):
+            image = BytesIO(image)
+
+        decoded = Image.open(image)
+        try:
+            decoded.load()  # Decodificar ya para poder soltar los bytes descargados
+            image = None
+            for idx, face_rectangle in enumerate(face_rectangles):
+                try:
+                    recortes[idx] = _crop_face(decoded, face_rectangle, size)
+                except Exception as e:
+                    print(f"❌ Error in get_face_crops (cara {idx + 1}): {e}")
+        finally:
+            # Liberar la imagen decodificada en cuanto está el último recorte
+            decoded.close()
+            del decoded
+
     except Exception as e:
-        print(f"❌ Error in detect_faces_facepp: {e}")
-        return None
+        print(f"❌ Error in get_face_crops: {e}")
+
+    return recortes
 
 def get_face_crop(image_url, face_rectangle):
     """
     Recorta la cara de la imagen usando PIL basado en el rectángulo proporcionado.
     Retorna buffer BytesIO con la imagen recortada o None en error.
+    Para varias caras de la misma foto usar get_face_crops (una sola descarga).
     """
-    try:
-        response = requests.get(image_url, timeout=10)  # Timeout para descarga de imagen
-        if response.status_code != 200:
-            print(f"⚠️ Error downloading image: {response.status_code}")
-            return None
-        
-        image = Image.open(BytesIO(response.content))
-        
-        left = face_rectangle['left']
-        top = face_rectangle['top']
-        width = face_rectangle['width']
-        height = face_rectangle['height']
-        
-        # Añadir padding para mejor encuadre
-        padding = int(min(width, height) * 0.1)
-        left = max(0, left - padding)
-        top = max(0, top - padding)
-        right = min(image.width, left + width + 2 * padding)
-        bottom = min(image.height, top + height + 2 * padding)
-        
-        crop = image.crop((left, top, right, bottom))
-        crop = crop.resize((200, 200), Image.Resampling.LANCZOS)
-        
-        buffer = BytesIO()
-        crop.save(buffer, format='JPEG', quality=90)
-        buffer.seek(0)
-        
-        return buffer
-        
-    except Exception as e:
-        print(f"❌ Error in get_face_crop: {e}")
-        return None
+    return get_face_crops(image_url, [face_rectangle])[0]
 
 def get_face_crop_from_facepp(image_url, face_token):
     """
@@ -131,7 +143,7 @@ def get_face_crop_from_facepp(image_url, face_token):
 def upload_temp_face_crop(buffer):
     """
     Sube un recorte temporal de cara a Cloudinary en carpeta temp_faces.
-    Retorna dict con secure_url y public_id o dict con error.
+    Retorna dict con secure_url, public_id y created_at o dict con error.
     """
     try:
         public_id = f"temp_face_{secrets.token_hex(8)}"
@@ -151,7 +163,8 @@ def upload_temp_face_crop(buffer):
         
         return {
             'secure_url': result['secure_url'],
-            'public_id': result['public_id']
+            'public_id': result['public_id'],
+            'created_at': result.get('created_at')
         }
         
     except Exception as e:
@@ -0,0 +1,108 @@
+"""
+Canal Server-Sent Events del estado de sesión (/api/events)
+
+La caducidad de la sesión se calcula una sola vez al conectar; a partir de ahí
+el generador solo duerme y emite eventos (sin base de datos ni get_current_user):
+
+    session-status   HTML de session_status.html cada vez que cambia el minuto
+    session-warning  HTML del aviso, una vez, cuando quedan WARNING_MINUTES
+    session-expired  al caducar; el navegador vuelve a /
+
+Cada conexión dura como mucho SSE_STREAM_SECONDS: con workers gthread ocupa un
+hilo mientras está abierta, así que se cierra y EventSource se reconecta solo
+(y recalcula la caducidad, por ejemplo tras extender la sesión). Además cada
+worker acepta como mucho SSE_MAX_STREAMS canales a la vez, para que siempre
+queden hilos para las peticiones normales; el resto recibe 204 y el navegador
+sigue con el sondeo HTMX ([!window.sessionEventsActive]).
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+WARNING_MINUTES = 10
+HEARTBEAT_SECONDS = int(os.getenv('SSE_HEARTBEAT_SECONDS', 20))
+STREAM_SECONDS = int(os.getenv('SSE_STREAM_SECONDS', 600))
+RETRY_MS = 5000
+# Canales abiertos a la vez por worker; debe quedar por debajo de `threads` de gunicorn
+MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 2))
+
+_streams = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+def reservar_stream():
+    """Ocupar uno de los MAX_STREAMS canales del worker; False si están todos en uso"""
+    return _streams.acquire(blocking=False)
+
+
+def liberar_stream():
+    """Devolver el canal al cerrarse la respuesta"""
+    _streams.release()
+
+
+def session_time_info(expires, now=None):
+    """Minutos restantes de la sesión tal como los muestra session_status.html"""
+    now = now or datetime.now()
+    total_minutes = int((expires - now).total_seconds() / 60)
+    if total_minutes <= 0:
+        return {
+            'minutes_remaining': 0,
+            'hours_remaining': 0,
+            'mins_remaining': 0,
+            'is_expiring_soon': True
+        }
+    return {
+        'minutes_remaining': total_minutes,
+        'hours_remaining': total_minutes // 60,
+        'mins_remaining': total_minutes % 60,
+        'is_expiring_soon': total_minutes < 30
+    }
+
+
+def format_event(event, data=''):
+    """Un evento SSE; cada línea de `data` va en su propia línea data:"""
+    lines = [f'event: {event}']
+    lines.extend(f'data: {line}' for line in (str(data).splitlines() or ['']))
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream(expires, render_status, render_warning, max_seconds=STREAM_SECONDS,
+           heartbeat=HEARTBEAT_SECONDS, clock=time.time, sleep=time.sleep):
+    """Generador de eventos para una sesión que caduca en `expires` (datetime)
+
+    render_status(session_info) y render_warning(time_remaining) devuelven HTML.
+    """
+    expires_ts = expires.timestamp()
+    warning_ts = expires_ts - WARNING_MINUTES * 60
+    end = clock() + max_seconds
+    warned = False
+
+    yield f'retry: {RETRY_MS}\n\n'
+    last_minutes = None
+    while True:
+        now = clock()
+        if now >= expires_ts:
+            if last_minutes != 0:
+                yield format_event('session-status', render_status(session_time_info(expires, datetime.fromtimestamp(now))))
+            yield format_event('session-expired')
+            return
+
+        info = session_time_info(expires, datetime.fromtimestamp(now))
+        if info['minutes_remaining'] != last_minutes:
+            last_minutes = info['minutes_remaining']
+            yield format_event('session-status', render_status(info))
+        if not warned and now >= warning_ts:
+            warned = True
+            yield format_event('session-warning', render_warning(f"{info['minutes_remaining']} minutos"))
+
+        if now >= end:
+            return
+
+        # Dormir hasta el próximo cambio de minuto, el aviso, el final o el latido
+        remaining = expires_ts - now
+        siguiente = [remaining % 60 or 60, heartbeat, end - now]
+        if not warned:
+            siguiente.append(warning_ts - now)
+        sleep(max(min(siguiente), 0.05))
+        # Comentario SSE: mantiene viva la conexión y detecta clientes desconectados
+        yield ': ping\n\n'
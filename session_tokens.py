@@ -0,0 +1,90 @@
+"""
+Tokens de acceso firmados (opcional, SIGNED_ACCESS_TOKENS=true)
+
+Formato: v1.<user_id>.<expira (epoch)>.<generación>.<nonce>.<firma>, firmado con
+HMAC-SHA256 y SECRET_KEY. Se verifica en el propio proceso sin consultar users;
+solo la generación del usuario (tabla token_generations) se lee de PostgreSQL,
+y como mucho una vez cada `ttl` segundos por worker. Subir la generación
+(logout) revoca todos los tokens anteriores del usuario.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+PREFIX = 'v1'
+
+
+class TokenClaims(namedtuple('TokenClaims', 'user_id expires generation')):
+    """Datos firmados de un token"""
+    __slots__ = ()
+
+    @property
+    def expires_at(self):
+        return datetime.fromtimestamp(self.expires)
+
+
+def _firma(secret, payload):
+    digest = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def is_signed_token(token):
+    return isinstance(token, str) and token.startswith(PREFIX + '.')
+
+
+def issue_token(secret, user_id, expires_at, generation):
+    """Crear un token firmado para user_id que caduca en expires_at (datetime)"""
+    payload = f'{PREFIX}.{int(user_id)}.{int(expires_at.timestamp())}.{int(generation)}.{secrets.token_urlsafe(8)}'
+    return f'{payload}.{_firma(secret, payload)}'
+
+
+def verify_token(secret, token):
+    """TokenClaims si la firma es válida y no ha caducado; None en otro caso"""
+    if not is_signed_token(token):
+        return None
+    payload, _, firma = token.rpartition('.')
+    if not hmac.compare_digest(firma, _firma(secret, payload)):
+        return None
+    try:
+        _, user_id, expires, generation, _ = payload.split('.')
+        claims = TokenClaims(int(user_id), int(expires), int(generation))
+    except ValueError:
+        return None
+    if claims.expires <= time.time():
+        return None
+    return claims
+
+
+class GenerationCache:
+    """Generación vigente de cada usuario, cacheada por worker durante `ttl` segundos"""
+
+    def __init__(self, ttl=15):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # user_id -> (expires_at, generation)
+
+    def get(self, user_id):
+        """Generación cacheada o None si no está o está caducada"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, user_id, generation):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, generation)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+# Instancia global
+generation_cache = GenerationCache(ttl=int(os.getenv('TOKEN_GENERATION_TTL', 15)))
@@ -0,0 +1,79 @@
+// Estado de sesión por Server-Sent Events (/api/events)
+// Mientras el canal está abierto, window.sessionEventsActive desactiva el sondeo
+// HTMX de /api/session-status y /api/session-warning, que queda como respaldo.
+(function () {
+  if (!window.EventSource) return;
+
+  let source = null;
+
+  const connect = () => {
+    if (source) return;
+    source = new EventSource("/api/events");
+
+    source.onopen = () => {
+      window.sessionEventsActive = true;
+    };
+
+    source.onerror = () => {
+      // Sesión no autenticada (204) o error definitivo: volver al sondeo
+      window.sessionEventsActive = false;
+      if (source.readyState === EventSource.CLOSED) {
+        source = null;
+      }
+    };
+
+    source.addEventListener("session-status", (event) => {
+      const current = document.getElementById("session-time-remaining");
+      if (!current) return;
+      const wrapper = document.createElement("div");
+      wrapper.innerHTML = event.data;
+      const updated = wrapper.firstElementChild;
+      if (!updated) return;
+      current.replaceWith(updated);
+      htmx.process(updated);
+    });
+
+    source.addEventListener("session-warning", (event) => {
+      if (document.getElementById("sessionWarningModal")) return;
+      const wrapper = document.createElement("div");
+      wrapper.innerHTML = event.data;
+      const modal = wrapper.querySelector("#sessionWarningModal");
+      if (!modal) return;
+      document.body.appendChild(modal);
+      htmx.process(modal);
+      // innerHTML no ejecuta los <script> del aviso (handleExtendResponse)
+      wrapper.querySelectorAll("script").forEach((old) => {
+        const script = document.createElement("script");
+        script.textContent = old.textContent;
+        document.body.appendChild(script);
+      });
+    });
+
+    source.addEventListener("session-expired", () => {
+      source.close();
+      source = null;
+      window.sessionEventsActive = false;
+      setTimeout(() => {
+        window.location.href = "/";
+      }, 3000);
+    });
+  };
+
+  const reconnect = () => {
+    if (source) source.close();
+    source = null;
+    window.sessionEventsActive = false;
+    connect();
+  };
+
+  // Tras iniciar sesión, cerrarla o extenderla (HTMX), reconectar con la nueva caducidad
+  document.addEventListener("htmx:afterRequest", (event) => {
+    const path = event.detail.pathInfo && event.detail.pathInfo.requestPath;
+    if (path && /^\/(api\/auth\/|api\/extend-session|logout)/.test(path)) {
+      reconnect();
+    }
+  });
+
+  // Sin sesión el servidor responde 204 y EventSource no reintenta
+  document.addEventListener("DOMContentLoaded", connect);
+})();
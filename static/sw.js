@@ -105,6 +105,11 @@ self.addEventListener('fetch', event => {
     return;
   }
 
+  // Canal SSE de sesión: sin pasar por el Service Worker (respuesta en streaming)
+  if (url.pathname === '/api/events') {
+    return;
+  }
+
   // No cachear URLs excluidas
   if (EXCLUDE_URLS.some(excludeUrl => url.pathname.startsWith(excludeUrl))) {
     event.respondWith(fetch(request));
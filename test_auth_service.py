@@ -0,0 +1,115 @@
+"""
+Códigos de verificación de email (auth_service.py)
+"""
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import auth_service
+import repository
+
+
+@pytest.fixture
+def email():
+    """Email nuevo, sin cuenta ni código"""
+    return f'{uuid.uuid4().hex[:12]}@example.com'
+
+
+def sesiones(conn, email):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT count(*) FROM sessions s JOIN users u ON u.id = s.user_id WHERE u.email = %s
+    ''', (email,))
+    return cursor.fetchone()[0]
+
+
+def verificar(conn, email, code, ahora=None):
+    ahora = ahora or datetime.now()
+    return auth_service.verificar_codigo(conn, email, code, uuid.uuid4().hex,
+                                         ahora + auth_service.SESSION_TTL, ahora=ahora)
+
+
+def test_codigo_incorrecto(conn, email):
+    assert auth_service.emitir_codigo_registro(conn, email, 'Ana', '123456')
+    assert verificar(conn, email, '654321') is None
+    assert auth_service.motivo_rechazo(conn, email, '654321') == auth_service.CODIGO_INCORRECTO
+    # El código bueno sigue vigente tras un intento fallido
+    usuario = verificar(conn, email, '123456')
+    assert usuario['name'] == 'Ana'
+    assert usuario['created']
+    assert sesiones(conn, email) == 1
+
+
+def test_codigo_caducado(conn, email):
+    emitido = datetime.now() - auth_service.CODE_TTL - timedelta(seconds=1)
+    assert auth_service.emitir_codigo_registro(conn, email, 'Ana', '123456', ahora=emitido)
+    assert verificar(conn, email, '123456') is None
+    assert auth_service.motivo_rechazo(conn, email, '123456') == auth_service.CODIGO_CADUCADO
+    cursor = conn.cursor()
+    cursor.execute('SELECT count(*) FROM users WHERE email = %s', (email,))
+    assert cursor.fetchone() == (0,)
+
+
+def test_codigo_usado_dos_veces(conn, email, user_id):
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET email = %s WHERE id = %s', (email, user_id))
+    assert auth_service.emitir_codigo_login(conn, email, '123456') == 'Prueba'
+
+    usuario = verificar(conn, email, '123456')
+    assert usuario['id'] == user_id
+    assert not usuario['created']
+    assert verificar(conn, email, '123456') is None
+    assert auth_service.motivo_rechazo(conn, email, '123456') == auth_service.CODIGO_NO_ENCONTRADO
+    assert sesiones(conn, email) == 1
+
+
+def test_codigo_usado_a_la_vez(pool, email):
+    """Dos peticiones simultáneas con el mismo código: solo una borra la fila y abre sesión"""
+    conn = pool.getconn()
+    try:
+        assert auth_service.emitir_codigo_registro(conn, email, 'Ana', '123456')
+    finally:
+        pool.putconn(conn)
+
+    barrera = threading.Barrier(2)
+    resultados = []
+
+    def usar():
+        conn = pool.getconn()
+        try:
+            barrera.wait()
+            resultados.append(verificar(conn, email, '123456'))
+        finally:
+            pool.putconn(conn)
+
+    hilos = [threading.Thread(target=usar) for _ in range(2)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(timeout=10)
+
+    assert len(resultados) == 2
+    assert sum(r is not None for r in resultados) == 1
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT count(*) FROM users WHERE email = %s', (email,))
+        assert cursor.fetchone() == (1,)
+        assert sesiones(conn, email) == 1
+    finally:
+        pool.putconn(conn)
+
+
+def test_solicitud_cambio_email_pendiente(conn, user_id, email):
+    assert auth_service.solicitud_cambio_email_pendiente(conn, user_id) is None
+    assert repository.contar_solicitudes_cambio_email(conn, user_id) == 0
+    assert auth_service.solicitar_cambio_email(conn, user_id, email, '123456')
+
+    new_email, expires = auth_service.solicitud_cambio_email_pendiente(conn, user_id)
+    assert new_email == email
+    assert repository.contar_solicitudes_cambio_email(conn, user_id) == 1
+    # Caducada: ya no está pendiente, pero sigue contando hasta que la purgue el mantenimiento
+    assert auth_service.solicitud_cambio_email_pendiente(conn, user_id, ahora=expires) is None
+    assert repository.contar_solicitudes_cambio_email(conn, user_id) == 1
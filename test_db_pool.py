@@ -0,0 +1,88 @@
+"""
+Pool de conexiones por worker (db_pool.py)
+"""
+import threading
+import time
+
+import pytest
+
+import repository
+from db_pool import PoolTimeout
+
+
+def test_checkout_timeout_con_pool_agotado(pool):
+    a, b = pool.getconn(), pool.getconn()
+    try:
+        inicio = time.monotonic()
+        with pytest.raises(PoolTimeout):
+            pool.getconn()
+        assert time.monotonic() - inicio >= pool.checkout_timeout
+        assert pool.stats()['timeouts'] == 1
+        assert pool.stats()['in_use'] == 2
+    finally:
+        pool.putconn(a)
+        pool.putconn(b)
+
+
+def test_checkout_espera_a_que_se_devuelva_una_conexion(pool):
+    a, b = pool.getconn(), pool.getconn()
+    threading.Timer(0.1, pool.putconn, args=(a,)).start()
+    c = pool.getconn()
+    try:
+        assert c is a
+        stats = pool.stats()
+        assert stats['waits'] == 1
+        assert stats['timeouts'] == 0
+        assert 0 < stats['wait_time_max'] < pool.checkout_timeout
+    finally:
+        pool.putconn(b)
+        pool.putconn(c)
+
+
+def test_reset_al_devolver_conserva_sentencias_preparadas(pool):
+    conn = pool.getconn()
+    cursor = conn.cursor()
+    cursor.execute('SHOW statement_timeout')
+    statement_timeout = cursor.fetchone()
+    sql = 'SELECT %s::int + 1'
+    repository.ejecutar(cursor, sql, (1,), preparada=True)
+    assert cursor.fetchone() == (2,)
+    cursor.execute("SET statement_timeout = '1234ms'")
+    cursor.execute('SELECT pg_advisory_lock(4242)')
+    cursor.execute('CREATE TEMP TABLE temporal (id int)')
+    conn.autocommit = False
+    cursor.execute('SELECT 1')  # transacción abierta al devolverla
+    pool.putconn(conn)
+
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor()
+        # RESET ALL, DISCARD TEMP y pg_advisory_unlock_all limpian la sesión...
+        assert conn.autocommit
+        cursor.execute('SHOW statement_timeout')
+        assert cursor.fetchone() == statement_timeout
+        cursor.execute("SELECT to_regclass('pg_temp.temporal')")
+        assert cursor.fetchone() == (None,)
+        cursor.execute("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+        assert cursor.fetchone() == (0,)
+        # ...pero sin DEALLOCATE: la sentencia preparada sigue en la sesión
+        assert len(conn.prepared_statements) == 1
+        cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+        assert cursor.fetchone() == (1,)
+        repository.ejecutar(cursor, sql, (41,), preparada=True)
+        assert cursor.fetchone() == (42,)
+        assert pool.stats()['connections_created'] == 1
+    finally:
+        pool.putconn(conn)
+
+
+def test_conexion_rota_se_descarta(pool):
+    conn = pool.getconn()
+    conn.close()
+    pool.putconn(conn)
+    stats = pool.stats()
+    assert stats['size'] == 0
+    assert stats['idle'] == 0
+    nueva = pool.getconn()
+    assert nueva is not conn
+    pool.putconn(nueva)
@@ -0,0 +1,86 @@
+"""
+Cola de envío de emails del worker (email_service.py)
+"""
+import smtplib
+import threading
+import time
+
+from email_service import EmailQueue, PreparedEmail
+
+
+class ServicioFalso:
+    """EmailService sin SMTP: deliver falla con `error` mientras esté puesto"""
+
+    idle_timeout = 60
+
+    def __init__(self, error=None, lento=0):
+        self.error = error
+        self.lento = lento
+        self.entregados = []
+        self.intentos = 0
+        self.primer_intento = threading.Event()
+
+    def is_configured(self):
+        return True
+
+    def deliver(self, msg):
+        self.intentos += 1
+        self.primer_intento.set()
+        time.sleep(self.lento)
+        if self.error:
+            raise self.error
+        self.entregados.append(msg.to)
+
+    def close(self):
+        pass
+
+
+def mensaje(to):
+    return PreparedEmail('app@example.com', to, b'')
+
+
+def test_stop_envia_lo_encolado():
+    servicio = ServicioFalso()
+    cola = EmailQueue(servicio)
+    for i in range(3):
+        cola.enqueue(mensaje(f'{i}@example.com'))
+    cola.stop()
+    assert servicio.entregados == ['0@example.com', '1@example.com', '2@example.com']
+    assert cola.stats()['sent'] == 3
+
+
+def test_stop_corta_la_espera_entre_reintentos():
+    """Con el backoff máximo de 60 s, stop() no espera: un último intento y se cuenta como fallido"""
+    servicio = ServicioFalso(error=smtplib.SMTPServerDisconnected('caído'))
+    cola = EmailQueue(servicio, backoff=60, max_backoff=60)
+    cola.enqueue(mensaje('a@example.com'))
+    cola.enqueue(mensaje('b@example.com'))
+    # Esperar a que el primero esté en la espera de 60 s antes del reintento
+    for _ in range(100):
+        if cola.stats()['retries']:
+            break
+        time.sleep(0.05)
+
+    inicio = time.monotonic()
+    cola.stop(timeout=5)
+    assert time.monotonic() - inicio < 5
+    stats = cola.stats()
+    assert stats['failed'] == 2
+    assert stats['depth'] == 0
+    # a: el intento inicial y el último tras cortar la espera; b: uno solo
+    assert servicio.intentos == 3
+
+
+def test_stop_da_por_fallido_lo_que_no_se_envio_a_tiempo():
+    servicio = ServicioFalso(lento=0.5)
+    cola = EmailQueue(servicio)
+    for i in range(5):
+        cola.enqueue(mensaje(f'{i}@example.com'))
+    assert servicio.primer_intento.wait(5)
+    # El primero sigue enviándose cuando vence el timeout; los otros cuatro se descartan
+    cola.stop(timeout=0.1)
+    stats = cola.stats()
+    assert stats['depth'] == 0
+    assert stats['failed'] == 4
+    cola._thread.join(5)
+    assert servicio.entregados == ['0@example.com']
@@ -0,0 +1,56 @@
+"""
+Paginación por cursor (keyset) de las galerías
+"""
+from datetime import datetime
+
+import repository
+
+
+def insertar_fotos(conn, user_id, fotos):
+    """Insertar [(año, mes, created_at)]; devuelve los ids"""
+    cursor = conn.cursor()
+    ids = []
+    for año, mes, created_at in fotos:
+        cursor.execute('''
+            INSERT INTO photos (user_id, nombre, nombre_archivo, año, mes, created_at)
+            VALUES (%s, 'foto', 'https://example.com/foto.jpg', %s, %s, %s)
+            RETURNING id
+        ''', (user_id, año, mes, created_at))
+        ids.append(cursor.fetchone()[0])
+    return ids
+
+
+def recorrer_galeria(conn, user_id, page_size, max_paginas=50):
+    """Ids de todas las páginas, pasando el cursor codificado como lo hace render_galeria"""
+    consulta = repository.consulta_galeria(conn, ['p.user_id = %s'], [user_id])
+    vistas = []
+    despues_de = None
+    for _ in range(max_paginas):
+        fotos = repository.pagina_galeria(conn, consulta, page_size + 1, despues_de)
+        vistas.extend(foto.id for foto in fotos[:page_size])
+        if len(fotos) <= page_size:
+            return vistas
+        cursor = repository.encode_galeria_cursor(repository.clave_galeria(consulta, fotos[page_size - 1]))
+        despues_de = repository.decode_galeria_cursor(cursor)
+    raise AssertionError(f'La paginación no terminó en {max_paginas} páginas: {vistas}')
+
+
+def test_paginacion_con_fotos_sin_fecha(conn, user_id):
+    con_fecha = insertar_fotos(conn, user_id, [(2023, 5, datetime(2023, 5, 2)), (2023, 5, datetime(2023, 5, 1))])
+    sin_fecha = insertar_fotos(conn, user_id, [(2023, 5, None)] * 5)
+    sin_mes = insertar_fotos(conn, user_id, [(None, None, None)] * 2)
+
+    for page_size in (1, 2, 3):
+        vistas = recorrer_galeria(conn, user_id, page_size)
+        assert len(vistas) == len(set(vistas))
+        # Mismo orden que GALERIA_ORDEN: las fechas antes que las NULL (-infinity), id descendente
+        assert vistas == con_fecha + sorted(sin_fecha, reverse=True) + sorted(sin_mes, reverse=True)
+
+
+def test_cursor_sin_fecha_ida_y_vuelta():
+    cursor = repository.encode_galeria_cursor([2023, 5, repository.SIN_FECHA, 42])
+    assert repository.decode_galeria_cursor(cursor) == (2023, 5, repository.SIN_FECHA, 42)
+    fecha = datetime(2023, 5, 1, 12, 30)
+    cursor = repository.encode_galeria_cursor([2023, 5, fecha, 7])
+    assert repository.decode_galeria_cursor(cursor) == (2023, 5, fecha, 7)
+    assert repository.decode_galeria_cursor('no-es-un-cursor') is None
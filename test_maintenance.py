@@ -0,0 +1,58 @@
+"""
+Purga de los recortes temporales de caras (maintenance.py)
+"""
+from datetime import datetime, timedelta, timezone
+
+import maintenance
+import repository
+
+PURGA_RECORTES = dict(maintenance.PURGAS)['faces.crop_url']
+
+
+def insertar_foto(conn, user_id):
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO photos (user_id, nombre, nombre_archivo) VALUES (%s, 'foto', 'https://example.com/foto.jpg')
+        RETURNING id
+    ''', (user_id,))
+    return cursor.fetchone()[0]
+
+
+def cara(left):
+    return {'face_rectangle': {'left': left, 'top': 10, 'width': 50, 'height': 50}, 'face_token': 'token'}
+
+
+def recortes(conn, photo_id):
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT face_index, crop_public_id, crop_created_at FROM faces WHERE photo_id = %s ORDER BY face_index
+    ''', (photo_id,))
+    return cursor.fetchall()
+
+
+def test_redeteccion_no_retrasa_la_caducidad_del_recorte(conn, user_id):
+    photo_id = insertar_foto(conn, user_id)
+    repository.guardar_caras_detectadas(conn, {photo_id: [cara(10), cara(100)]}, None)
+    subido = datetime.now(timezone.utc) - maintenance.TEMP_FACES_MAX_AGE - timedelta(minutes=1)
+    repository.guardar_recortes_caras(conn, [
+        (photo_id, 0, 'https://example.com/0.jpg', 'temp_faces/viejo', subido.isoformat(), None),
+        (photo_id, 1, 'https://example.com/1.jpg', 'temp_faces/nuevo', None, None),
+    ])
+
+    # Re-detectar la misma cara actualiza updated_at pero conserva la fecha del recorte
+    repository.guardar_caras_detectadas(conn, {photo_id: [cara(10), cara(100)]}, None)
+    (_, public_id, crop_created_at), _ = recortes(conn, photo_id)
+    assert public_id == 'temp_faces/viejo'
+    assert crop_created_at == subido
+
+    maintenance.purgar(conn, 'faces.crop_url', PURGA_RECORTES)
+    assert [(idx, public_id) for idx, public_id, _ in recortes(conn, photo_id)] == \
+        [(0, None), (1, 'temp_faces/nuevo')]
+
+
+def test_cara_movida_pierde_el_recorte(conn, user_id):
+    photo_id = insertar_foto(conn, user_id)
+    repository.guardar_caras_detectadas(conn, {photo_id: [cara(10)]}, None)
+    repository.guardar_recortes_caras(conn, [(photo_id, 0, 'https://example.com/0.jpg', 'temp_faces/a', None, None)])
+    repository.guardar_caras_detectadas(conn, {photo_id: [cara(20)]}, None)
+    assert recortes(conn, photo_id) == [(0, None, None)]
@@ -0,0 +1,141 @@
+"""
+Migraciones del esquema (migrations.py) e importación de SQLite (migracion_db.py)
+"""
+import sqlite3
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import migracion_db
+import migrations
+
+ESQUEMA_SQLITE = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY, name TEXT, alias TEXT, phone TEXT, email TEXT,
+        access_token TEXT, token_expires TIMESTAMP, verification_code TEXT, code_expires TIMESTAMP,
+        created_at TIMESTAMP, updated_at TIMESTAMP, last_interaction_date DATE,
+        total_interaction_days INTEGER
+    );
+    CREATE TABLE sessions (id INTEGER PRIMARY KEY, user_id INTEGER, token TEXT, expires TIMESTAMP,
+                           created_at TIMESTAMP);
+    CREATE TABLE verification_codes (id INTEGER PRIMARY KEY, email TEXT, name TEXT, code TEXT,
+                                     expires TIMESTAMP, created_at TIMESTAMP);
+    CREATE TABLE photos (id INTEGER PRIMARY KEY, user_id INTEGER, nombre TEXT, nombre_archivo TEXT,
+                         categoria TEXT, mes INTEGER, año INTEGER, personas_ids TEXT,
+                         created_at TIMESTAMP, updated_at TIMESTAMP);
+    CREATE TABLE personas (id INTEGER PRIMARY KEY, nombre TEXT, imagen TEXT, created_at TIMESTAMP,
+                           updated_at TIMESTAMP);
+'''
+
+
+def conectar(dsn):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    return conn
+
+
+@pytest.fixture
+def sqlite_con_duplicados(tmp_path):
+    """SQLite antigua con dos personas con el mismo nombre y dos códigos para el mismo email"""
+    conn = sqlite3.connect(tmp_path / 'users.db')
+    conn.row_factory = sqlite3.Row
+    conn.executescript(ESQUEMA_SQLITE)
+    conn.executescript('''
+        INSERT INTO users (id, name, email, total_interaction_days) VALUES (1, 'Ana', 'ana@example.com', 0);
+        INSERT INTO verification_codes (id, email, name, code, expires, created_at) VALUES
+            (1, 'ana@example.com', 'Ana', '111111', '2099-01-01 00:00:00', '2024-01-01 00:00:00'),
+            (2, 'ana@example.com', 'Ana', '222222', '2099-01-01 00:00:00', '2024-01-02 00:00:00');
+        INSERT INTO personas (id, nombre) VALUES (1, 'Luis'), (2, 'Luis'), (3, 'Eva');
+        INSERT INTO photos (id, user_id, nombre, nombre_archivo, personas_ids) VALUES
+            (1, 1, 'a', 'https://example.com/a.jpg', '[1, 3]'),
+            (2, 1, 'b', 'https://example.com/b.jpg', '[2]');
+    ''')
+    yield conn
+    conn.close()
+
+
+def test_importar_sqlite_con_duplicados(nueva_base_de_datos, sqlite_con_duplicados):
+    pg_conn = conectar(nueva_base_de_datos())
+    try:
+        migracion_db.create_tables(pg_conn)
+        assert [v for v, _, applied in migrations.estado(pg_conn) if applied] == \
+            [v for v in range(1, migracion_db.VERSION_ESQUEMA_SQLITE + 1) if v != 5 or _hay_pg_trgm(pg_conn)]
+
+        for importar in (migracion_db.migrate_users, migracion_db.migrate_sessions,
+                         migracion_db.migrate_verification_codes, migracion_db.migrate_photos,
+                         migracion_db.migrate_personas):
+            importar(sqlite_con_duplicados, pg_conn)
+        migrations.backfill_photo_personas(pg_conn.cursor())
+        migracion_db.finish_migrations(pg_conn)
+
+        cursor = pg_conn.cursor()
+        cursor.execute('SELECT id, nombre FROM personas ORDER BY id')
+        assert cursor.fetchall() == [(1, 'Luis'), (3, 'Eva')]
+        cursor.execute('SELECT photo_id, persona_id FROM photo_personas ORDER BY 1, 2')
+        assert cursor.fetchall() == [(1, 1), (1, 3), (2, 1)]
+        cursor.execute('SELECT code FROM verification_codes WHERE email = %s', ('ana@example.com',))
+        assert cursor.fetchall() == [('222222',)]
+        assert all(applied for v, _, applied in migrations.estado(pg_conn) if v != 5)
+    finally:
+        pg_conn.close()
+
+
+def test_importar_sqlite_rechaza_esquema_posterior(migrated_database):
+    pg_conn = conectar(migrated_database)
+    try:
+        with pytest.raises(SystemExit):
+            migracion_db.create_tables(pg_conn)
+    finally:
+        pg_conn.close()
+
+
+def _hay_pg_trgm(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm')")
+    return cursor.fetchone()[0]
+
+
+def test_migrar_concurrente_aplica_cada_version_una_vez(nueva_base_de_datos):
+    """Dos procesos que arrancan a la vez: el advisory lock serializa y el segundo no repite nada"""
+    dsn = nueva_base_de_datos()
+    bloqueo = conectar(dsn)
+    cursor = bloqueo.cursor()
+    cursor.execute('SELECT pg_advisory_lock(%s)', (migrations.MIGRATIONS_LOCK_ID,))
+
+    resultados = {}
+
+    def arrancar(nombre):
+        conn = conectar(dsn)
+        try:
+            resultados[nombre] = migrations.migrar(conn)
+        except Exception as e:
+            resultados[nombre] = e
+        finally:
+            conn.close()
+
+    hilos = [threading.Thread(target=arrancar, args=(nombre,)) for nombre in ('a', 'b')]
+    for hilo in hilos:
+        hilo.start()
+    try:
+        # Los dos esperan el lock mientras lo tiene otro
+        time.sleep(3 * migrations.MIGRATIONS_LOCK_POLL)
+        cursor.execute("SELECT to_regclass('schema_migrations')")
+        assert cursor.fetchone()[0] is None
+    finally:
+        cursor.execute('SELECT pg_advisory_unlock(%s)', (migrations.MIGRATIONS_LOCK_ID,))
+        for hilo in hilos:
+            hilo.join(timeout=60)
+
+    # Con pg_advisory_lock el segundo quedaba con la transacción abierta y CREATE INDEX
+    # CONCURRENTLY del primero acababa en DeadlockDetected
+    assert all(isinstance(r, list) for r in resultados.values()), resultados
+    aplicadas = [v for v, _, applied_at in migrations.estado(bloqueo) if applied_at]
+    assert sorted(resultados['a'] + resultados['b']) == aplicadas
+    assert [] in (resultados['a'], resultados['b'])
+    assert migrations.migrar(bloqueo) == []
+
+    cursor.execute('SELECT version, count(*) FROM schema_migrations GROUP BY version HAVING count(*) > 1')
+    assert cursor.fetchall() == []
+    bloqueo.close()
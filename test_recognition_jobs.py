@@ -0,0 +1,48 @@
+"""
+Cola de trabajos de reconocimiento facial (recognition_jobs.py)
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import db_pool
+import recognition_jobs
+
+
+@pytest.fixture
+def trabajo(conn, user_id):
+    """Trabajo reservado recién tomado de la cola"""
+    cursor = conn.cursor()
+    cursor.execute("UPDATE recognition_jobs SET status = 'done' WHERE status IN ('queued', 'running')")
+    recognition_jobs.encolar(conn, user_id, [])
+    return recognition_jobs.tomar_trabajo(conn)
+
+
+def reserva(conn, trabajo):
+    cursor = conn.cursor()
+    cursor.execute('SELECT locked_until FROM recognition_jobs WHERE id = %s', (trabajo.id,))
+    return cursor.fetchone()[0]
+
+
+def test_latido_renueva_la_reserva(monkeypatch, pool, conn, trabajo):
+    monkeypatch.setattr(db_pool, 'get_pool', lambda: pool)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE recognition_jobs SET locked_until = %s WHERE id = %s',
+                   (datetime.now() + timedelta(seconds=1), trabajo.id))
+
+    with recognition_jobs.Latido(trabajo, intervalo=timedelta(seconds=0.1)) as latido:
+        latido.perdida.wait(0.5)
+    assert not latido.perdida.is_set()
+    assert reserva(conn, trabajo) > datetime.now() + recognition_jobs.RECOGNITION_LEASE - timedelta(seconds=5)
+
+
+def test_latido_detecta_trabajo_retomado(monkeypatch, pool, conn, trabajo):
+    monkeypatch.setattr(db_pool, 'get_pool', lambda: pool)
+    # Otro worker lo tomó tras caducar la reserva
+    cursor = conn.cursor()
+    cursor.execute('UPDATE recognition_jobs SET attempts = attempts + 1 WHERE id = %s', (trabajo.id,))
+    antes = reserva(conn, trabajo)
+
+    with recognition_jobs.Latido(trabajo, intervalo=timedelta(seconds=0.1)) as latido:
+        assert latido.perdida.wait(5)
+    assert reserva(conn, trabajo) == antes
@@ -0,0 +1,81 @@
+"""
+Caché por worker del usuario autenticado
+
+Guarda la fila de users resuelta por get_current_user() con un TTL corto,
+indexada por (user_id, access_token). Las vistas que cambian la sesión o los
+datos del usuario deben llamar a invalidate() para que el cambio se vea al
+instante en este worker; en los demás workers caduca como mucho en `ttl`.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class UserCache:
+    """Caché TTL thread-safe de filas de usuario"""
+
+    def __init__(self, ttl=30, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # (user_id, access_token) -> (expires_at, user)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, user_id, access_token):
+        """Devolver una copia del usuario cacheado o None"""
+        if not self.enabled:
+            return None
+        key = (user_id, access_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+        # El token puede caducar antes que la entrada de caché
+        token_expires = user.get('token_expires')
+        if token_expires is not None and token_expires <= datetime.now():
+            self.invalidate(user_id)
+            return None
+        return dict(user)
+
+    def set(self, user_id, access_token, user):
+        """Guardar la fila de usuario para este token"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict_locked()
+            self._entries[(user_id, access_token)] = (time.monotonic() + self.ttl, dict(user))
+
+    def invalidate(self, user_id):
+        """Eliminar todas las entradas de un usuario (todos sus tokens)"""
+        if user_id is None:
+            return
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict_locked(self):
+        """Quitar entradas caducadas y, si no basta, las más antiguas"""
+        now = time.monotonic()
+        for key in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            oldest = sorted(self._entries.items(), key=lambda item: item[1][0])
+            for key, _ in oldest[:len(self._entries) - self.max_entries + 1]:
+                del self._entries[key]
+
+
+# Instancia global (USER_CACHE_TTL=0 la desactiva)
+user_cache = UserCache(ttl=int(os.getenv('USER_CACHE_TTL', 30)))